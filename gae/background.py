@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""`background` is where work off the request path gets queued: deferred tasks, or a stand-in"""
+
+# Tasks are queued with tasks.defer(function, *args, _queue=...), the deferred library's call. Where
+# there is no task queue (tests, the local stand-ins) tasks is swapped for an InProcessTasks(), which
+# runs each task at once on the calling thread.
+
+from google.appengine.ext import deferred
+
+MAINTENANCE_QUEUE = 'maintenance'   # migrations and bulk deletes, see queue.yaml
+
+
+class InProcessTasks(object) :
+    """Stand-in for deferred: runs each task at once, remembers what ran"""
+
+    def __init__(self) :
+        self.ran = []
+
+    def defer(self, function, *args, **kwargs) :
+        kwargs = dict((k, v) for k, v in kwargs.items() if not k.startswith('_'))    # _queue, _countdown ...
+        self.ran.append((function.__name__, args))
+        return function(*args, **kwargs)
+
+
+tasks = deferred     # swapped for an InProcessTasks() where there is no task queue
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""`bench_handlers` times the upload and listing handlers against the in-memory stand-ins, with RPC latency"""
+
+# USAGE
+# python bench_handlers.py [-n 20] [--latency-ms 20]
+#
+# The stand-ins (standins/) answer instantly, which hides what overlapping RPCs buys. Here every
+# stand-in datastore, memcache, blobstore, images and GCS call first sleeps latency_ms, as a
+# production RPC takes a while, and an async call runs on its own thread from the moment it is
+# made, its future waiting for that thread. Per endpoint the report gives the mean wall clock per
+# request next to the summed latency of the calls it made: what the request would take if each
+# call waited for the one before. The listing caches are bumped before every request, outside
+# its timing, so the datastore is hit, and queued tasks are let finish between requests. A
+# stand-in tasklet runs to its end when called, so only futures started before a yield overlap.
+
+import argparse
+import functools
+import os
+import sys
+import threading
+import time
+import uuid
+from StringIO import StringIO
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class RpcLedger(object) :
+    """Summed call latency, across RPC threads"""
+
+    def __init__(self) :
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.seconds = 0.0
+
+    def add(self, seconds) :
+        with self.lock :
+            self.calls += 1
+            self.seconds += seconds
+
+    def take(self) :
+        with self.lock :
+            taken = (self.calls, self.seconds)
+            self.calls, self.seconds = 0, 0.0
+            return taken
+
+
+def slow_standins(latency, ledger) :
+    """ make each outermost stand-in call cost latency seconds, and run async calls on threads """
+    from standins import ndb, memcache, blobstore, images, cloudstorage
+    depth = threading.local()
+
+    def slowed(function) :
+        @functools.wraps(function)
+        def call(*args, **kwargs) :
+            outermost = not getattr(depth, 'calls', 0)
+            depth.calls = getattr(depth, 'calls', 0) + 1
+            try :
+                if outermost :      # one RPC, however the stand-in implements it
+                    time.sleep(latency)
+                    ledger.add(latency)
+                return function(*args, **kwargs)
+            finally :
+                depth.calls -= 1
+        return call
+
+    for module, names in ((ndb, ('get_multi', 'put_multi', 'delete_multi')),
+                          (memcache, ('get', 'get_multi', 'set', 'set_multi', 'add', 'add_multi', 'incr',
+                                      'delete', 'delete_multi')),
+                          (blobstore, ('create_gs_key',)),
+                          (images, ('get_serving_url',)),
+                          (cloudstorage, ('open', 'stat', 'delete', 'compose', 'copy2'))) :
+        for name in names :
+            setattr(module, name, slowed(getattr(module, name)))
+    for cls, names in ((ndb.Query, ('fetch', 'fetch_page', 'get', 'count')),
+                       (ndb.Key, ('get', 'delete')),
+                       (ndb.Model, ('put',))) :
+        for name in names :
+            setattr(cls, name, slowed(getattr(cls, name).__func__ if hasattr(getattr(cls, name), '__func__')
+                                      else getattr(cls, name)))
+    get_by_id = ndb.Model.__dict__['get_by_id'].__func__
+    ndb.Model.get_by_id = classmethod(slowed(get_by_id))
+
+    class ThreadedFuture(ndb.Future) :
+        """Runs its call on a thread from creation; get_result() waits for it"""
+
+        def __init__(self, function, args, kwargs) :
+            ndb.Future.__init__(self)
+            self.thread = threading.Thread(target=self.work, args=(function, args, kwargs))
+            self.thread.daemon = True
+            self.thread.start()
+
+        def work(self, function, args, kwargs) :
+            try :
+                self.result = function(*args, **kwargs)
+            except Exception as error :
+                self.exception = error
+
+        def get_result(self) :
+            self.thread.join()
+            return ndb.Future.get_result(self)
+
+        def wait(self) :
+            self.thread.join()
+
+        def done(self) :
+            return not self.thread.is_alive()
+
+    def run(cls, function, *args, **kwargs) :
+        if ndb.STORE.lock._is_owned() :
+            # in a stand-in transaction, which holds the store lock: a thread would wait on it for good
+            return ndb.Future(function(*args, **kwargs))
+        return ThreadedFuture(function, args, kwargs)
+    ndb.Future.run = classmethod(run)
+
+
+def run(n, latency) :
+    sys.path.insert(0, HERE)
+    import local_server
+    app = local_server.make_app()
+    import standins
+
+    import main
+    from listing_cache import INCIDENT_LISTINGS, DEVICE_LISTINGS
+    from device import Device, device_group_key
+    for i in range(5) :
+        Device(parent=device_group_key(), external_id='bench camera {}'.format(i)).put()
+
+    ledger = RpcLedger()
+    slow_standins(latency, ledger)
+    client = app.test_client()
+    jpeg = open(os.path.join(HERE, 'static', 'favicon.ico'), 'rb').read()    # any bytes do, nothing decodes them
+
+    def upload() :
+        name = '{}.jpg'.format(uuid.uuid4().hex)
+        return client.post('/upload_image', content_type='multipart/form-data',
+                           data={'api' : '1', 'camera' : 'bench', 'img' : (StringIO(jpeg + name), name, 'image/jpeg')})
+
+    def show() :
+        return client.get('/show')
+
+    def devices() :
+        return client.get('/devices')
+
+    print "{:<12} {:>8} {:>10} {:>12} {:>8}".format('endpoint', 'requests', 'wall ms', 'serial ms', 'overlap')
+    for name, request, prepare in (('upload', upload, None),
+                                   ('show', show, INCIDENT_LISTINGS.bump),
+                                   ('devices', devices, DEVICE_LISTINGS.bump)) :
+        wall = 0.0
+        serial = 0.0
+        for _ in range(n) :
+            if prepare :
+                prepare()
+            ledger.take()
+            start = time.time()
+            response = request()
+            wall += time.time() - start
+            serial += ledger.take()[1]
+            standins.deferred.wait_idle(30)    # queued tasks (derivatives) are not the request's calls
+            if response.status_code >= 400 :
+                print name, "failed:", response.status_code, response.data[:200]
+                break
+        print "{:<12} {:>8} {:>10.1f} {:>12.1f} {:>7.2f}x".format(name, n, 1000 * wall / n, 1000 * serial / n,
+                                                                    serial / wall if wall else 0.0)
+
+
+def main() :
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=20, help="requests per endpoint")
+    ap.add_argument("--latency-ms", type=float, default=20.0, help="added to every stand-in call")
+    args = ap.parse_args()
+    run(args.n, args.latency_ms / 1000.0)
+
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""`bulk_delete` empties a kind (optionally under one ancestor) in cursor batches, GCS objects and all"""
+
+# A DeleteJob entity is the checkpoint: the query cursor after the last batch deleted, and counts.
+# Each batch is a task (queue "maintenance", see queue.yaml) that fetches a page from the cursor,
+# deletes the page's GCS objects on parallel threads and then the entities, saves the cursor and
+# queues the next batch. A batch retried after its deletes finds those entities gone and carries on
+# from the same cursor; a task that arrives for an older batch number is a duplicate and does nothing.
+# A job whose tasks were lost can be resumed from /jobs. delete_now() runs the same batches inline.
+#
+# Kinds register what to delete alongside an entity (object names), which of a batch's entities
+# share their objects with entities outside it (those objects are kept, an identical upload may have
+# just reused one), what to do with a page about to be deleted (drop caches keyed by it) and which
+# listing to invalidate, which is bumped after every batch.
+
+import logging
+
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+
+import cloudstorage as gcs  # pip installed into app directoy/lib, not a first class citizen quite yet
+
+from metrics import REGISTRY
+import background
+
+DELETE_BATCH_SIZE = 200     # entities per batch (and per task)
+MAX_DELETE_THREADS = 8      # concurrent GCS deletes per batch
+
+OBJECT_NAMES = {}           # kind : function(entity) -> GCS object names to delete with it
+SHARED = {}                 # kind : function(entities) -> keys of those whose objects are still used elsewhere
+DELETED = {}                # kind : function(entities) called before they are deleted, e.g. to drop caches
+LISTINGS = {}               # kind : ListingCache to bump as the kind is deleted
+
+
+def register(kind, object_names=None, listing=None, shared=None, deleted=None) :
+    if deleted is not None :
+        DELETED[kind] = deleted
+    if object_names is not None :
+        OBJECT_NAMES[kind] = object_names
+    if shared is not None :
+        SHARED[kind] = shared
+    if listing is not None :
+        LISTINGS[kind] = listing
+
+
+class DeleteJob(ndb.Model) :
+    """A bulk delete, running or finished, and where it has got to"""
+    kind = ndb.StringProperty(indexed=False)
+    ancestor = ndb.KeyProperty(indexed=False)           # None for the whole kind
+    status = ndb.StringProperty(indexed=False, default='running')   # running, done
+    cursor = ndb.StringProperty(indexed=False)          # urlsafe, after the last batch deleted
+    batch = ndb.IntegerProperty(indexed=False, default=0)   # next batch to run
+    deleted = ndb.IntegerProperty(indexed=False, default=0)
+    objects_deleted = ndb.IntegerProperty(indexed=False, default=0)
+    error = ndb.StringProperty(indexed=False)           # last failure, the task queue retries it
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def recent(cls, limit=20) :
+        return cls.query().order(-cls.started).fetch(limit)
+
+
+def delete_object(name) :
+    try :
+        gcs.delete(name)
+        return 1
+    except gcs.NotFoundError :
+        return 0    # never written (a clip's derivatives), or deleted by an earlier try of this batch
+
+
+def delete_batch(kind, ancestor=None, cursor_text=None, batch_size=DELETE_BATCH_SIZE) :
+    """ delete one page of kind from cursor_text: (entities deleted, objects deleted, next cursor, more) """
+    import main     # registers the models and their object names; a task may run in a fresh instance
+    object_names = OBJECT_NAMES.get(kind)
+    query = ndb.Query(kind=kind, ancestor=ancestor)
+    cursor = Cursor(urlsafe=cursor_text) if cursor_text else None
+    with REGISTRY.timer('gae_call_seconds', call='datastore_query') :
+        page, next_cursor, more = query.fetch_page(batch_size, start_cursor=cursor, keys_only=object_names is None and kind not in DELETED)
+    keys = page if object_names is None and kind not in DELETED else [entity.key for entity in page]
+    if kind in DELETED :
+        DELETED[kind](page)
+    objects = 0
+    if object_names is not None :
+        keep = SHARED[kind](page) if kind in SHARED else set()
+        names = [name for entity in page if entity.key not in keep for name in object_names(entity)]
+        with REGISTRY.timer('gae_call_seconds', call='gcs_delete') :
+            objects = sum(main.parallel_map(delete_object, names, MAX_DELETE_THREADS))
+    with REGISTRY.timer('gae_call_seconds', call='datastore_delete') :
+        ndb.delete_multi(keys)
+    REGISTRY.inc('bulk_deleted_total', len(keys), kind=kind)
+    return len(keys), objects, next_cursor.urlsafe() if more and next_cursor else None, more
+
+
+def cleared(kind) :
+    if kind in LISTINGS :
+        LISTINGS[kind].bump()
+
+
+def delete_now(kind, ancestor=None, batch_size=DELETE_BATCH_SIZE) :
+    """ delete inline, batch by batch; for small sets and callers that need them gone on return """
+    deleted, objects, cursor_text, more = 0, 0, None, True
+    while more :
+        entities, blobs, cursor_text, more = delete_batch(kind, ancestor, cursor_text, batch_size)
+        deleted += entities
+        objects += blobs
+    cleared(kind)
+    return deleted, objects
+
+
+def start_delete_job(kind, ancestor=None) :
+    """ record a DeleteJob and queue its first batch; the job's key """
+    job_key = DeleteJob(kind=kind, ancestor=ancestor).put()
+    queue_batch(job_key.id(), 0)
+    return job_key
+
+
+def queue_batch(job_id, batch) :
+    background.tasks.defer(run_delete_batch, job_id, batch, _queue=background.MAINTENANCE_QUEUE)
+
+
+def resume_delete_job(job_id) :
+    """ queue the next batch of an unfinished job again, after its task was lost; False if there is nothing to resume """
+    job = DeleteJob.get_by_id(job_id)
+    if job is None or job.status == 'done' :
+        return False
+    queue_batch(job_id, job.batch)
+    return True
+
+
+def run_delete_batch(job_id, batch, batch_size=DELETE_BATCH_SIZE) :
+    """ task: delete the job's next batch, checkpoint, queue the one after or finish """
+    job = DeleteJob.get_by_id(job_id)
+    if job is None or job.status == 'done' or job.batch != batch :
+        logging.info("run_delete_batch() job {} batch {} already run".format(job_id, batch))
+        return
+    try :
+        entities, objects, job.cursor, more = delete_batch(job.kind, job.ancestor, job.cursor, batch_size)
+    except Exception as error :
+        job.error = '{}: {}'.format(type(error).__name__, error)
+        job.put()
+        raise       # and the queue retries this batch from the saved cursor
+    job.batch += 1
+    job.deleted += entities
+    job.objects_deleted += objects
+    job.error = None
+    if not more :
+        job.status = 'done'
+    job.put()
+    cleared(job.kind)       # no cached page may link to what this batch deleted
+    if more :
+        queue_batch(job_id, job.batch)
+    else :
+        logging.info("run_delete_batch() job {} done, {} deleted".format(job_id, job.deleted))
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""`derivatives` makes the thumbnail and medium sized copies of an uploaded image, off the upload request"""
+
+# Uploads only queue the work: a deferred task (queue "derivatives", see queue.yaml) has the images
+# service resize the GCS original, writes each size back to GCS next to it as <name>.<size>.jpg, and
+# records the serving urls on the Incident. Until the task has run the listing falls back to the
+# original. Clips are skipped.
+
+import logging
+
+from google.appengine.ext import ndb
+from google.appengine.ext import blobstore
+from google.appengine.api import images
+
+import cloudstorage as gcs  # pip installed into app directoy/lib, not a first class citizen quite yet
+
+from metrics import REGISTRY
+from listing_cache import INCIDENT_LISTINGS
+import background
+
+# derivative : longest side in pixels
+SIZES = (('thumb', 200), ('medium', 800))
+JPEG_QUALITY = 80
+TASK_QUEUE = 'derivatives'
+
+
+def derivative_name(gcs_filename, size_name) :
+    return '{}.{}.jpg'.format(gcs_filename, size_name)
+
+
+def exists(gcs_filename) :
+    try :
+        gcs.stat(gcs_filename)
+        return True
+    except gcs.NotFoundError :
+        return False
+
+
+def enqueue_derivatives(incident, gcs_filename) :
+    """ queue the derivative task for an image incident that has been put() """
+    if incident.is_clip() :
+        return
+    background.tasks.defer(make_derivatives, incident.key.urlsafe(), gcs_filename, _queue=TASK_QUEUE)
+
+
+def make_derivatives(incident_key, gcs_filename) :
+    """ task: resize the original into each of SIZES, store them and their serving urls on the incident """
+    import main     # the Incident model lives there; a task may run in a fresh instance that never imported it
+    incident = ndb.Key(urlsafe=incident_key).get()
+    if incident is None :
+        return      # cleared from the log before the task ran
+    urls = {}
+    for size_name, pixels in SIZES :
+        name = derivative_name(gcs_filename, size_name)
+        if exists(name) :
+            # the same content uploaded again: its derivatives were made the first time
+            urls[size_name] = images.get_serving_url(blobstore.create_gs_key('/gs' + name))
+            continue
+        with REGISTRY.timer('gae_call_seconds', call='images_resize') :
+            image = images.Image(blob_key=incident.gcs_blob_image_key)
+            image.resize(width=pixels, height=pixels)
+            data = image.execute_transform(output_encoding=images.JPEG, quality=JPEG_QUALITY)
+        with REGISTRY.timer('gae_call_seconds', call='gcs_write') :
+            with gcs.open(name, 'w', content_type='image/jpeg') as f :
+                f.write(data)
+        with REGISTRY.timer('gae_call_seconds', call='images_serving_url') :
+            urls[size_name] = images.get_serving_url(blobstore.create_gs_key('/gs' + name))
+    incident.thumb_url = urls['thumb']
+    incident.medium_url = urls['medium']
+    incident.put()
+    INCIDENT_LISTINGS.bump()
+    logging.info("make_derivatives() {} done".format(gcs_filename))
@@ -10,18 +10,26 @@
 import logging
 import os
 import time
+import datetime
 import json
 import cgi
 import urllib
 
 # import Google specific modules
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.api import memcache
 from google.appengine.ext import blobstore    # not using blob storage, but are using blob API on GCS (well, that's the plan)
 
 import cloudstorage as gcs  # pip installed into app directoy/lib, not a first class citizen quite yet
 
+from listing_cache import DEVICE_LISTINGS
+import background
+import bulk_delete
+
 # GCS bucket suffix, after app name
 APP_DOMAIN = '.appspot.com'             # GAE convention  TBD import from config file throughout *.py
+LEASE_SECONDS = 60                      # a leased command is hidden from other leases this long, then redelivered
 
 
 # set up the datastore models
@@ -51,6 +59,9 @@ class Device(ndb.Model) :
     # implied: ndb Device.id is ssigned by GCS
     # implied: to do queue's added later, Queued items point to devices.
 
+    def _post_put_hook(self, future) :
+        DEVICE_LISTINGS.bump()      # any device write invalidates the cached /devices listing
+
     @classmethod 
     def find_all_devices(cls) :
         return cls.query().order(-cls.last_ping_time)
@@ -61,51 +72,71 @@ class Device(ndb.Model) :
         ancestor_key = device_group_key(device_group_id)
         return cls.query(ancestor=ancestor_key).order(-cls.last_ping_time)
 
+    @classmethod
+    def key_for_external_id(cls, external_id, device_group_id = None) :
+        """ the key of the device with this external id, a new device (id = external id) if there is none """
+        found = cls.query(cls.external_id == external_id).fetch(1, keys_only=True)
+        if found :
+            return found[0]
+        return cls.get_or_insert(external_id, parent=device_group_key(device_group_id), external_id=external_id).key
+
     @classmethod
     # purposefully no default id, but whole key required
-    def clear_group(cls, device_group_id):
+    def clear_group(cls, device_group_id, background=False):
+        """ delete the group's devices in batches, inline or as a background DeleteJob (its key returned) """
         ancestor_key = device_group_key(device_group_id)
-        ndb.delete_multi(cls.query(ancestor=ancestor_key).fetch(keys_only=True))
+        if background :
+            return bulk_delete.start_delete_job(cls._get_kind(), ancestor_key)
+        bulk_delete.delete_now(cls._get_kind(), ancestor_key)
         # and ignore referential integrity issues in To Do Queuesq
 
 
 
-# default <kind, id> ancestor for queue items in ndb
-# by convention - the <kind> is stable, vary the ancestor key's id()
+# Every device has its own 'to do' queue, a root key of its own (queue_key()) that its commands are
+# children of. Devices all sit in their device group's entity group, so a command under its Device
+# would share that group's one write per second or so with every other device's commands, the
+# heartbeat's Device writes and get_or_insert(). Under its own root, a device's enqueues, leases and
+# acknowledgements write only that queue. Commands stored under the device or the old single
+# To_Do_Queue/Commands root are moved by reparent_commands() (/migrate_shards).
+
 QUEUE_KIND = "To_Do_Queue"
-DEFAULT_QUEUE_ID = "Commands"
 
-# Note - not using the device as the parent, but entities point back to a device as defined in the Model
-# This could be debatable.
-# A common Parent, via single queue_id, supports "find all to do" type queries via ancestor.
-# the real issue is likely write speeds at scale
-# millions of devices may not warrant millions of "to do" writes.
-# not a problem for ~10 camera [TBD async retry code...ha]
+def queue_key(device_key) :
+    """ the root key a device's commands are children of, no entity behind it """
+    return ndb.Key(QUEUE_KIND, device_key.urlsafe())
 
-def queue_key(queue_id = None) :
-    queue_key = ndb.Key(QUEUE_KIND, queue_id or DEFAULT_QUEUE_ID)
-    """Constructs a command queue Datastore key to be used as the ancestor for a group of commands """
-    return queue_key
+# Delivery is by lease: a device takes its pending commands, which are hidden from further leases
+# until lease_expires, and acknowledges the ones it has run in one batch. A command that is not
+# acknowledged in time (the pi crashed, the reply was lost) is delivered again. Every enqueue bumps a
+# per device memcache counter that long polls watch, so a waiting device queries only when told to,
+# and that pings compare with the value at which the device last had nothing (idle_key), so a ping
+# from a device with no commands costs memcache gets, not a query.
 
 # a set of commands for some device to do
 class To_Do_Command(ndb.Model) :
     """A command and optional parametes is added to queue aimed at a device,"""
-    device = ndb.KeyProperty(kind=Device, indexed=True)
+    device = ndb.KeyProperty(kind=Device, indexed=True)     # the parent is queue_key(device)
     queue_time = ndb.DateTimeProperty(indexed=True, auto_now_add=True)  # when added to queue
-    status = ndb.StringProperty(indexed=True)
+    status = ndb.StringProperty(indexed=True)               # pending, then done or failed as acknowledged
     command = ndb.StringProperty(indexed=False)
     simple_parameters = ndb.StringProperty(indexed=False) # flattened json
     binary_parameter = ndb.BlobProperty()
+    lease_expires = ndb.DateTimeProperty(indexed=True)      # leasable from then on; set to the queue time on put
+    lease_count = ndb.IntegerProperty(indexed=False, default=0)     # deliveries so far
+    done_time = ndb.DateTimeProperty(indexed=False)
+
+    def _pre_put_hook(self) :
+        if self.lease_expires is None :
+            self.lease_expires = datetime.datetime.now()
 
 
     # this is debatable, operates on class because operating on ndb model
     # let's call it a wrapper
     @classmethod
-    def assign_device(cls, queue_id = None, **kwargs) :
-        """ add a new command for a specific device in the given queue group """
-        cmd = cls(parent = queue_key(queue_id))
+    def assign_device(cls, **kwargs) :
+        """ add a new command to a specific device's queue """
         if 'device' in kwargs :
-            cmd.device = kwargs['device']
+            cmd = cls(parent = queue_key(kwargs['device']), device = kwargs['device'])
         else :
             raise ValueError('Adding command to device, but no device key specified')
         if 'command' in kwargs :
@@ -114,28 +145,126 @@ class To_Do_Command(ndb.Model) :
             cmd.simple_parameters = kwargs['parameters']
         if 'binary' in kwargs :
             cmd.binary_parameter = kwargs['binary']
-        status = kwargs['status'] if 'status' in kwargs else 'pending'
+        cmd.status = kwargs['status'] if 'status' in kwargs else 'pending'
         command_key = cmd.put()
         # print "added command:", command_key, "to device:", cmd.device
         return command_key
 
     @classmethod
-    def find_commands_in_queue(cls, queue_id=None) :
-        """ retrieve all commands with a common ancestor """
-        ancestor_key = queue_key(queue_id)
-        return cls.query(ancestor=ancestor_key).order(-cls.queue_time)
+    def find_commands_in_group(cls, device_group_id = None) :
+        """ retrieve the commands for all the devices in a device group (an IN query, so a few devices) """
+        device_keys = Device.find_devices_in_group(device_group_id).fetch(keys_only=True)
+        return cls.query(cls.device.IN(device_keys or [None])).order(-cls.queue_time)
 
     @classmethod
     def find_commands_for_device(cls, device_key) :
-        """ retrieve commands pointing at device (commands may be from more than one queue group) """
-        # return cls.query(cls.device == device_key).order(-cls.queue_time)
-        print "finding commands for device", device_key
-        return cls.query().filter(cls.device == device_key).order(-cls.queue_time)
+        """ retrieve the device's commands, newest first """
+        return cls.query(ancestor=queue_key(device_key)).order(-cls.queue_time)
+
+    @classmethod
+    def enqueue(cls, device_keys, command, parameters = None) :
+        """ the same command for each device, in one put_multi; waiting long polls are signalled """
+        commands = [cls(parent = queue_key(device_key), device = device_key, command = command,
+                        simple_parameters = parameters, status = 'pending') for device_key in device_keys]
+        keys = ndb.put_multi(commands)
+        for device_key in set(device_keys) :
+            memcache.incr(cls.signal_key(device_key), initial_value=0)
+        return keys
+
+    @staticmethod
+    def signal_key(device_key) :
+        """ memcache counter bumped whenever the device is sent a command """
+        return 'commands-signal:' + device_key.urlsafe()
+
+    @staticmethod
+    def idle_key(device_key) :
+        """ memcache: the signal value at which the device was last found with nothing to lease """
+        return 'commands-idle:' + device_key.urlsafe()
 
     @classmethod
-    def clear_queue(cls, queue_id = None) :
-        ancestor_key = queue_key(queue_id)
-        ndb.delete_multi(cls.query(ancestor=ancestor_key).fetch(keys_only=True))
+    def leasable_for_device(cls, device_key, now = None) :
+        """ the device's pending commands not leased out at now, oldest lease first """
+        now = now or datetime.datetime.now()
+        return cls.query(cls.status == 'pending', cls.lease_expires <= now,
+                         ancestor=queue_key(device_key)).order(cls.lease_expires)
+
+    @classmethod
+    def lease(cls, device_key, max_commands = 10, lease_seconds = LEASE_SECONDS) :
+        """ take up to max_commands of the device's pending commands for lease_seconds; the leased commands """
+        now = datetime.datetime.now()
+        keys = cls.leasable_for_device(device_key, now).fetch(max_commands, keys_only=True)
+        if not keys :
+            return []
+
+        # each command is checked again inside the transaction (one entity group, the device's queue);
+        # of two racing leases only one sees it still leasable
+        @ndb.transactional()
+        def take() :
+            leased = [command for command in ndb.get_multi(keys)
+                      if command is not None and command.status == 'pending' and command.lease_expires <= now]
+            for command in leased :
+                command.lease_expires = now + datetime.timedelta(seconds=lease_seconds)
+                command.lease_count += 1
+            ndb.put_multi(leased)
+            return leased
+        return take()
+
+    @classmethod
+    def acknowledge(cls, device_key, command_ids, status = 'done') :
+        """ mark the device's commands (urlsafe ids) done or failed in one put_multi; how many were """
+        keys = []
+        for command_id in command_ids :
+            try :
+                key = ndb.Key(urlsafe=command_id)
+            except Exception :
+                continue        # not a key at all
+            if key.kind() == cls._get_kind() and key.parent() == queue_key(device_key) :
+                keys.append(key)
+        now = datetime.datetime.now()
+        acknowledged = [command for command in ndb.get_multi(keys)
+                        if command is not None and command.device == device_key and command.status == 'pending']
+        for command in acknowledged :
+            command.status = status
+            command.done_time = now
+        ndb.put_multi(acknowledged)
+        return len(acknowledged)
+
+    def to_dict_for_device(self) :
+        """ what a device is sent: id, command and the decoded parameters """
+        return dict(id = self.key.urlsafe(),
+                    command = self.command,
+                    parameters = json.loads(self.simple_parameters) if self.simple_parameters else None)
+
+    @classmethod
+    def clear_queue(cls, device_group_id = None, background=False) :
+        """ delete the group's devices' commands in batches, inline or as background DeleteJobs, one per
+            device (their keys returned) """
+        jobs = []
+        for device_key in Device.find_devices_in_group(device_group_id).fetch(keys_only=True) :
+            if background :
+                jobs.append(bulk_delete.start_delete_job(cls._get_kind(), queue_key(device_key)))
+            else :
+                bulk_delete.delete_now(cls._get_kind(), queue_key(device_key))
+        return jobs
+
+
+def reparent_commands(cursor_text = None, batch_size = 100) :
+    """ task: move a batch of commands not yet under their device's queue_key(), keeping each id; repeats
+        until every command has been looked at """
+    # same id under the new parent, so a task retried after the put but before the delete puts the same again
+    cursor = Cursor(urlsafe=cursor_text) if cursor_text else None
+    commands, next_cursor, more = To_Do_Command.query().fetch_page(batch_size, start_cursor=cursor)
+    old = [command for command in commands
+           if command.device is not None and command.key.parent() != queue_key(command.device)]
+    ndb.put_multi([To_Do_Command(parent = queue_key(command.device), id = command.key.id(), **command.to_dict())
+                   for command in old])
+    ndb.delete_multi([command.key for command in old])
+    logging.info("reparent_commands() moved {}".format(len(old)))
+    if more and next_cursor :
+        background.tasks.defer(reparent_commands, next_cursor.urlsafe(), batch_size,
+                               _queue=background.MAINTENANCE_QUEUE)
+
+bulk_delete.register(Device._get_kind(), listing=DEVICE_LISTINGS)
 
 def unit_test_devices() :
     # Ok, more like code coverage
@@ -152,6 +281,8 @@ def unit_test_devices() :
 
         # this should either work, or be a silent no-op.
         # if it fails to clear, and leaves junk, then remaining results are non-conclusive
+        # (previous tests' commands first, they are found through their devices)
+        To_Do_Command.clear_queue(test_device_group_id)
         Device.clear_group(test_device_group_id)
 
         # create device_one
@@ -169,26 +300,12 @@ def unit_test_devices() :
         assert len(query.fetch()) == 1, "expected one test device, but found %d" % len(query.fetch())
         assert query.fetch()[0].key.id() == device_one_key.id(), "test device key.id put() does not match test device key fetched"
 
-        # check default queue group <kind>,<id>
-        default_queue_key = queue_key()
-        assert default_queue_key.kind() == QUEUE_KIND, "Default Queue kind failure"
-        assert default_queue_key.string_id() == DEFAULT_QUEUE_ID, "Default queue id failure"
-
-        # create a test queue or, viewed per device, a group of queues
-        test_queue_id = "test_queue"
-        test_queue_key = queue_key(test_queue_id)
-        assert test_queue_key.kind() == QUEUE_KIND, "test queue kind failure: " + test_queue_key.kind()
-        assert test_queue_key.string_id() == test_queue_id, "test queue id failure"
-
-        # silent, untested cleanup of any previuos tests (hopefully not clearing other queue grpousp!)
-        To_Do_Command.clear_queue(test_queue_id)
-
         # manually create command_one for device_one
-        command_one = To_Do_Command(parent=test_queue_key, device=device_one_key, command="test me")
+        command_one = To_Do_Command(parent=queue_key(device_one_key), device=device_one_key, command="test me")
         command_one_key = command_one.put()
 
-        # retrieve all commands in this test queue group (only one)
-        query = To_Do_Command.find_commands_in_queue(test_queue_id)
+        # retrieve all commands for the test device group (only one)
+        query = To_Do_Command.find_commands_in_group(test_device_group_id)
         assert len(query.fetch()) == 1, "expected one test command, but found %d" % len(query.fetch())
         assert query.fetch()[0].key.id() == command_one_key.id(), "test command key put() does not match test command key fetched"
         assert query.fetch()[0].device == device_one_key, "expected device one key: " + device_one_key +", but got: " + query.fetch()[0].device
@@ -204,11 +321,11 @@ def unit_test_devices() :
         test_device_two = Device(parent=test_device_group_key, external_id="test device two")
         device_two_key = test_device_two.put()
         time.sleep(1)
-        command_two_key = To_Do_Command.assign_device(queue_id=test_queue_id, device=device_two_key, command="test me too")
+        command_two_key = To_Do_Command.assign_device(device=device_two_key, command="test me too")
         time.sleep(1)
 
-        # retrieve all commands in this test queue group (now there are two)
-        query = To_Do_Command.find_commands_in_queue(test_queue_id)
+        # retrieve all commands for the test device group (now there are two)
+        query = To_Do_Command.find_commands_in_group(test_device_group_id)
         assert len(query.fetch()) == 2, "expected two test commands, but found %d" % len(query.fetch())
 
         # retrieve the command aimed at device_two
@@ -219,11 +336,11 @@ def unit_test_devices() :
 
         # at this point, two devices, two commands, one command per device
         # add command_three for device_two, retrieve and check.
-        command_three_key = To_Do_Command.assign_device(queue_id=test_queue_id, device=device_two_key, command="test me third")
+        command_three_key = To_Do_Command.assign_device(device=device_two_key, command="test me third")
         time.sleep(1)
 
-        # retrieve all commands in this test queue group (now three); also confirms cls.order
-        query = To_Do_Command.find_commands_in_queue(test_queue_id)
+        # retrieve all commands for the test device group (now three); also confirms cls.order
+        query = To_Do_Command.find_commands_in_group(test_device_group_id)
         assert len(query.fetch()) == 3, "expected three test commands, but found %d" % len(query.fetch())
         assert query.fetch()[2].key == command_one_key, "expected command_one key: " + command_one_key + ", but got: " + query.fetch()[0].key
         assert query.fetch()[2].device == device_one_key, "expected device one key: " + device_one_key +", but got: " + query.fetch()[0].device
@@ -238,7 +355,7 @@ def unit_test_devices() :
         
         # clean up entities with ancesteors  == <named kind>.<test id>
 ##        Device.clear_group(test_device_group_id)
-##        To_Do_Command.clear_queue(test_queue_id)
+##        To_Do_Command.clear_queue(test_device_group_id)
 
     except AssertionError, error :
         result = error.args[0]
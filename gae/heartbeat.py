@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""`heartbeat` absorbs device pings and writes them to the datastore in bounded, batched flushes"""
+
+# A ping only updates this instance's pending dict (external id : latest ping time). When flush_seconds
+# (main.HEARTBEAT_FLUSH_SECONDS) have passed since the instance last flushed, the next ping flushes: a
+# memcache add per device, which only one instance can win per flush_seconds, picks the devices due a
+# write, and those are read and written back with one get_multi and one put_multi. Pings whose gate
+# another instance holds go back into pending for the next flush. So however often a fleet pings, each
+# device costs at most one datastore write per flush_seconds; last_ping_time is at most about that
+# stale. Devices are found by external id, created on their first ping (or again, after being
+# deleted), and the id to key lookup is kept in memcache; deleting devices forgets their lookups.
+
+import datetime
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from device import Device
+from metrics import REGISTRY
+import bulk_delete
+
+KEY_CACHE_SECONDS = 24 * 3600   # memcache lifetime of an external id's Device key
+
+
+class HeartbeatBuffer(object) :
+    """record(external_id) per ping; flushes the pending pings itself when due"""
+
+    def __init__(self, flush_seconds=0, client=None) :
+        self.flush_seconds = flush_seconds
+        self.client = client or memcache
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_flush = 0.0
+
+    def record(self, external_id, when=None) :
+        """ note a ping from external_id; returns its Device key """
+        when = when or datetime.datetime.now()
+        with self.lock :
+            if when > self.pending.get(external_id, datetime.datetime.min) :
+                self.pending[external_id] = when
+            due = time.time() - self.last_flush >= self.flush_seconds
+            if due :
+                self.last_flush = time.time()
+                pending, self.pending = self.pending, {}
+        REGISTRY.inc('heartbeats_total')
+        if due :
+            self.flush(pending)
+        return self.device_key(external_id)
+
+    def flush(self, pending) :
+        """ write last_ping_time for the devices in pending not written elsewhere in the last flush_seconds """
+        gates = dict(('heartbeat-written:' + external_id, 1) for external_id in pending)
+        refused = set(self.client.add_multi(gates, time=self.flush_seconds))
+        due = [external_id for external_id in pending if 'heartbeat-written:' + external_id not in refused]
+        with self.lock :
+            # written elsewhere lately: carried to this instance's next flush, not lost
+            for external_id in pending :
+                if 'heartbeat-written:' + external_id in refused and \
+                   pending[external_id] > self.pending.get(external_id, datetime.datetime.min) :
+                    self.pending[external_id] = pending[external_id]
+        if not due :
+            return 0
+        keys = [self.device_key(external_id) for external_id in due]
+        with REGISTRY.timer('gae_call_seconds', call='datastore_get') :
+            devices = ndb.get_multi(keys)
+        for i, (device, external_id) in enumerate(zip(devices, due)) :
+            if device is None :
+                # deleted since its key was cached: look it up afresh, which makes a new one if need be
+                self.forget(external_id)
+                device = devices[i] = self.device_key(external_id).get()
+            device.last_ping_time = pending[external_id]
+        with REGISTRY.timer('gae_call_seconds', call='datastore_put') :
+            ndb.put_multi(devices)
+        REGISTRY.inc('heartbeat_writes_total', len(devices))
+        return len(devices)
+
+    def device_key(self, external_id) :
+        cache_key = 'device-key:' + external_id
+        urlsafe = self.client.get(cache_key)
+        if urlsafe :
+            return ndb.Key(urlsafe=urlsafe)
+        key = Device.key_for_external_id(external_id)
+        self.client.set(cache_key, key.urlsafe(), time=KEY_CACHE_SECONDS)
+        return key
+
+    def forget(self, *external_ids) :
+        self.client.delete_multi(['device-key:' + external_id for external_id in external_ids])
+
+
+def forget_deleted_devices(devices) :
+    """ bulk_delete hook: drop the cached keys of devices about to be deleted """
+    HEARTBEATS.forget(*[device.external_id for device in devices if device.external_id])
+
+
+HEARTBEATS = HeartbeatBuffer()      # main sets flush_seconds from app.config['HEARTBEAT_FLUSH_SECONDS']
+bulk_delete.register(Device._get_kind(), deleted=forget_deleted_devices)
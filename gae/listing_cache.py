@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""`listing_cache` keeps rendered listings (incident pages, devices) out of the datastore between writes"""
+
+# Two tiers: a small LRU in each instance, then memcache, then the datastore. Nothing is ever
+# deleted to invalidate; each cache has a generation counter in memcache which writers bump, and
+# every entry is stored under the generation it was computed in, so a bump orphans the lot at
+# once, on every instance. A read costs one memcache get (the generation) and, on a local miss,
+# one more for the value. If memcache loses the counter it restarts from the clock, so an old
+# generation number is never reused. LocalMemcache is a dict with the same calls, for tests.
+#
+# A listing built from eventually consistent queries may, just after a write, not show that write
+# yet. Such a cache takes settle_seconds: for that long after a bump pages are computed but not
+# stored, so a page missing the latest upload is never kept until the next write.
+
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+
+from metrics import REGISTRY
+
+CACHE_SECONDS = 600         # memcache lifetime of a listing, orphaned generations just age out
+SETTLE_SECONDS = 3          # how long after a write the incident queries may still miss it
+LOCAL_ENTRIES = 64          # per instance LRU size, per cache
+
+
+class LocalLRU(object) :
+    """Bounded least recently used dict, safe across request threads"""
+
+    def __init__(self, max_entries=LOCAL_ENTRIES) :
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key) :
+        with self.lock :
+            value = self.entries.pop(key, None)
+            if value is not None :
+                self.entries[key] = value   # most recently used last
+            return value
+
+    def set(self, key, value) :
+        with self.lock :
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries :
+                self.entries.popitem(last=False)
+
+    def clear(self) :
+        with self.lock :
+            self.entries.clear()
+
+
+class LocalMemcache(object) :
+    """In-memory stand-in for the memcache calls used here (no expiry)"""
+
+    def __init__(self) :
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def get(self, key) :
+        return self.values.get(key)
+
+    def get_multi(self, keys) :
+        return dict((key, self.values[key]) for key in keys if key in self.values)
+
+    def set(self, key, value, time=0) :
+        self.values[key] = value
+        return True
+
+    def add_multi(self, mapping, time=0) :
+        """ the keys not added, as memcache.add_multi """
+        return [key for key, value in mapping.items() if not self.add(key, value, time)]
+
+    def add(self, key, value, time=0) :
+        with self.lock :
+            if key in self.values :
+                return False
+            self.values[key] = value
+            return True
+
+    def incr(self, key, delta=1, initial_value=None) :
+        with self.lock :
+            if key not in self.values :
+                if initial_value is None :
+                    return None
+                self.values[key] = initial_value
+            self.values[key] += delta
+            return self.values[key]
+
+
+class ListingCache(object) :
+    """get(key, compute) through the LRU and memcache; bump() after any write that changes the listing"""
+
+    def __init__(self, name, client=None, local_entries=LOCAL_ENTRIES, seconds=CACHE_SECONDS, settle_seconds=0) :
+        self.name = name
+        self.client = client or memcache
+        self.local = LocalLRU(local_entries)
+        self.seconds = seconds
+        self.settle_seconds = settle_seconds
+        self.generation_key = 'listing-generation:' + name
+        self.bumped_key = 'listing-bumped:' + name
+
+    def generation(self) :
+        """ (current generation, time of the last bump or None) """
+        values = self.client.get_multi([self.generation_key, self.bumped_key])
+        generation = values.get(self.generation_key)
+        if generation is None :
+            self.client.add(self.generation_key, int(time.time() * 1000))
+            generation = self.client.get(self.generation_key)
+        return generation, values.get(self.bumped_key)
+
+    def bump(self) :
+        self.client.incr(self.generation_key, initial_value=int(time.time() * 1000))
+        if self.settle_seconds :
+            self.client.set(self.bumped_key, time.time(), time=self.seconds)
+
+    def get(self, key, compute) :
+        """ the cached value for key in the current generation, else compute() (which must not return None) """
+        generation, bumped = self.generation()
+        if bumped is not None and time.time() - bumped < self.settle_seconds :
+            REGISTRY.inc('listing_cache_total', cache=self.name, result='settling')
+            return compute()
+        value_key = 'listing:{}:{}:{}'.format(self.name, generation, key)
+        value = self.local.get(value_key)
+        if value is not None :
+            REGISTRY.inc('listing_cache_total', cache=self.name, result='local')
+            return value
+        value = self.client.get(value_key)
+        if value is not None :
+            REGISTRY.inc('listing_cache_total', cache=self.name, result='memcache')
+        else :
+            REGISTRY.inc('listing_cache_total', cache=self.name, result='miss')
+            value = compute()
+            self.client.set(value_key, value, time=self.seconds)
+        self.local.set(value_key, value)
+        return value
+
+
+INCIDENT_LISTINGS = ListingCache('incidents', settle_seconds=SETTLE_SECONDS)     # non-ancestor queries
+DEVICE_LISTINGS = ListingCache('devices')
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""`load_test` drives the web app with concurrent uploads, listings, pings and command polls"""
+
+# USAGE
+# python load_test.py [--url http://host:port] [-c 8] [--seconds 20] [--mix upload=4,show=1,api=2,ping=4,commands=1]
+#                     [--devices 10] [--image some.jpg]
+#
+# Without --url the app is started in this process on the in-memory stand-ins (local_server.py), so
+# the numbers compare one commit with the next on the same box rather than predict production; the
+# server shares the interpreter (and its lock) with the clients. Against a deployed app only the pi
+# endpoints (upload, ping, commands) get through; the listings want a Google sign in. Each of the
+# -c workers picks endpoints at random in the --mix proportions until --seconds are up; the report
+# gives per endpoint the requests, errors (HTTP 400 and up, redirects for the listings, exceptions),
+# throughput and latency quantiles. Uploads carry random perceptual hashes, so none are merged.
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+import requests
+
+DEFAULT_MIX = 'upload=4,show=1,api=2,ping=4,commands=1'
+
+
+class Recorder(object) :
+    """Latency samples and error counts per endpoint, across worker threads"""
+
+    def __init__(self) :
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def add(self, endpoint, seconds, ok) :
+        with self.lock :
+            self.samples.setdefault(endpoint, []).append(seconds)
+            if not ok :
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, elapsed) :
+        print "{:<10} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+            'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms')
+        total = 0
+        for endpoint in sorted(self.samples) :
+            samples = sorted(self.samples[endpoint])
+            total += len(samples)
+            print "{:<10} {:>8} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+                endpoint, len(samples), self.errors.get(endpoint, 0), len(samples) / elapsed,
+                1000 * quantile(samples, 0.5), 1000 * quantile(samples, 0.95), 1000 * quantile(samples, 0.99),
+                1000 * samples[-1])
+        print "{:<10} {:>8} {:>7} {:>9.1f}".format('all', total, sum(self.errors.values()), total / elapsed)
+
+
+def quantile(ordered, q) :
+    """ nearest rank quantile of a sorted list """
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+class Client(object) :
+    """One worker's session and the requests it can make"""
+
+    def __init__(self, url, devices, image) :
+        self.url = url
+        self.devices = devices
+        self.image = image
+        self.session = requests.Session()
+
+    def upload(self) :
+        # a few random bytes after the image make each upload new content, not a dedup hit
+        files = {'img' : ('{}.jpg'.format(uuid.uuid4().hex), self.image + uuid.uuid4().bytes, 'image/jpeg')}
+        data = dict(api='1', camera=random.choice(self.devices), reason='load test', dhash=uuid.uuid4().hex[:16])
+        return self.session.post(self.url + '/upload_image', files=files, data=data)
+
+    def show(self) :
+        return self.session.get(self.url + '/show', allow_redirects=False)
+
+    def api(self) :
+        return self.session.get(self.url + '/api/incidents', params=dict(limit=50), allow_redirects=False)
+
+    def ping(self) :
+        metrics = json.dumps({'frames_total' : random.randint(0, 10000)})
+        return self.session.post(self.url + '/ping', data=dict(device=random.choice(self.devices), metrics=metrics))
+
+    def commands(self) :
+        return self.session.get(self.url + '/rcp_get', params=dict(device=random.choice(self.devices), wait=0))
+
+
+def parse_mix(text) :
+    """ 'name=weight,...' to a list with each name weight times, for random.choice """
+    picks = []
+    for part in text.split(',') :
+        name, _, weight = part.partition('=')
+        if not hasattr(Client, name.strip()) :
+            raise ValueError("no endpoint {!r} in --mix".format(name))
+        picks.extend([name.strip()] * int(weight or 1))
+    return picks
+
+
+def start_local_server() :
+    """ the app on the stand-ins, served on a free port by a thread of this process; its base url """
+    import logging
+    import local_server
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)    # not a line per request
+    server = make_server('127.0.0.1', 0, local_server.make_app(), threaded=True)
+    thread = threading.Thread(target=server.serve_forever, name="local server")
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def run(url, concurrency, seconds, picks, devices, image) :
+    recorder = Recorder()
+    deadline = time.time() + seconds
+
+    def work() :
+        client = Client(url, devices, image)
+        while time.time() < deadline :
+            endpoint = random.choice(picks)
+            start = time.time()
+            try :
+                response = getattr(client, endpoint)()
+                ok = response.status_code < 300
+            except requests.RequestException :
+                ok = False
+            recorder.add(endpoint, time.time() - start, ok)
+
+    threads = [threading.Thread(target=work, name="load {}".format(n)) for n in range(concurrency)]
+    start = time.time()
+    for t in threads :
+        t.start()
+    for t in threads :
+        t.join()
+    recorder.report(time.time() - start)
+    return recorder
+
+
+def main() :
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", help="app to drive, default: start one here on the in-memory stand-ins")
+    ap.add_argument("-c", "--concurrency", type=int, default=8, help="concurrent clients")
+    ap.add_argument("--seconds", type=float, default=20.0, help="how long to keep them going")
+    ap.add_argument("--mix", default=DEFAULT_MIX, help="endpoint=weight,... request proportions")
+    ap.add_argument("--devices", type=int, default=10, help="distinct cameras uploading and pinging")
+    ap.add_argument("--image", help="JPEG to upload (a deployed app's images service needs a real one)")
+    args = ap.parse_args()
+    url = args.url.rstrip('/') if args.url else start_local_server()
+    image = open(args.image, 'rb').read() if args.image else os.urandom(32 * 1024)
+    devices = ['load-test-{}'.format(n) for n in range(args.devices)]
+    print "driving {} with {} clients for {}s".format(url, args.concurrency, args.seconds)
+    run(url, args.concurrency, args.seconds, parse_mix(args.mix), devices, image)
+
+
+if __name__ == "__main__" :
+    main()
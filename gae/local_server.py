@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""`local_server` serves the web app on the in-memory stand-ins, no App Engine SDK needed"""
+
+# USAGE
+# python local_server.py [--port 8080] [--user <email>]
+#
+# Every request is signed in as --user (the first white listed address by default); /admin_login
+# still wants the admin password from private.py. Data lives in memory and goes when the server
+# stops. Images are served from the stand-in GCS at /_local/gcs/<bucket>/<name>.
+
+import argparse
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, 'lib'))      # Flask, as vendored for App Engine, if it is there
+
+import standins
+
+
+def make_app(user_email=None) :
+    """ install the stand-ins, import the app and add the routes the stand-ins need; main.app """
+    from private import white_list
+    standins.install(user_email or white_list[0])
+    import main
+    from flask import request, redirect, abort
+    import cloudstorage as gcs
+
+    def serve_object(name) :
+        try :
+            with gcs.open('/' + name) as f :
+                data = f.read()
+            stat = gcs.stat('/' + name)
+        except gcs.NotFoundError :
+            abort(404)
+        return main.app.response_class(data, mimetype=stat.content_type)
+
+    def sign_in() :
+        standins.users.sign_in(request.args.get('email') or white_list[0])
+        return redirect(request.args.get('continue_url') or '/')
+
+    def sign_out() :
+        standins.users.sign_in(None)
+        return redirect(request.args.get('continue_url') or '/')
+
+    main.app.add_url_rule(standins.images.SERVING_PREFIX + '/<path:name>', 'local_gcs', serve_object)
+    main.app.add_url_rule('/_local/login', 'local_login', sign_in)
+    main.app.add_url_rule('/_local/logout', 'local_logout', sign_out)
+    return main.app
+
+
+def main() :
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8080)
+    ap.add_argument("--user", help="Google account every request is signed in as")
+    args = ap.parse_args()
+    from werkzeug.serving import run_simple
+    run_simple(args.host, args.port, make_app(args.user), threaded=True, use_reloader=False)
+
+
+if __name__ == "__main__" :
+    main()
@@ -5,6 +5,12 @@ import os
 import json
 import cgi
 import urllib
+import threading
+import datetime
+import re
+import time
+import hashlib
+import uuid
 
 
 # Import the Flask Framework
@@ -17,15 +23,45 @@ from google.appengine.ext import ndb
 from google.appengine.api import app_identity
 from google.appengine.ext import blobstore    # not using blob storage, but are using blob API on GCS (well, that's the plan)
 from google.appengine.api import images
+from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 
 import cloudstorage as gcs  # pip installed into app directoy/lib, not a first class citizen quite yet
 
 # bring in application support pieces
-from device import Device, unit_test_devices
+from device import Device, To_Do_Command, unit_test_devices, reparent_commands
+from metrics import REGISTRY, Metrics
+from listing_cache import INCIDENT_LISTINGS, DEVICE_LISTINGS
+from heartbeat import HEARTBEATS
+from derivatives import enqueue_derivatives, derivative_name, SIZES
+import background
+import bulk_delete
+import rollups
+import retention
 
 # GCS bucket suffix, after app name
 APP_DOMAIN = '.appspot.com'             # GAE convention
 MAX_CONTENT_LENGTH = 8 * 1024 * 1024    # 8 MB max per file uploaded (try to stay in the 'free' billing zone)
+MAX_BATCH_THREADS = 4                   # concurrent GCS writes per /upload_batch request
+DEDUP_MAX_DISTANCE = 6                  # uploads whose dhash is this many bits (of 64) or fewer from ...
+DEDUP_WINDOW_SECONDS = 300              # ... an incident this recent, from any camera, are merged into it
+DEDUP_RECENT_LIMIT = 50                 # most recent incidents compared against
+PAGE_SIZE = 20                          # incidents per /show page
+API_MAX_LIMIT = 500                     # most incidents one /api/incidents response holds
+COMMAND_LEASE_BATCH = 10                # most commands leased per /ping or /rcp_get (one transaction)
+COMMAND_LEASE_SECONDS = 60              # a leased, unacknowledged command is delivered again after this
+COMMAND_MAX_WAIT_SECONDS = 25           # longest /rcp_get long poll, well inside the request deadline
+COMMAND_POLL_SECONDS = 0.5              # a long poll checks its memcache signal this often ...
+COMMAND_REQUERY_SECONDS = 5             # ... and tries a lease anyway this often, for expired leases
+HEARTBEAT_FLUSH_SECONDS = 60            # per device, at most one last_ping_time write in this many seconds
+DEVICE_METRICS_SECONDS = 24 * 3600      # /metrics shows the last summary a pi sent on its ping this long
+MIGRATION_BATCH_SIZE = 100              # incidents re-parented per task by /migrate_shards
+UPLOAD_CHUNK_SIZE = 256 * 1024          # bytes per read when streaming a body into GCS (GCS's write block size)
+CONTENT_PREFIX = 'sha256/'              # objects named by their content hash, see content_name()
+IMMUTABLE_CACHE_SECONDS = 365 * 24 * 3600   # browser and proxy lifetime of a content addressed object
+TIMELINE_BUCKETS = {'day' : 30, 'hour' : 48}  # /timeline default span, in buckets of each period
+TIMELINE_MAX_BUCKETS = 24 * 31             # longest span one /timeline response covers
 
 # local imports
 from private import flask_secret, white_list, admin_name, admin_password # private constants => .gitignore
@@ -35,7 +71,11 @@ from private import flask_secret, white_list, admin_name, admin_password # priva
 # used to form a root <kind, id> pair.
 ROOT_INCIDENT_KIND="Incident_Log"  # the base "model"/"kind" (pseudo) for everything
 ROOT_INCIDENT_ID="My Yard Cam"     # default. Other users or diffferent cameras can create entity groups based on different IDs.
+SHARD_BUCKET_FORMAT = '%Y-%m-%d'   # incidents are grouped per camera per day
 
+# The single "My Yard Cam" log put every upload from every camera in one entity group, about one write
+# a second between them. Incidents now live in one group per camera per day (incident_shard_key), and
+# the listing queries span the groups; the old log only remains as the source for /migrate_shards.
 def incident_log_key(incident_id = None):
     """Constructs a Datastore key to be used as the ancestor for entries in an Incident Log """
     key_id = incident_id if incident_id is not None else ROOT_INCIDENT_ID
@@ -43,20 +83,120 @@ def incident_log_key(incident_id = None):
     ##print "incident root key <", root_key.kind(), root_key.id(), ">"
     return ndb.Key(ROOT_INCIDENT_KIND, key_id)
 
+def incident_shard_key(camera = None, when = None):
+    """ the ancestor for a camera's incidents in the time bucket holding when (default now) """
+    when = when or datetime.datetime.now()
+    return ndb.Key(ROOT_INCIDENT_KIND, '{}|{}'.format(camera or ROOT_INCIDENT_ID, when.strftime(SHARD_BUCKET_FORMAT)))
+
+def camera_name(value) :
+    """ the camera named by an upload, ROOT_INCIDENT_ID when it does not say """
+    value = (value or '').strip()[:100]
+    return value or ROOT_INCIDENT_ID
+
 class Incident(ndb.Model) :
     """An incident is timestamped at the server and points to an image (eventually)"""
     upload_time = ndb.DateTimeProperty(auto_now_add=True)
+    capture_time = ndb.DateTimeProperty(indexed=False)  # UTC, when the pi took it, if it said; later for a spooled upload
+    camera = ndb.StringProperty()                       # also part of the ancestor, see incident_shard_key()
     reason = ndb.StringProperty(indexed=False)
-    image_name = ndb.StringProperty(indexed=False)
+    image_name = ndb.StringProperty(indexed=False)     # as uploaded, for display
+    object_name = ndb.StringProperty()                 # in the bucket, content_name(); for older entries None, or
+                                                        # the file name once retention.index_batch() re-put them
+                                                        # (indexed, retention asks who else shares one)
     gcs_blob_image_key = ndb.BlobProperty()
+    content_type = ndb.StringProperty(indexed=False)    # None for older (image) entries; clips are video/*
+    dhash = ndb.StringProperty(indexed=False)           # perceptual hash from the pi, 16 hex digits
+    duplicate_count = ndb.IntegerProperty(indexed=False, default=0)  # near duplicate uploads merged into this one
+    serving_url = ndb.StringProperty(indexed=False)     # images service URL, fetched once at upload; None for clips
+    thumb_url = ndb.StringProperty(indexed=False)       # derivatives, set by a background task some time after upload
+    medium_url = ndb.StringProperty(indexed=False)
+    archive_name = ndb.StringProperty(indexed=False)    # once archived by retention.py the image lives here ...
+    archive_offset = ndb.IntegerProperty(indexed=False) # ... at this offset, for this many bytes, the original
+    archive_length = ndb.IntegerProperty(indexed=False) # and its derivatives gone
+
+    def is_clip(self) :
+        return (self.content_type or '').startswith('video/')
+
+    def event_time(self) :
+        """ when it happened: the capture time the pi sent, else the upload time """
+        return self.capture_time or self.upload_time
+
+    def stored_name(self) :
+        """ the object's name in the bucket: by content hash, or for older entries the uploaded file name """
+        return self.object_name or self.image_name
+
+    # these span every shard, the datastore merging them in upload_time order; being non-ancestor
+    # queries they are eventually consistent, an upload can take a moment to show up
 
     @classmethod
-    def logged_entries(cls, ancestor_key):
-        return cls.query(ancestor=ancestor_key).order(-cls.upload_time)
+    def logged_entries(cls, camera = None):
+        return cls.for_camera(camera).order(-cls.upload_time)
 
     @classmethod
-    def clear_log(cls, ancestor_key):
-        ndb.delete_multi(cls.query(ancestor=ancestor_key).fetch(keys_only=True))
+    def logged_entries_oldest_first(cls, camera = None):
+        """ logged_entries() backwards, for paging towards newer entries """
+        return cls.for_camera(camera).order(cls.upload_time)
+
+    @classmethod
+    def logged_since(cls, since, camera = None):
+        return cls.for_camera(camera).filter(cls.upload_time >= since).order(-cls.upload_time)
+
+    @classmethod
+    def for_camera(cls, camera = None):
+        return cls.query() if camera is None else cls.query(cls.camera == camera)
+
+    @classmethod
+    def clear_log(cls, background=False):
+        """ delete every incident and its GCS objects, and their rollups, inline or as background
+            DeleteJobs (the incidents' job key returned) """
+        if background :
+            bulk_delete.start_delete_job(rollups.IncidentRollup._get_kind())
+            return bulk_delete.start_delete_job(cls._get_kind())
+        bulk_delete.delete_now(rollups.IncidentRollup._get_kind())
+        bulk_delete.delete_now(cls._get_kind())
+
+    def object_names(self) :
+        """ the GCS objects behind this incident: the original, and the derivatives of an image
+            (content addressed objects may be shared, so only for clearing incidents wholesale) """
+        if self.archive_name :
+            archive = gcs_object_name(self.archive_name)
+            return [archive, retention.archive_index_name(archive)]
+        original = gcs_object_name(self.stored_name())
+        if self.is_clip() :
+            return [original]
+        return [original] + [derivative_name(original, size_name) for size_name, _ in SIZES]
+
+def incidents_sharing_objects(incidents) :
+    """ keys of those incidents whose object is still used by another incident """
+    names = set(incident.stored_name() for incident in incidents)
+    shared = still_referenced_async(names, [incident.key for incident in incidents]).get_result()
+    return set(incident.key for incident in incidents if incident.stored_name() in shared)
+
+bulk_delete.register(Incident._get_kind(), object_names=Incident.object_names, listing=INCIDENT_LISTINGS,
+                     shared=incidents_sharing_objects)
+
+# A resumable upload: the body arrives as one or more raw PUTs, each streamed into its own GCS part
+# object. A PUT that dies half way never closes its part, so nothing of it is kept and the pi resends
+# from the last acknowledged offset. The final PUT composes the parts into the real object.
+class UploadSession(ndb.Model) :
+    """An upload in progress, parts received so far"""
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    image_name = ndb.StringProperty(indexed=False)
+    content_type = ndb.StringProperty(indexed=False)
+    reason = ndb.StringProperty(indexed=False)
+    dhash = ndb.StringProperty(indexed=False)
+    camera = ndb.StringProperty(indexed=False)
+    capture_time = ndb.DateTimeProperty(indexed=False)
+    total_size = ndb.IntegerProperty(indexed=False)     # declared by the sender, None if unknown
+    received = ndb.IntegerProperty(indexed=False, default=0)
+    parts = ndb.IntegerProperty(indexed=False, default=0)
+
+    def part_name(self, index) :
+        return gcs_object_name('uploads/{}.part{}'.format(self.key.id(), index))
+
+    def assembled_name(self) :
+        """ where the whole upload is put together, before it is named by its hash """
+        return gcs_object_name('uploads/{}'.format(self.key.id()))
 
 
 # helper functions
@@ -69,10 +209,255 @@ def verified_user(users) :
                     "OK" if user and user.email() in app.config['WHITE_LIST'] else "Not verified"))
     return user and user.email() in app.config['WHITE_LIST']
 
+def gcs_object_name(filename) :
+    """ /bucket/filename for an uploaded image or clip """
+    # The string value on localhost is 'None', not None 
+    bucket_root = app_identity.get_application_id() if app_identity.get_application_id() != "None" else "local"
+    return "/{}{}/{}".format(bucket_root, app.config['APP_DOMAIN'], filename)
+
+def content_name(digest, filename) :
+    """ the object name for content with this sha256 hex digest: the same bytes, the same object
+        the uploaded file's extension is kept, for whoever lists the bucket """
+    extension = re.sub(r'[^.a-z0-9]', '', os.path.splitext(filename or '')[1].lower())[:10]
+    return '{}{}{}'.format(CONTENT_PREFIX, digest, extension)
+
+@ndb.tasklet
+def still_referenced_async(names, excluded_keys) :
+    """ the names among names (object_name, content addressed or an older file name) that an incident
+        outside excluded_keys, and not archived, points at; such an object is not to be deleted """
+    excluded = set(excluded_keys)
+    names = list(names)
+    with REGISTRY.timer('gae_call_seconds', call='datastore_query') :
+        holders = yield [Incident.query(Incident.object_name == name).fetch_async(len(excluded) + 1)
+                         for name in names]
+    raise ndb.Return(set(name for name, incidents in zip(names, holders)
+                         if any(incident.key not in excluded and not incident.archive_name for incident in incidents)))
+
+def valid_sha256(value) :
+    """ a sha256 hex digest as sent by the pi, or None """
+    return value.lower() if value and re.match(r'^[0-9a-fA-F]{64}$', value) else None
+
+def gcs_exists(gcs_filename) :
+    with REGISTRY.timer('gae_call_seconds', call='gcs_stat') :
+        try :
+            gcs.stat(gcs_filename)
+            return True
+        except gcs.NotFoundError :
+            return False
+
+def valid_dhash(value) :
+    """ a perceptual hash as sent by the pi, or None """
+    return value.lower() if value and re.match(r'^[0-9a-fA-F]{16}$', value) else None
+
+def parse_capture_time(value) :
+    """ an upload's capture time, as parse_api_time() reads it; None if missing or unreadable, it is only informative """
+    try :
+        return parse_api_time(value)
+    except ValueError :
+        return None
+
+def dedup_hash(image_hash, capture_time) :
+    """ image_hash, or None for an upload taken before the duplicate window (a pi's spooled backlog),
+        which is compared with nothing newer """
+    window = datetime.timedelta(seconds=app.config['DEDUP_WINDOW_SECONDS'])
+    if capture_time is not None and capture_time < datetime.datetime.utcnow() - window :
+        return None
+    return image_hash
+
+def hamming(a, b) :
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+# The upload and listing paths are ndb tasklets: each RPC is started as soon as its inputs are known and
+# only waited for where its result is needed, so independent RPCs (the blob key and the move of the object
+# to its content name, the serving url fan-out, batch puts) overlap instead of queueing one behind the other.
+# Timers around a yield measure the wait, not the RPC.
+
+@ndb.tasklet
+def recent_hashed_incidents_async() :
+    """ recent incidents with a perceptual hash, newest first; none taken long before their upload """
+    since = datetime.datetime.now() - datetime.timedelta(seconds=app.config['DEDUP_WINDOW_SECONDS'])
+    with REGISTRY.timer('gae_call_seconds', call='datastore_query') :
+        recent = yield Incident.logged_since(since).fetch_async(app.config['DEDUP_RECENT_LIMIT'])
+    raise ndb.Return([incident for incident in recent if dedup_hash(incident.dhash, incident.capture_time)])
+
+def find_near_duplicate(image_hash, candidates) :
+    """ the first candidate incident within DEDUP_MAX_DISTANCE bits of image_hash, or None """
+    if image_hash :
+        for incident in candidates :
+            if hamming(image_hash, incident.dhash) <= app.config['DEDUP_MAX_DISTANCE'] :
+                return incident
+    return None
+
+def serving_url(incident, external=False) :
+    # the images service only serves images, event clips are served from GCS by serve_clip()
+    if incident.is_clip() :
+        return url_for('serve_clip', filename=incident.stored_name(), _external=external)
+    if incident.archive_name :
+        return url_for('serve_archived', incident_key=incident.key.urlsafe(), _external=external)
+    if incident.serving_url :
+        return incident.serving_url
+    with REGISTRY.timer('gae_call_seconds', call='images_serving_url') :
+        return images.get_serving_url(incident.gcs_blob_image_key)
+
+@ndb.tasklet
+def fill_serving_urls_async(incidents) :
+    """ set serving_url on image incidents that lack one, the RPCs in parallel; returns those changed (not put) """
+    missing = [incident for incident in incidents
+               if not incident.is_clip() and not incident.archive_name and not incident.serving_url]
+    with REGISTRY.timer('gae_call_seconds', call='images_serving_url') :
+        urls = yield [images.get_serving_url_async(incident.gcs_blob_image_key) for incident in missing]
+    for incident, url in zip(missing, urls) :
+        incident.serving_url = url
+    raise ndb.Return(missing)
+
+@ndb.tasklet
+def incident_page_async(cursor_text=None, backwards=False, page_size=PAGE_SIZE) :
+    """ (incidents newest first, cursor to the next (older) page, cursor to the previous (newer) page)
+        cursors are urlsafe strings, None when there is no such page; the previous page is fetched backwards """
+    cursor = Cursor(urlsafe=cursor_text) if cursor_text else None
+    with REGISTRY.timer('gae_call_seconds', call='datastore_query') :
+        if backwards and cursor :
+            incidents, end, more = yield Incident.logged_entries_oldest_first().fetch_page_async(
+                page_size, start_cursor=cursor.reversed())
+            incidents.reverse()
+            raise ndb.Return((incidents, cursor.urlsafe(), end.reversed().urlsafe() if more and end else None))
+        incidents, end, more = yield Incident.logged_entries().fetch_page_async(page_size, start_cursor=cursor)
+    raise ndb.Return((incidents, end.urlsafe() if more and end else None, cursor.urlsafe() if cursor else None))
+
+def stream_to_gcs(stream, gcs_filename, content_type, limit, digest=None) :
+    """ copy stream into a new GCS object UPLOAD_CHUNK_SIZE bytes at a time, returns the size
+        past limit bytes it aborts with a 413; the object is only closed, so only created, on success
+        digest, a hashlib object, is updated with the bytes on the way """
+    size = 0
+    with REGISTRY.timer('gae_call_seconds', call='gcs_write') :
+        f = gcs.open(gcs_filename, 'w', content_type=content_type)
+        while True :
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk :
+                break
+            size += len(chunk)
+            if size > limit :
+                logging.warning("stream_to_gcs() {} rejected past {} bytes".format(gcs_filename, limit))
+                abort(413)
+            f.write(chunk)
+            if digest is not None :
+                digest.update(chunk)
+        f.close()
+    return size
+
+def hash_gcs(gcs_filename) :
+    """ sha256 hex digest of an object, read back UPLOAD_CHUNK_SIZE bytes at a time """
+    digest = hashlib.sha256()
+    with REGISTRY.timer('gae_call_seconds', call='gcs_read') :
+        with gcs.open(gcs_filename) as f :
+            while True :
+                chunk = f.read(UPLOAD_CHUNK_SIZE)
+                if not chunk :
+                    break
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def promote_to_content_name(gcs_filename, digest, filename) :
+    """ move an assembled upload to its content addressed name, or drop it if that object exists; the name """
+    name = content_name(digest, filename)
+    if gcs_exists(gcs_object_name(name)) :
+        REGISTRY.inc('gcs_content_writes_total', result='existing')
+    else :
+        with REGISTRY.timer('gae_call_seconds', call='gcs_copy') :
+            gcs.copy2(gcs_filename, gcs_object_name(name))
+        REGISTRY.inc('gcs_content_writes_total', result='written')
+    gcs.delete(gcs_filename)
+    return name
+
+def stream_upload_to_gcs(image, content_type) :
+    """ stream an uploaded (werkzeug FileStorage) file into a temporary GCS object, hashing it on the way;
+        (that object, its sha256 hex digest), 413 past MAX_CONTENT_LENGTH
+        only UPLOAD_CHUNK_SIZE bytes of it are in memory at a time, however large the file or the batch """
+    digest = hashlib.sha256()
+    temporary = gcs_object_name('uploads/form-{}'.format(uuid.uuid4().hex))
+    stream_to_gcs(image.stream, temporary, content_type, app.config['MAX_CONTENT_LENGTH'], digest)
+    return temporary, digest.hexdigest()
+
+def save_upload_to_gcs(image, content_type) :
+    """ stream_upload_to_gcs(), then move the object to its content addressed name, which is returned """
+    temporary, digest = stream_upload_to_gcs(image, content_type)
+    return promote_to_content_name(temporary, digest, image.filename)
+
+@ndb.tasklet
+def merge_near_duplicate_async(image_hash, image_name) :
+    """ if image_hash is close to a recent incident, count the upload against that incident and return it """
+    if not image_hash :
+        raise ndb.Return(None)
+    duplicate = find_near_duplicate(image_hash, (yield recent_hashed_incidents_async()))
+    if duplicate is not None :
+        duplicate.duplicate_count = (duplicate.duplicate_count or 0) + 1
+        with REGISTRY.timer('gae_call_seconds', call='datastore_put') :
+            yield duplicate.put_async()
+        INCIDENT_LISTINGS.bump()    # its duplicate_count is in the listings
+        REGISTRY.inc('upload_duplicates_total')
+        logging.info("{} merged as near duplicate of {}".format(image_name, duplicate.image_name))
+    raise ndb.Return(duplicate)
+
+def create_gs_key_async(gcs_filename) :
+    """ start the blob key RPC for a GCS object; it only encodes the name, so it can run before the object is there """
+    return blobstore.create_gs_key_async('/gs' + gcs_filename)
+
+@ndb.tasklet
+def store_incident_async(image_name, object_name, content_type, reason, image_hash=None, camera=None,
+                         blob_key_rpc=None, capture_time=None) :
+    """ log an Incident for an object already in GCS, returns it; blob_key_rpc, from create_gs_key_async(), if started """
+    gcs_filename = gcs_object_name(object_name)
+    with REGISTRY.timer('gae_call_seconds', call='blobstore_create_gs_key') :
+        blob_api_key = yield blob_key_rpc or create_gs_key_async(gcs_filename)
+    logging.info("store_incident() blob_api_key: {}".format(blob_api_key))
+
+    camera = camera_name(camera)
+    incident = Incident(parent = incident_shard_key(camera),
+                        camera = camera,
+                        reason = reason,
+                        image_name = image_name,
+                        object_name = object_name,
+                        gcs_blob_image_key = blob_api_key,
+                        content_type = content_type,
+                        dhash = image_hash,
+                        capture_time = capture_time)
+    yield fill_serving_urls_async([incident])
+    put = incident.put_async()
+    generations = rollups.counted_generations_async()     # needs no incident, so it is read during the put
+    with REGISTRY.timer('gae_call_seconds', call='datastore_put') :
+        i_key = yield put
+    yield rollups.count_incidents_async([incident], generations)
+    INCIDENT_LISTINGS.bump()
+    REGISTRY.inc('uploads_total')
+    logging.info("store_incident() added key. kind: {}, id: {}".format(i_key.kind(), i_key.id()))
+    enqueue_derivatives(incident, gcs_filename)
+    raise ndb.Return(incident)
+
+def parallel_map(function, items, max_threads) :
+    """ [function(item) ...] on up to max_threads request threads, for blocking calls like GCS writes """
+    results = [None] * len(items)
+    errors = []
+    def work(indexes) :
+        for i in indexes :
+            try :
+                results[i] = function(items[i])
+            except Exception as error :
+                errors.append(error)
+    threads = [threading.Thread(target=work, args=(range(n, len(items), max_threads),))
+               for n in range(min(max_threads, len(items)))]
+    for t in threads :
+        t.start()
+    for t in threads :
+        t.join()
+    if errors :
+        raise errors[0]
+    return results
+
 
 # the  main.app enty (<this file>.<this symbol>) in app.yaml gets real work started right about here 
 app = Flask(__name__)
 app.config.from_object(__name__)            # pulls in UPPER_CASE constants
+HEARTBEATS.flush_seconds = app.config['HEARTBEAT_FLUSH_SECONDS']
 app.config['SECRET_KEY'] = flask_secret     # Flask's semi secret_key
 app.config['WHITE_LIST'] = white_list       # simple list of allowed email accounts (gmail authentication), shpuld move to datasotre
 app.config['ADMIN_NAME'] = admin_name       # admin name within this app, not overall GAE admin
@@ -85,11 +470,40 @@ app.config['PASSWORD'] = admin_password     # and the admin password
 #
 # --> /upload --> /upload_images note: upload_images is not protected, called from pi,  TODO: fix this
 #
+# --> /upload_batch, many images in one request from a pi, same lack of protection
+#
+# --> /upload_session --> /upload_session/<id> (PUT parts, GET offset), resumable raw uploads, same again
+#
 # --> /init is direct URL access only, requires /admin_login() 
 #
+# --> /jobs lists the background bulk deletes /init starts, with their progress; /jobs/<id>/resume requeues one
+#
+# --> /migrate_shards, the same, moves incidents from the old single log into per camera, per day groups,
+#     and commands into their device's own queue
+#
+# --> /api/incidents?since=&until=&camera=&limit= JSON for dashboards, with ETag and conditional GET
+#
 # --> /info is for debugging
 #
-# --> /rcp --> /rcp_save (saves form input), /rcp_get (gets saved input from/to pi)
+# --> /rcp --> /rcp_save (queues form input as commands for the chosen devices)
+#     /rcp_get (a pi leases its commands, long polling), /rcp_ack (and acknowledges them), not protected
+#
+# --> /ping heartbeat from a pi, optionally with its metrics summary, answered with its pending commands;
+#     /metrics for a Prometheus scraper
+
+
+# every request is timed per endpoint; datastore, GCS and images calls are timed per call inside the handlers
+@app.before_request
+def start_request_timer() :
+    g.request_start = time.time()
+
+@app.after_request
+def record_request_metrics(response) :
+    endpoint = request.endpoint or 'none'
+    if hasattr(g, 'request_start') :
+        REGISTRY.observe('request_seconds', time.time() - g.request_start, endpoint=endpoint)
+    REGISTRY.inc('requests_total', endpoint=endpoint, status=response.status_code)
+    return response
 
 
 @app.route('/')
@@ -109,17 +523,154 @@ def hello():
         return redirect(url_for('show_entries'))
 
 @app.route('/show')
+@ndb.toplevel
 def show_entries():
     if not verified_user(users) :
         return redirect(url_for('hello'))
     
-    # "select all" ndb query from default Incident log
-    incidents = Incident.logged_entries(incident_log_key())
-    entries = [dict(title = incident.reason, 
+    entries, next_cursor, prev_cursor = show_page()
+    return render_template('show_entries.html', entries=entries, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+@app.route('/show.json')
+@ndb.toplevel
+def show_entries_json():
+    """ the same page of entries as /show, for scripts: {"entries": [...], "next": cursor, "prev": cursor} """
+    if not verified_user(users) :
+        abort(403)
+    entries, next_cursor, prev_cursor = show_page()
+    entries = [dict(entry, upload_time=entry['upload_time'].isoformat()) for entry in entries]   # cached, copy
+    return app.response_class(json.dumps(dict(entries=entries, next=next_cursor, prev=prev_cursor)),
+                              mimetype='application/json')
+
+def show_page() :
+    """ one page of the default Incident log, per the request's cursor and dir=prev arguments """
+    cursor_text = request.args.get('cursor')
+    backwards = request.args.get('dir') == 'prev'
+    return INCIDENT_LISTINGS.get('{}:{}'.format('prev' if backwards else 'next', cursor_text or ''),
+                                 lambda : fetch_show_page(cursor_text, backwards))
+
+def fetch_show_page(cursor_text, backwards) :
+    # one bounded query per page; the serving urls were stored at upload, older entries get theirs stored here, once
+    try :
+        incidents, next_cursor, prev_cursor = incident_page_async(cursor_text, backwards).get_result()
+    except (datastore_errors.BadValueError, datastore_errors.BadRequestError) :
+        abort(400)
+    legacy = fill_serving_urls_async(incidents).get_result()
+    if legacy :
+        ndb.put_multi_async(legacy)     # not waited for here, @ndb.toplevel sees it done before the request ends
+    entries = [dict(title = incident.reason,
                     image_name = incident.image_name,
-                    image_url = images.get_serving_url(incident.gcs_blob_image_key)) for incident in incidents]
-    # at some point we need to fetch_page() and paginate
-    return render_template('show_entries.html', entries=entries)
+                    upload_time = incident.upload_time,
+                    content_type = incident.content_type or 'image/jpeg',
+                    image_url = serving_url(incident),
+                    thumb_url = incident.thumb_url or serving_url(incident),
+                    medium_url = incident.medium_url or serving_url(incident)) for incident in incidents]
+    return entries, next_cursor, prev_cursor
+
+@app.route('/api/incidents')
+@ndb.toplevel
+def api_incidents() :
+    """ incidents in [since, until), newest first, as compact JSON: {"incidents": [...], "more": bool}
+        a poll that sends back the ETag gets a 304 while the response is unchanged (no Last-Modified:
+        thumbnails, duplicate counts and archiving change entries without changing any upload_time) """
+    if not verified_user(users) :
+        abort(403)
+    try :
+        since = parse_api_time(request.args.get('since'))
+        until = parse_api_time(request.args.get('until'))
+        limit = min(int(request.args.get('limit', PAGE_SIZE)), app.config['API_MAX_LIMIT'])
+    except ValueError :
+        abort(400)
+    if limit < 1 :
+        abort(400)
+    camera = request.args.get('camera') or None
+    # cached per listing generation, so an unchanged log costs a memcache get and no query
+    key = 'api:{}:{}:{}:{}'.format(since and since.isoformat(), until and until.isoformat(), camera, limit)
+    body = INCIDENT_LISTINGS.get(key, lambda : fetch_api_incidents(since, until, camera, limit))
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.sha1(body).hexdigest())     # strong: same bytes, same tag
+    response.headers['Cache-Control'] = 'private, no-cache'     # always revalidate, a 304 is cheap
+    return response.make_conditional(request)
+
+@app.route('/timeline')
+def timeline() :
+    """ incidents per day (or ?period=hour) per camera, from the rollups alone, never the incidents """
+    if not verified_user(users) :
+        return redirect(url_for('hello'))
+    rows, cameras = timeline_rows()
+    busiest = max([row['total'] for row in rows] or [0])
+    return render_template('timeline.html', rows=rows, cameras=cameras, busiest=busiest,
+                           period=request.args.get('period', 'day'), camera=request.args.get('camera'))
+
+@app.route('/timeline.json')
+def timeline_json() :
+    """ the same as /timeline for scripts: {"period": .., "buckets": [{"start", "total", "cameras"}], "cameras": [..]} """
+    if not verified_user(users) :
+        abort(403)
+    rows, cameras = timeline_rows()
+    rows = [dict(row, start=row['start'].isoformat()) for row in rows]   # cached, copy
+    return app.response_class(json.dumps(dict(period=request.args.get('period', 'day'), buckets=rows, cameras=cameras)),
+                              mimetype='application/json')
+
+def timeline_rows() :
+    """ per the request's period, buckets (count, default TIMELINE_BUCKETS) and camera arguments, oldest first """
+    period = request.args.get('period', 'day')
+    if period not in rollups.PERIODS :
+        abort(400)
+    try :
+        buckets = int(request.args.get('buckets', app.config['TIMELINE_BUCKETS'][period]))
+    except ValueError :
+        abort(400)
+    if not 1 <= buckets <= app.config['TIMELINE_MAX_BUCKETS'] :
+        abort(400)
+    camera = request.args.get('camera') or None
+    until = rollups.bucket_start(period, datetime.datetime.now()) + rollups.PERIODS[period]
+    since = until - buckets * rollups.PERIODS[period]
+    # rollups change with the incident log, so they are cached alongside its listings
+    key = 'timeline:{}:{}:{}:{}'.format(period, since.isoformat(), until.isoformat(), camera)
+    return INCIDENT_LISTINGS.get(key, lambda : fetch_timeline(period, since, until, camera))
+
+def fetch_timeline(period, since, until, camera) :
+    counts = rollups.timeline(period, since, until, camera)
+    cameras = sorted(set(name for _, per_camera in counts for name in per_camera))
+    rows = [dict(start=start, total=sum(per_camera.values()), cameras=dict(per_camera)) for start, per_camera in counts]
+    return rows, cameras
+
+def parse_api_time(value) :
+    """ an ISO 8601 UTC time (seconds, optionally fraction) or seconds since the epoch, None if not given """
+    if not value :
+        return None
+    if re.match(r'^\d+(\.\d+)?$', value) :
+        return datetime.datetime.utcfromtimestamp(float(value))
+    value = value.rstrip('Z')
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+
+def fetch_api_incidents(since, until, camera, limit) :
+    """ the JSON body for /api/incidents """
+    query = Incident.for_camera(camera)
+    if since :
+        query = query.filter(Incident.upload_time >= since)
+    if until :
+        query = query.filter(Incident.upload_time < until)
+    with REGISTRY.timer('gae_call_seconds', call='datastore_query') :
+        incidents = query.order(-Incident.upload_time).fetch(limit + 1)
+    more = len(incidents) > limit
+    incidents = incidents[:limit]
+    legacy = fill_serving_urls_async(incidents).get_result()
+    if legacy :
+        ndb.put_multi_async(legacy)
+    entries = [dict(id = incident.key.urlsafe(),
+                    camera = incident.camera,
+                    time = incident.upload_time.isoformat(),
+                    captured = incident.capture_time and incident.capture_time.isoformat(),
+                    reason = incident.reason,
+                    type = incident.content_type or 'image/jpeg',
+                    url = serving_url(incident, external=True),
+                    thumb = incident.thumb_url,
+                    medium = incident.medium_url,
+                    duplicates = incident.duplicate_count or 0) for incident in incidents]
+    body = json.dumps(dict(incidents=entries, more=more), separators=(',', ':'))
+    return body
 
 @app.route('/upload')
 def upload_image_prompt() :
@@ -142,30 +693,31 @@ def upload_image() :
         # desire to store the image in GCS, but using the blob API (not blobstore) so that we can send it back easily
         logging.info("upload _image() source image.filename: {}".format(image.filename))
 
-        # The string value on localhost is 'None', not None 
-        bucket_root = app_identity.get_application_id() if app_identity.get_application_id() != "None" else "local"
-        gcs_filename = "/{}{}/{}".format(bucket_root, app.config['APP_DOMAIN'], image.filename)
-        logging.info("upload_image() destination gcs_filename: {}".format(gcs_filename))
-        with gcs.open(gcs_filename, 'w') as f:
-            image.save(f)
+        # a near duplicate of a recent incident (from any camera) is merged into it, nothing is written
+        image_hash = valid_dhash(request.form.get('dhash'))
+        capture_time = parse_capture_time(request.form.get('captured'))
+        duplicate = merge_near_duplicate_async(dedup_hash(image_hash, capture_time), image.filename).get_result()
+        if duplicate is not None :
+            if 'api' in request.form :
+                return serving_url(duplicate, external=True)
+            flash("Near duplicate of {}, not stored".format(duplicate.image_name))
+            return redirect(url_for('show_entries'))
+
+        # named by content, so two pis' same named frames never collide and a retried upload is stored once
+        content_type = image.mimetype or 'image/jpeg'
+        temporary, digest = stream_upload_to_gcs(image, content_type)
+        # the blob key only encodes the name, so its RPC runs while the object is moved there
+        blob_key_rpc = create_gs_key_async(gcs_object_name(content_name(digest, image.filename)))
+        object_name = promote_to_content_name(temporary, digest, image.filename)
+        logging.info("upload_image() destination object: {}".format(object_name))
 
         reason = request.form['reason'] if 'reason' in request.form else "manually uploaded image"
         logging.info("upload_image() reason: {}".format(reason))
-        
-        blob_api_filename = '/gs' + gcs_filename 
-        logging.info("upload_image() blob_api filename: {}".format(blob_api_filename))
-        
-        blob_api_key = blobstore.create_gs_key(blob_api_filename)
-        logging.info("upload_image() blob_api_key: {}".format(blob_api_key))
-                                                                 
-        incident = Incident(parent = incident_log_key(),
-                            reason = reason,
-                            image_name = image.filename,
-                            gcs_blob_image_key = blob_api_key)
-        i_key = incident.put()
-        logging.info("upload_image() added key. kind: {}, id: {}".format(i_key.kind(), i_key.id()))
 
-        url = images.get_serving_url(blob_api_key)
+        incident = store_incident_async(image.filename, object_name, content_type, reason, image_hash,
+                                        request.form.get('camera'), blob_key_rpc=blob_key_rpc,
+                                        capture_time=capture_time).get_result()
+        url = serving_url(incident, external=True)
         if 'api' in request.form : 
             return url # to api requestor
         else :
@@ -173,6 +725,227 @@ def upload_image() :
 
 
 
+@app.route('/upload_batch', methods=['POST'])
+def upload_batch() :
+    """ many images from a pi in one request; returns a JSON list of serving urls in upload order """
+    ## TODO - same lack of security as upload_image
+    uploads = [image for image in request.files.getlist('img') if image]
+    if not uploads :
+        return json.dumps([])
+    reason = request.form['reason'] if 'reason' in request.form else "uploaded image batch"
+    logging.info("upload_batch() {} images, reason: {}".format(len(uploads), reason))
+
+    # one dhash per image, in order; near duplicates of recent incidents, or of an
+    # earlier image in this batch, are merged into that incident and not written
+    hashes = [valid_dhash(h) for h in request.form.getlist('dhash')]
+    if len(hashes) != len(uploads) :
+        hashes = [None] * len(uploads)
+    # likewise one capture time each, for a pi sending its spooled backlog
+    capture_times = [parse_capture_time(t) for t in request.form.getlist('captured')]
+    if len(capture_times) != len(uploads) :
+        capture_times = [None] * len(uploads)
+    candidates = recent_hashed_incidents_async().get_result() if any(hashes) else []
+    camera = camera_name(request.form.get('camera'))
+    incidents = []      # per upload, the new incident or the one it was merged into
+    new = []            # (upload index, image, incident) still to be written
+    for i, (image, image_hash) in enumerate(zip(uploads, hashes)) :
+        duplicate = find_near_duplicate(dedup_hash(image_hash, capture_times[i]), candidates)
+        if duplicate is not None :
+            duplicate.duplicate_count = (duplicate.duplicate_count or 0) + 1
+            incidents.append(duplicate)
+            continue
+        incident = Incident(parent = incident_shard_key(camera),
+                            camera = camera,
+                            reason = reason,
+                            image_name = image.filename,
+                            content_type = image.mimetype or 'image/jpeg',
+                            dhash = image_hash,
+                            capture_time = capture_times[i])
+        if dedup_hash(image_hash, capture_times[i]) :
+            candidates.insert(0, incident)
+        incidents.append(incident)
+        new.append((i, image, incident))
+    logging.info("upload_batch() {} near duplicates merged".format(len(uploads) - len(new)))
+    REGISTRY.inc('upload_duplicates_total', len(uploads) - len(new))
+    REGISTRY.inc('uploads_total', len(new))
+
+    # GCS writes block, so overlap them on a few threads; each upload is streamed, never read whole
+    object_names = parallel_map(lambda (_, image, incident) : save_upload_to_gcs(image, incident.content_type),
+                                new, MAX_BATCH_THREADS)
+    gcs_filenames = [gcs_object_name(name) for name in object_names]
+    key_rpcs = [create_gs_key_async(name) for name in gcs_filenames]
+    with REGISTRY.timer('gae_call_seconds', call='blobstore_create_gs_key') :
+        for (_, _, incident), name, rpc in zip(new, object_names, key_rpcs) :
+            incident.object_name = name
+            incident.gcs_blob_image_key = rpc.get_result()
+
+    changed = []
+    for incident in incidents :
+        if not any(incident is other for other in changed) :
+            changed.append(incident)
+    fill_serving_urls_async(changed).get_result()
+    with REGISTRY.timer('gae_call_seconds', call='datastore_put') :
+        ndb.put_multi(changed)
+    if new :
+        rollups.count_incidents_async([incident for (_, _, incident) in new]).get_result()
+    if changed :
+        INCIDENT_LISTINGS.bump()    # new incidents, or merged duplicates' counts
+    for (_, _, incident), gcs_filename in zip(new, gcs_filenames) :
+        enqueue_derivatives(incident, gcs_filename)
+
+    return json.dumps([serving_url(incident, external=True) for incident in incidents])
+
+
+@app.route('/upload_session', methods=['POST'])
+def start_upload_session() :
+    """ begin a resumable upload: filename, content_type, size, reason, dhash, sha256, captured
+        returns JSON {"session": id, "offset": 0}, or {"url": ...} for a near duplicate or content the
+        bucket already holds (nothing to send) """
+    ## TODO - same lack of security as upload_image
+    filename = request.form.get('filename')
+    if not filename :
+        abort(400)
+    size = request.form.get('size', type=int)
+    if size is not None and size > app.config['MAX_CONTENT_LENGTH'] :
+        abort(413)      # before a single byte of the body is sent
+    image_hash = valid_dhash(request.form.get('dhash'))
+    capture_time = parse_capture_time(request.form.get('captured'))
+    duplicate = merge_near_duplicate_async(dedup_hash(image_hash, capture_time), filename).get_result()
+    if duplicate is not None :
+        return json.dumps(dict(url=serving_url(duplicate, external=True)))
+    content_type = request.form.get('content_type') or 'application/octet-stream'
+    digest = valid_sha256(request.form.get('sha256'))
+    if digest and gcs_exists(gcs_object_name(content_name(digest, filename))) :
+        incident = store_incident_async(filename, content_name(digest, filename), content_type,
+                                        request.form.get('reason') or "resumable upload", image_hash,
+                                        request.form.get('camera'), capture_time=capture_time).get_result()
+        return json.dumps(dict(url=serving_url(incident, external=True)))
+    upload = UploadSession(image_name = filename,
+                           content_type = content_type,
+                           reason = request.form.get('reason') or "resumable upload",
+                           dhash = image_hash,
+                           camera = request.form.get('camera'),
+                           capture_time = capture_time,
+                           total_size = size)
+    upload.put()
+    return json.dumps(dict(session=upload.key.id(), offset=0))
+
+@app.route('/upload_session/<int:session_id>', methods=['GET', 'PUT'])
+def upload_session(session_id) :
+    """ GET: {"offset": bytes received}. PUT ?offset=n[&final=1], raw body: the next part, streamed straight to GCS
+        a PUT at the wrong offset gets a 409 with the right one; the final part returns {"url": ...} """
+    upload = UploadSession.get_by_id(session_id)
+    if upload is None :
+        abort(404)
+    if request.method == 'GET' :
+        return json.dumps(dict(offset=upload.received))
+
+    if request.args.get('offset', type=int) != upload.received :
+        return json.dumps(dict(offset=upload.received)), 409
+    limit = app.config['MAX_CONTENT_LENGTH'] - upload.received
+    if request.content_length is not None and request.content_length > limit :
+        abort(413)
+    final = bool(request.args.get('final', type=int))
+    gcs_filename = upload.assembled_name()
+    digest = None
+    if final and not upload.parts :
+        # the whole body in one PUT, hashed on its way into the object
+        digest = hashlib.sha256()
+        upload.received += stream_to_gcs(request.stream, gcs_filename, upload.content_type, limit, digest)
+    else :
+        upload.received += stream_to_gcs(request.stream, upload.part_name(upload.parts), upload.content_type, limit)
+        upload.parts += 1
+    if not final :
+        upload.put()
+        return json.dumps(dict(offset=upload.received))
+
+    if upload.parts :
+        # compose wants the parts by name within the bucket
+        bucket_prefix = gcs_filename[:gcs_filename.index('/', 1) + 1]
+        part_names = [upload.part_name(i) for i in range(upload.parts)]
+        with REGISTRY.timer('gae_call_seconds', call='gcs_compose') :
+            gcs.compose([name[len(bucket_prefix):] for name in part_names], gcs_filename,
+                        content_type=upload.content_type)
+            for name in part_names :
+                gcs.delete(name)
+    hex_digest = digest.hexdigest() if digest else hash_gcs(gcs_filename)
+    blob_key_rpc = create_gs_key_async(gcs_object_name(content_name(hex_digest, upload.image_name)))
+    object_name = promote_to_content_name(gcs_filename, hex_digest, upload.image_name)
+    incident = store_incident_async(upload.image_name, object_name, upload.content_type, upload.reason,
+                                    upload.dhash, upload.camera, blob_key_rpc=blob_key_rpc,
+                                    capture_time=upload.capture_time).get_result()
+    upload.key.delete()
+    return json.dumps(dict(url=serving_url(incident, external=True), offset=upload.received))
+
+
+@app.route('/clip/<path:filename>')
+@app.route('/object/<path:filename>')
+def serve_clip(filename) :
+    """ stream an event clip (or any stored object) back out of GCS
+        a content addressed object never changes: its hash is a strong ETag and it is cached for good """
+    if not verified_user(users) :
+        return redirect(url_for('hello'))
+    gcs_filename = gcs_object_name(filename)
+    try :
+        stat = gcs.stat(gcs_filename)
+    except gcs.NotFoundError :
+        abort(404)
+    immutable = filename.startswith(CONTENT_PREFIX)
+    if immutable :
+        etag = filename[len(CONTENT_PREFIX):]      # the hash, and which derivative
+        cache_control = 'public, max-age={}, immutable'.format(app.config['IMMUTABLE_CACHE_SECONDS'])
+    else :
+        etag = stat.etag        # an older object, named by file name, can be overwritten
+        cache_control = 'private, no-cache'
+    if request.if_none_match.contains(etag) :
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+        return response
+    def generate() :
+        with gcs.open(gcs_filename) as f :
+            while True :
+                chunk = f.read(256 * 1024)
+                if not chunk :
+                    break
+                yield chunk
+    response = app.response_class(generate(), mimetype=stat.content_type,
+                                  headers={'Content-Length' : str(stat.st_size), 'Cache-Control' : cache_control})
+    response.set_etag(etag)
+    return response
+
+@app.route('/archived/<incident_key>')
+def serve_archived(incident_key) :
+    """ an archived incident's image, one range read out of its archive object; never changes, so cached for good """
+    if not verified_user(users) :
+        return redirect(url_for('hello'))
+    try :
+        key = ndb.Key(urlsafe=incident_key)
+    except Exception :      # the datastore's decoding errors vary: any bad key is simply not there
+        abort(404)
+    if key.kind() != Incident._get_kind() :
+        abort(404)
+    incident = key.get()
+    if incident is None or not incident.archive_name :
+        abort(404)
+    etag = '{}:{}:{}'.format(incident.archive_name, incident.archive_offset, incident.archive_length)
+    cache_control = 'private, max-age={}, immutable'.format(app.config['IMMUTABLE_CACHE_SECONDS'])
+    if request.if_none_match.contains(etag) :
+        response = app.response_class(status=304)
+    else :
+        with REGISTRY.timer('gae_call_seconds', call='gcs_read') :
+            try :
+                with gcs.open(gcs_object_name(incident.archive_name)) as f :
+                    f.seek(incident.archive_offset)
+                    data = f.read(incident.archive_length)
+            except gcs.NotFoundError :
+                abort(404)
+        response = app.response_class(data, mimetype=incident.content_type or 'image/jpeg')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
 @app.route('/admin_login', methods=['GET', 'POST'])
 def admin_login():
     if not verified_user(users) :
@@ -207,10 +980,130 @@ def init() :
         flash("Must be logged in as administrator to re-initialize images.")
         return redirect(url_for('show_entries'))
     else :
-        Incident.clear_log(incident_log_key())
-        flash('Incident Log Cleared!')
+        job_key = Incident.clear_log(background=True)
+        flash('Clearing the incident log in the background, job {}'.format(job_key.id()))
+    return redirect(url_for('delete_jobs'))
+
+@app.route('/jobs')
+def delete_jobs() :
+    """ admin: recent bulk delete jobs and how far each has got """
+    if not verified_user(users) :
+        return redirect(url_for('hello'))
+    if not session.get('admin_logged_in') :
+        flash("Must be logged in as administrator to see background jobs.")
+        return redirect(url_for('show_entries'))
+    jobs = bulk_delete.DeleteJob.recent()
+    rebuilds = rollups.RollupJob.recent()
+    retentions = retention.RetentionJob.recent()
+    running = any(job.status != 'done' for job in jobs + retentions) or any(job.phase != 'done' for job in rebuilds)
+    return render_template('jobs.html', jobs=jobs, rebuilds=rebuilds, retentions=retentions, running=running)
+
+@app.route('/jobs/<int:job_id>/resume')
+def resume_delete_job(job_id) :
+    """ admin: requeue an unfinished job's next batch, for when its task was lost """
+    if not verified_user(users) :
+        return redirect(url_for('hello'))
+    if not session.get('admin_logged_in') :
+        flash("Must be logged in as administrator to resume background jobs.")
+        return redirect(url_for('show_entries'))
+    if bulk_delete.resume_delete_job(job_id) :
+        flash('Job {} resumed'.format(job_id))
+    else :
+        flash('Job {} is finished or gone'.format(job_id))
+    return redirect(url_for('delete_jobs'))
+
+@app.route('/rollups/rebuild')
+def rebuild_rollups() :
+    """ admin: recount every incident into the timeline rollups, in background batches """
+    if not verified_user(users) :
+        return redirect(url_for('hello'))
+    if not session.get('admin_logged_in') :
+        flash("Must be logged in as administrator to rebuild the timeline.")
+        return redirect(url_for('show_entries'))
+    job_key = rollups.start_rebuild()
+    flash('Rebuilding the timeline rollups in the background, job {}'.format(job_key.id()))
+    return redirect(url_for('delete_jobs'))
+
+@app.route('/rollups/<int:job_id>/resume')
+def resume_rollup_job(job_id) :
+    """ admin: requeue an unfinished rebuild's next batch """
+    if not verified_user(users) :
+        return redirect(url_for('hello'))
+    if not session.get('admin_logged_in') :
+        flash("Must be logged in as administrator to resume background jobs.")
+        return redirect(url_for('show_entries'))
+    if rollups.resume_rebuild(job_id) :
+        flash('Rebuild {} resumed'.format(job_id))
+    else :
+        flash('Rebuild {} is finished or gone'.format(job_id))
+    return redirect(url_for('delete_jobs'))
+
+@app.route('/retention')
+def run_retention() :
+    """ cron (see cron.yaml) or admin: archive images older than retention.RETENTION_DAYS in the background """
+    # App Engine drops an X-Appengine-Cron header sent from outside, so only its cron service sets it
+    if request.headers.get('X-Appengine-Cron') == 'true' :
+        job_key = retention.start_retention()
+        return 'retention job {}'.format(job_key.id() if job_key else 'already running')
+    if not verified_user(users) :
+        return redirect(url_for('hello'))
+    if not session.get('admin_logged_in') :
+        flash("Must be logged in as administrator to archive old images.")
+        return redirect(url_for('show_entries'))
+    job_key = retention.start_retention()
+    if job_key :
+        flash('Archiving old images in the background, job {}'.format(job_key.id()))
+    else :
+        flash('A retention job is still running')
+    return redirect(url_for('delete_jobs'))
+
+@app.route('/retention/<int:job_id>/resume')
+def resume_retention_job(job_id) :
+    """ admin: requeue an unfinished retention job's next batch """
+    if not verified_user(users) :
+        return redirect(url_for('hello'))
+    if not session.get('admin_logged_in') :
+        flash("Must be logged in as administrator to resume background jobs.")
+        return redirect(url_for('show_entries'))
+    if retention.resume_retention(job_id) :
+        flash('Retention job {} resumed'.format(job_id))
+    else :
+        flash('Retention job {} is finished or gone'.format(job_id))
+    return redirect(url_for('delete_jobs'))
+
+@app.route('/migrate_shards')
+def migrate_shards() :
+    """ admin: move incidents still in the old single log into camera/day shards, and commands into their
+        device's queue_key(), in background batches """
+    if not verified_user(users) :
+        return redirect(url_for('hello'))
+    if not session.get('admin_logged_in') :
+        flash("Must be logged in as administrator to migrate the incident log.")
+        return redirect(url_for('show_entries'))
+    background.tasks.defer(reparent_incidents, _queue=background.MAINTENANCE_QUEUE)
+    background.tasks.defer(reparent_commands, _queue=background.MAINTENANCE_QUEUE)
+    flash('Incident log and command queue migration started')
     return redirect(url_for('show_entries'))
 
+def reparent_incidents(batch_size = MIGRATION_BATCH_SIZE) :
+    """ task: copy a batch from the old log into shards, keeping each id, then delete the originals; repeats until empty """
+    # same id in the new parent, so a task retried after the put but before the delete just puts the same entities again
+    old = Incident.query(ancestor=incident_log_key()).fetch(batch_size)
+    if not old :
+        logging.info("reparent_incidents() done")
+        return
+    moved = []
+    for incident in old :
+        values = incident.to_dict()
+        values['camera'] = camera_name(incident.camera)
+        moved.append(Incident(parent = incident_shard_key(values['camera'], incident.upload_time),
+                              id = incident.key.id(), **values))
+    ndb.put_multi(moved)
+    ndb.delete_multi([incident.key for incident in old])
+    INCIDENT_LISTINGS.bump()
+    logging.info("reparent_incidents() moved {}".format(len(moved)))
+    background.tasks.defer(reparent_incidents, batch_size, _queue=background.MAINTENANCE_QUEUE)
+
 
 @app.route('/rcp')
 def rcp_input() :
@@ -221,7 +1114,7 @@ def rcp_input() :
         flash("Must be logged in as administrator to use remote commands")
         return redirect(url_for('show_entries'))
     else :
-        return render_template('rcp_input.html')
+        return render_template('rcp_input.html', devices=DEVICE_LISTINGS.get('all', device_listing))
 
 @app.route('/rcp_save', methods=['GET', 'POST'])
 def rcp_save() :
@@ -232,47 +1125,151 @@ def rcp_save() :
         flash("Must be logged in as administrator to use remote commands")
         return redirect(url_for('show_entries'))
     if request.method == 'POST':
-        session['rcp'] = {}
+        # one To_Do_Command per filled in field per device: command = field name, parameters = its value as json
+        target = request.form.get('device', 'all')
+        try :
+            device_keys = ([ndb.Key(urlsafe=device['key']) for device in DEVICE_LISTINGS.get('all', device_listing)]
+                           if target == 'all' else [ndb.Key(urlsafe=target)])
+        except Exception :
+            abort(400)
+        queued = 0
         for command in request.form :
-            session['rcp'][command] = request.form[command] # 'rcp' : { command1: parameter_value1, command2 : p_v2, ... }
-        session['rcp']['sent'] = 0 # retrieval counter
-        flash('Remote commands and values queued')
+            if command != 'device' and request.form[command] :
+                queued += len(To_Do_Command.enqueue(device_keys, command, json.dumps(request.form[command])))
+        flash('{} remote commands queued for {} devices'.format(queued, len(device_keys)))
         return redirect(url_for('show_entries'))
     else :
-        # could "fail" silently here by jump ingto show_entries, but better to call out the dead end.
-        return rcp_get()
+        # a plain link here (or a reload after the redirect) lands back on the form
+        return redirect(url_for('rcp_input'))
 
 
 @app.route('/rcp_get')
 def rcp_get():
-    """ no usr verification, return queued paramters """
-    if 'rcp' not in session or not isinstance(session['rcp'].get('sent'), int) :
-        return json.dumps({})
-    else :
-        session['rcp']['sent'] += 1
-        return json.dumps(session['rcp'])
+    """ no usr verification: lease the device's commands, waiting up to wait seconds for some to arrive """
+    device_id = (request.values.get('device') or '').strip()[:100]
+    try :
+        wait = min(float(request.args.get('wait', 0)), app.config['COMMAND_MAX_WAIT_SECONDS'])
+        max_commands = min(int(request.args.get('max', COMMAND_LEASE_BATCH)), app.config['COMMAND_LEASE_BATCH'])
+    except ValueError :
+        abort(400)
+    if not device_id :
+        abort(400)
+    commands = lease_commands(HEARTBEATS.device_key(device_id), max_commands, wait)
+    return app.response_class(json.dumps(dict(device=device_id,
+                                              commands=[command.to_dict_for_device() for command in commands])),
+                              mimetype='application/json')
+
+def lease_commands(device_key, max_commands, wait=0) :
+    """ lease the device's commands; if there are none, wait up to wait seconds for an enqueue to signal some
+        a device found with nothing to lease is not queried again, which every ping would otherwise do, until
+        an enqueue moves its signal on or COMMAND_LEASE_SECONDS pass (a leased command may be due again) """
+    deadline = time.time() + wait
+    signal_key = To_Do_Command.signal_key(device_key)
+    idle_key = To_Do_Command.idle_key(device_key)
+    while True :
+        cached = memcache.get_multi([signal_key, idle_key])
+        signal = cached.get(signal_key)
+        if signal is None :
+            memcache.add(signal_key, 0)     # never sent a command, or evicted: start a signal to compare with
+            signal = memcache.get(signal_key)
+        if signal is not None and cached.get(idle_key) == signal :
+            commands = []
+            REGISTRY.inc('command_leases_skipped_total')
+        else :
+            with REGISTRY.timer('gae_call_seconds', call='datastore_lease') :
+                commands = To_Do_Command.lease(device_key, max_commands, app.config['COMMAND_LEASE_SECONDS'])
+            if not commands and signal is not None :
+                memcache.set(idle_key, signal, time=app.config['COMMAND_LEASE_SECONDS'])
+        if commands or time.time() >= deadline :
+            return commands
+        requery = min(deadline, time.time() + app.config['COMMAND_REQUERY_SECONDS'])
+        while time.time() < requery and memcache.get(signal_key) == signal :
+            time.sleep(app.config['COMMAND_POLL_SECONDS'])
+
+@app.route('/rcp_ack', methods=['POST'])
+def rcp_ack():
+    """ no usr verification: a device reports commands done (or status=failed), many id fields in one post """
+    device_id = (request.form.get('device') or '').strip()[:100]
+    status = request.form.get('status', 'done')
+    if not device_id or status not in ('done', 'failed') :
+        abort(400)
+    with REGISTRY.timer('gae_call_seconds', call='datastore_put') :
+        acknowledged = To_Do_Command.acknowledge(HEARTBEATS.device_key(device_id), request.form.getlist('id'), status)
+    return app.response_class(json.dumps(dict(device=device_id, acknowledged=acknowledged)),
+                              mimetype='application/json')
 
-@app.route('/ping') 
+@app.route('/ping', methods=['GET', 'POST'])
 def ping() :
-    """ ping  from decice - send back command and conrol info"""
-    print request.args
-    
-    return __name__
+    """ ping  from decice - send back command and conrol info: {"device": id, "commands": [leased commands]} """
+    device_id = (request.values.get('device') or '').strip()[:100]
+    if not device_id :
+        abort(400)
+    device_key = HEARTBEATS.record(device_id)     # written to the Device now and then, see heartbeat.py
+    if 'metrics' in request.form :
+        try :
+            record_device_metrics(device_id, json.loads(request.form['metrics']))
+        except (ValueError, TypeError, AttributeError) as error :
+            logging.warning("ping() bad metrics from {}: {}".format(device_id, error))
+    commands = lease_commands(device_key, app.config['COMMAND_LEASE_BATCH'])
+    return app.response_class(json.dumps(dict(device=device_id,
+                                              commands=[command.to_dict_for_device() for command in commands])),
+                              mimetype='application/json')
+
+def record_device_metrics(device_id, summary) :
+    """ keep a pi's metrics summary, as gauges labelled with the metric, in memcache: any instance may
+        take the device's next ping or serve the next scrape, so none keeps it in its own registry """
+    gauges = []
+    for name, value in summary.items() :
+        if isinstance(value, list) :
+            count, total, p50, p95, p99 = value
+            gauges.append(('device_count', count, dict(metric=name)))
+            gauges.append(('device_sum', total, dict(metric=name)))
+            for quantile, seconds in ((0.5, p50), (0.95, p95), (0.99, p99)) :
+                gauges.append(('device_quantile', seconds, dict(metric=name, quantile=quantile)))
+        else :
+            gauges.append(('device_value', value, dict(metric=name)))
+    memcache.set('device-metrics:' + device_id, gauges, time=app.config['DEVICE_METRICS_SECONDS'])
+
+def device_metrics() :
+    """ every known device's last summary, gauges labelled with the device, in a registry of their own """
+    registry = Metrics(REGISTRY.prefix)
+    device_ids = [device['real_world_id'] for device in DEVICE_LISTINGS.get('all', device_listing)
+                  if device['real_world_id']]
+    for device_id, gauges in memcache.get_multi(device_ids, key_prefix='device-metrics:').items() :
+        for name, value, labels in gauges :
+            registry.set(name, value, device=device_id, **labels)
+    return registry
+
+@app.route('/metrics')
+def metrics() :
+    """ metrics in Prometheus text format: the pis' device_* gauges, from memcache, are the same whichever
+        instance answers; everything else is this instance's own registry, so per instance """
+    return app.response_class(REGISTRY.prometheus() + device_metrics().prometheus(),
+                              mimetype='text/plain; version=0.0.4')
 
 @app.route('/devices')
+@ndb.toplevel
 def show_devices() :
     if not verified_user(users) :
         return redirect(url_for('hello'))
     
-    # "select all" ndb query from Devices
+    # "select all" ndb query from Devices, until a device is written again
     # no need to paginate
-    device_query = Device.find_all_devices()
-    device_list = [dict(kind = device.key.kind(),
-                        ndb_id = device.key.id(),
-                        last_ping_time = device.last_ping_time,
-                        real_world_id = device.external_id
-                        ) for device in device_query]
-    return render_template('show_devices.html', devices=device_list)
+    return render_template('show_devices.html', devices=DEVICE_LISTINGS.get('all', device_listing))
+
+def device_listing() :
+    return device_listing_async().get_result()
+
+@ndb.tasklet
+def device_listing_async() :
+    with REGISTRY.timer('gae_call_seconds', call='datastore_query') :
+        device_query = yield Device.find_all_devices().fetch_async()
+    raise ndb.Return([dict(kind = device.key.kind(),
+                           ndb_id = device.key.id(),
+                           key = device.key.urlsafe(),
+                           last_ping_time = device.last_ping_time,
+                           real_world_id = device.external_id
+                           ) for device in device_query])
 
     
 @app.route('/testd')
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""`metrics` counters, timers and histograms, shared by the pi camcorder and the web app"""
+
+# The same module on both sides (pi/metrics.py is a copy of this file, as the pi code is installed on its
+# own; change both), so it sticks to the standard library.
+# Histograms use fixed, cumulative buckets as Prometheus does: observing is a bisect and an add under
+# a lock, cheap enough for the capture loop and every datastore call. The web app renders the registry
+# in Prometheus text format at /metrics; the pi sends summary() (counts, sums, approximate
+# percentiles) on its ping. On GAE each instance keeps its own registry, so /metrics describes the
+# instance that served the scrape, apart from the pis' summaries, which main keeps in memcache.
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds, from a fast cv2 call up to a slow upload
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object) :
+    """Observation counts in fixed buckets, plus their total"""
+
+    def __init__(self, bounds=DEFAULT_BUCKETS) :
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)     # last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value) :
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q) :
+        """ upper bound of the bucket holding the q'th observation (the largest bound if past them all) """
+        if not self.count :
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts) :
+            seen += n
+            if seen >= rank :
+                return bound
+        return self.bounds[-1]
+
+
+class Metrics(object) :
+    """A registry of named, optionally labelled, counters and histograms; safe across threads"""
+
+    def __init__(self, prefix='yardcam') :
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}      # (name, labels) : value
+        self.histograms = {}    # (name, labels) : Histogram
+        self.gauges = {}        # (name, labels) : value, last one set wins
+        self.help = {}
+
+    def describe(self, name, text) :
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels) :
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock :
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels) :
+        with self.lock :
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels) :
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock :
+            histogram = self.histograms.get(key)
+            if histogram is None :
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels) :
+        """ time the with block into histogram name, in seconds """
+        start = time.time()
+        try :
+            yield
+        finally :
+            self.observe(name, time.time() - start, **labels)
+
+    def reset(self) :
+        with self.lock :
+            self.counters.clear()
+            self.histograms.clear()
+            self.gauges.clear()
+
+    def summary(self) :
+        """ compact, JSON ready: {'name{label=value}' : count for counters and gauges,
+            [count, total seconds, p50, p95, p99] for histograms} """
+        with self.lock :
+            result = dict((flat_name(name, labels), value) for (name, labels), value in self.counters.items())
+            result.update((flat_name(name, labels), value) for (name, labels), value in self.gauges.items())
+            for (name, labels), h in self.histograms.items() :
+                result[flat_name(name, labels)] = [h.count, round(h.sum, 4),
+                                                   h.quantile(0.5), h.quantile(0.95), h.quantile(0.99)]
+            return result
+
+    def prometheus(self) :
+        """ the registry in Prometheus text exposition format """
+        with self.lock :
+            lines = []
+            for kind, series in (('counter', self.counters), ('gauge', self.gauges)) :
+                for name in sorted(set(name for (name, _) in series)) :
+                    full = self.prefix + '_' + name
+                    self.header(lines, name, full, kind)
+                    for (other, labels), value in sorted(series.items()) :
+                        if other == name :
+                            lines.append('{}{} {}'.format(full, label_text(labels), value))
+            for name in sorted(set(name for (name, _) in self.histograms)) :
+                full = self.prefix + '_' + name
+                self.header(lines, name, full, 'histogram')
+                for (other, labels), h in sorted(self.histograms.items()) :
+                    if other != name :
+                        continue
+                    cumulative = 0
+                    for bound, n in zip(h.bounds + ('+Inf',), h.counts) :
+                        cumulative += n
+                        lines.append('{}_bucket{} {}'.format(full, label_text(labels + (('le', bound),)), cumulative))
+                    lines.append('{}_sum{} {}'.format(full, label_text(labels), h.sum))
+                    lines.append('{}_count{} {}'.format(full, label_text(labels), h.count))
+            return '\n'.join(lines) + '\n'
+
+    def header(self, lines, name, full, kind) :
+        if name in self.help :
+            lines.append('# HELP {} {}'.format(full, self.help[name]))
+        lines.append('# TYPE {} {}'.format(full, kind))
+
+
+def flat_name(name, labels) :
+    if not labels :
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}={}'.format(k, v) for k, v in labels))
+
+
+def label_text(labels) :
+    if not labels :
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                    for k, v in labels))
+
+
+# the process wide registry
+REGISTRY = Metrics()
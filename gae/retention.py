@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""`retention` packs images older than RETENTION_DAYS into large archive objects and deletes their originals"""
+
+# A RetentionJob (started daily by cron, see cron.yaml) walks the incidents uploaded since the last
+# job's cut off and before its own, now less RETENTION_DAYS, in upload_time batches on the "maintenance"
+# queue. Each batch writes its images end to end into one archive object, archive/<day>/<...>.pack,
+# with a JSON index next to it (.index.json: name, offset, length and content type of each), points
+# every incident at its (archive, offset, length) so main.serve_archived() can range read it back,
+# then deletes the originals and their derivatives: one object and a small index per batch in place
+# of three objects per image. Clips are left as they are.
+#
+# Each try of a batch writes an archive of its own name, so a retry never overwrites one that
+# incidents already point to; the incidents it finds archived by an earlier try are skipped. An
+# original can be shared: by identical uploads (content addressed) or, for older entries named by
+# file name, by uploads of the same name. It is kept while an incident outside the batch still points
+# at it (main.still_referenced_async) and goes when that one is archived in turn. That asks the
+# object_name index, which older incidents are not in until re-put, so until one job has re-put every
+# incident (status indexing, index_batch(), giving older ones their file name as object_name) no
+# job archives anything.
+
+import datetime
+import json
+import logging
+import uuid
+from collections import OrderedDict
+
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+
+import cloudstorage as gcs  # pip installed into app directoy/lib, not a first class citizen quite yet
+
+from metrics import REGISTRY
+from listing_cache import INCIDENT_LISTINGS
+from derivatives import derivative_name, SIZES
+import background
+import bulk_delete
+
+RETENTION_DAYS = 90         # images older than this are archived
+ARCHIVE_BATCH_SIZE = 100    # incidents per batch, so per archive object at most
+ARCHIVE_READ_THREADS = 8    # originals read at once while an archive is written
+
+
+class RetentionJob(ndb.Model) :
+    """One retention run over [since, until), and where it has got to"""
+    since = ndb.DateTimeProperty(indexed=False)     # the previous job's until, None for the first
+    until = ndb.DateTimeProperty(indexed=False)
+    status = ndb.StringProperty(indexed=False, default='running')  # indexing, running, done
+    indexed = ndb.BooleanProperty(indexed=False, default=False)     # every incident is in the object_name index
+    cursor = ndb.StringProperty(indexed=False)
+    batch = ndb.IntegerProperty(indexed=False, default=0)   # next batch to run
+    archived = ndb.IntegerProperty(indexed=False, default=0)
+    archives = ndb.IntegerProperty(indexed=False, default=0)
+    objects_deleted = ndb.IntegerProperty(indexed=False, default=0)
+    error = ndb.StringProperty(indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def recent(cls, limit=5) :
+        return cls.query().order(-cls.started).fetch(limit)
+
+
+def archive_index_name(archive_name) :
+    return archive_name + '.index.json'
+
+
+def start_retention(now=None) :
+    """ record a RetentionJob taking over from the last one and queue its first batch; its key,
+        or None while an earlier job is still running """
+    recent = RetentionJob.recent(1)
+    if recent and recent[0].status != 'done' :
+        logging.info("start_retention() job {} still running".format(recent[0].key.id()))
+        return None
+    until = (now or datetime.datetime.now()) - datetime.timedelta(days=RETENTION_DAYS)
+    indexed = bool(recent) and recent[0].indexed
+    job_key = RetentionJob(since=recent[0].until if recent else None, until=until, indexed=indexed,
+                           status='running' if indexed else 'indexing').put()
+    queue_batch(job_key.id(), 0)
+    return job_key
+
+
+def queue_batch(job_id, batch) :
+    background.tasks.defer(run_retention_batch, job_id, batch, _queue=background.MAINTENANCE_QUEUE)
+
+
+def resume_retention(job_id) :
+    job = RetentionJob.get_by_id(job_id)
+    if job is None or job.status == 'done' :
+        return False
+    queue_batch(job_id, job.batch)
+    return True
+
+
+def run_retention_batch(job_id, batch) :
+    """ task: archive one batch, checkpoint, queue the next """
+    job = RetentionJob.get_by_id(job_id)
+    if job is None or job.status == 'done' or job.batch != batch :
+        logging.info("run_retention_batch() job {} batch {} already run".format(job_id, batch))
+        return
+    try :
+        if job.status == 'indexing' :
+            job.cursor, more = index_batch(job.cursor)
+            if not more :
+                job.status, job.indexed, job.cursor, more = 'running', True, None, True
+        else :
+            archived, deleted, job.cursor, more = archive_batch(job, batch)
+            job.archived += archived
+            job.archives += 1 if archived else 0
+            job.objects_deleted += deleted
+            if not more :
+                job.status = 'done'
+    except Exception as error :
+        job.error = '{}: {}'.format(type(error).__name__, error)
+        job.put()
+        raise       # and the queue retries this batch from the saved cursor
+    job.batch += 1
+    job.error = None
+    job.put()
+    if more :
+        queue_batch(job_id, job.batch)
+    else :
+        logging.info("run_retention_batch() job {} done, {} incidents archived".format(job_id, job.archived))
+
+
+def index_batch(cursor_text) :
+    """ re-put a page of every incident, so each is in the object_name index, an older one under its file
+        name; (next cursor, more) """
+    import main
+    Incident = main.Incident
+    cursor = Cursor(urlsafe=cursor_text) if cursor_text else None
+    with REGISTRY.timer('gae_call_seconds', call='datastore_query') :
+        page, next_cursor, more = Incident.query().fetch_page(ARCHIVE_BATCH_SIZE, start_cursor=cursor)
+    for incident in page :
+        incident.object_name = incident.stored_name()
+    with REGISTRY.timer('gae_call_seconds', call='datastore_put') :
+        ndb.put_multi(page)
+    return next_cursor.urlsafe() if more and next_cursor else None, more
+
+
+def archive_batch(job, batch) :
+    """ archive one page of the job's incidents from its cursor: (archived, objects deleted, next cursor, more) """
+    import main     # the Incident model; a task may run in a fresh instance
+    Incident = main.Incident
+    query = Incident.query(Incident.upload_time < job.until)
+    if job.since :
+        query = query.filter(Incident.upload_time >= job.since)
+    cursor = Cursor(urlsafe=job.cursor) if job.cursor else None
+    with REGISTRY.timer('gae_call_seconds', call='datastore_query') :
+        page, next_cursor, more = query.order(Incident.upload_time).fetch_page(ARCHIVE_BATCH_SIZE, start_cursor=cursor)
+    next_cursor = next_cursor.urlsafe() if more and next_cursor else None
+    todo = [incident for incident in page if not incident.is_clip() and not incident.archive_name]
+    if not todo :
+        return 0, 0, next_cursor, more
+
+    # incidents of the same content share one original, and one entry in the archive
+    by_name = OrderedDict()
+    for incident in todo :
+        by_name.setdefault(incident.stored_name(), []).append(incident)
+    archive_name = 'archive/{}/{}-{}-{}.pack'.format(todo[0].upload_time.strftime('%Y-%m-%d'), job.key.id(),
+                                                     batch, uuid.uuid4().hex[:8])
+    entries = write_archive(main, archive_name, by_name)
+    archived = [incident for entry in entries for incident in by_name[entry['name']]]
+    if not archived :
+        return 0, 0, next_cursor, more     # every original already gone, nothing to point at
+
+    shared = main.still_referenced_async([entry['name'] for entry in entries],
+                                         [incident.key for incident in archived]).get_result()
+    with REGISTRY.timer('gae_call_seconds', call='datastore_put') :
+        ndb.put_multi(archived)
+    INCIDENT_LISTINGS.bump()
+
+    doomed = []
+    for entry in entries :
+        if entry['name'] in shared :
+            continue
+        original = main.gcs_object_name(entry['name'])
+        doomed += [original] + [derivative_name(original, size_name) for size_name, _ in SIZES]
+    with REGISTRY.timer('gae_call_seconds', call='gcs_delete') :
+        deleted = sum(main.parallel_map(bulk_delete.delete_object, doomed, ARCHIVE_READ_THREADS))
+    REGISTRY.inc('archived_total', len(archived))
+    logging.info("archive_batch() {} incidents into {}, {} objects deleted".format(len(archived), archive_name, deleted))
+    return len(archived), deleted, next_cursor, more
+
+
+def read_object(gcs_filename) :
+    """ an object's bytes, None if it is gone """
+    try :
+        with gcs.open(gcs_filename) as f :
+            return f.read()
+    except gcs.NotFoundError :
+        return None
+
+
+def write_archive(main, archive_name, by_name) :
+    """ write the originals named in by_name end to end into archive_name, and its index; point their
+        incidents (not put) at their place in it; the index entries, for the originals that were found """
+    names = list(by_name)
+    entries = []
+    offset = 0
+    with REGISTRY.timer('gae_call_seconds', call='gcs_write') :
+        with gcs.open(main.gcs_object_name(archive_name), 'w', content_type='application/octet-stream') as f :
+            for start in range(0, len(names), ARCHIVE_READ_THREADS) :
+                group = names[start:start + ARCHIVE_READ_THREADS]
+                datas = main.parallel_map(read_object, [main.gcs_object_name(name) for name in group],
+                                          ARCHIVE_READ_THREADS)
+                for name, data in zip(group, datas) :
+                    if data is None :
+                        logging.warning("write_archive() {} is missing, its incidents are left as they are".format(name))
+                        continue
+                    f.write(data)
+                    content_type = by_name[name][0].content_type or 'image/jpeg'
+                    entries.append(dict(name=name, offset=offset, length=len(data), content_type=content_type))
+                    for incident in by_name[name] :
+                        incident.archive_name = archive_name
+                        incident.archive_offset = offset
+                        incident.archive_length = len(data)
+                        incident.serving_url = incident.thumb_url = incident.medium_url = None
+                    offset += len(data)
+        if entries :
+            with gcs.open(main.gcs_object_name(archive_index_name(archive_name)), 'w',
+                          content_type='application/json') as f :
+                f.write(json.dumps(entries, separators=(',', ':')))
+    if not entries :
+        bulk_delete.delete_object(main.gcs_object_name(archive_name))
+    return entries
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""`rollups` keeps incident counts per camera per day and per hour, so timelines never read incidents"""
+
+# Each upload adds one to a day and an hour IncidentRollup, a shard picked at random of SHARDS for
+# that camera and bucket, each add a small transaction of its own, so busy cameras spread their
+# writes instead of queueing on one entity. A timeline reads every shard in its range, at most
+# SHARDS + 1 entities per bucket per camera however many incidents there are. Buckets are UTC, and by
+# capture time where the pi sent one, so a spooled backlog lands when it happened. Counting is best
+# effort: the incident is stored by then, so an add that fails is logged and retried as a task of its
+# own rather than failing the upload (whose retry would store the incident twice).
+#
+# Rollups belong to a generation, RollupGeneration.current, the one timelines read; those written
+# before generations existed are generation 0. A rebuild (RollupJob, queue "maintenance") never
+# touches the live counts: it opens the next generation, which uploads count into alongside the
+# current one from then on, walks the incidents uploaded before that point in upload_time batches,
+# adding them to one more shard per bucket, BACKFILL_SHARD, makes its generation the current one,
+# and only then deletes the older generations' rollups in batches. Backfill shards remember the last
+# batch they took, so a retried batch does not count twice. The few uploads in flight at its start
+# may be off.
+
+import datetime
+import logging
+import random
+from collections import defaultdict
+
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+
+from metrics import REGISTRY
+from listing_cache import INCIDENT_LISTINGS
+import background
+import bulk_delete
+
+SHARDS = 8                  # per camera, bucket and period
+BACKFILL_SHARD = 'backfill'
+BACKFILL_BATCH_SIZE = 500   # incidents counted per rebuild task
+PERIODS = {'day' : datetime.timedelta(days=1), 'hour' : datetime.timedelta(hours=1)}
+
+
+def bucket_start(period, when) :
+    """ the start of the day or hour holding when """
+    if period == 'day' :
+        return datetime.datetime(when.year, when.month, when.day)
+    return datetime.datetime(when.year, when.month, when.day, when.hour)
+
+
+def bucket_starts(period, since, until) :
+    """ every bucket start from the one holding since up to, not including, until """
+    start = bucket_start(period, since)
+    while start < until :
+        yield start
+        start += PERIODS[period]
+
+
+class IncidentRollup(ndb.Model) :
+    """One shard of one camera's incident count for one day or hour"""
+    camera = ndb.StringProperty()
+    period = ndb.StringProperty()                       # day or hour
+    start = ndb.DateTimeProperty()                      # the bucket's start
+    count = ndb.IntegerProperty(indexed=False, default=0)
+    last_batch = ndb.IntegerProperty(indexed=False, default=-1)     # backfill shard only, see above
+    generation = ndb.IntegerProperty(indexed=False)                 # None for generation 0
+
+    @staticmethod
+    def key_for(period, camera, start, shard, generation=0) :
+        name = '{}|{}|{}|{}'.format(period, camera, start.isoformat(), shard)
+        return ndb.Key(IncidentRollup, 'g{}|{}'.format(generation, name) if generation else name)
+
+    @classmethod
+    def in_range(cls, period, since, until, camera=None) :
+        query = cls.query(cls.period == period, cls.start >= bucket_start(period, since), cls.start < until)
+        return query if camera is None else query.filter(cls.camera == camera)
+
+bulk_delete.register(IncidentRollup._get_kind(), listing=INCIDENT_LISTINGS)
+
+
+class RollupGeneration(ndb.Model) :
+    """The rollup generation timelines read, and the one a rebuild is filling, if any (one entity)"""
+    current = ndb.IntegerProperty(indexed=False, default=0)
+    building = ndb.IntegerProperty(indexed=False)
+
+    @classmethod
+    @ndb.tasklet
+    def load_async(cls) :
+        """ the entity, or before the first rebuild, an unsaved one at generation 0 """
+        state = yield cls.get_by_id_async('rollups')
+        raise ndb.Return(state or cls(id='rollups'))
+
+    def counted(self) :
+        """ the generations a new incident is added to """
+        return [self.current] + ([self.building] if self.building else [])
+
+
+@ndb.transactional_tasklet
+def add_async(key, period, camera, start, amount, generation=0) :
+    shard = yield key.get_async()
+    if shard is None :
+        shard = IncidentRollup(key=key, camera=camera, period=period, start=start, generation=generation or None)
+    shard.count += amount
+    yield shard.put_async()
+
+
+@ndb.tasklet
+def add_or_defer_async(period, camera, start, amount, generation) :
+    """ add_async() to a random shard; if that fails, retry it in a task instead of raising """
+    try :
+        yield add_async(IncidentRollup.key_for(period, camera, start, random.randrange(SHARDS), generation),
+                        period, camera, start, amount, generation)
+    except Exception as error :
+        logging.warning("rollup add {} {} {} +{} deferred: {}".format(period, camera, start, amount, error))
+        REGISTRY.inc('rollup_adds_deferred_total')
+        background.tasks.defer(add_later, period, camera, start, amount, generation,
+                               _queue=background.MAINTENANCE_QUEUE)
+
+
+def add_later(period, camera, start, amount, generation) :
+    """ task: a rollup add that failed during an upload; the queue retries it until it commits """
+    add_async(IncidentRollup.key_for(period, camera, start, random.randrange(SHARDS), generation),
+              period, camera, start, amount, generation).get_result()
+
+
+@ndb.tasklet
+def counted_generations_async() :
+    """ the generations new incidents are added to, [0] if that cannot be read; never raises """
+    try :
+        state = yield RollupGeneration.load_async()
+    except Exception as error :
+        logging.warning("counted_generations_async() generation unknown, counting into 0: {}".format(error))
+        raise ndb.Return([0])
+    raise ndb.Return(state.counted())
+
+
+@ndb.tasklet
+def count_incidents_async(incidents, generations=None) :
+    """ add newly stored incidents (with upload_time set, so after their put) to the day and hour rollups
+        of their event_time(), in each generation being counted; never raises, see above
+        generations, a counted_generations_async() future, lets the caller read them alongside its put """
+    totals = defaultdict(int)
+    for incident in incidents :
+        for period in PERIODS :
+            totals[(period, incident.camera, bucket_start(period, incident.event_time()))] += 1
+    with REGISTRY.timer('gae_call_seconds', call='datastore_rollup') :
+        generations = yield generations or counted_generations_async()
+        yield [add_or_defer_async(period, camera, start, amount, generation)
+               for (period, camera, start), amount in totals.items() for generation in generations]
+
+
+def timeline(period, since, until, camera=None) :
+    """ [(bucket start, {camera : incidents})] for every bucket in [since, until), oldest first """
+    counts = dict((start, defaultdict(int)) for start in bucket_starts(period, since, until))
+    with REGISTRY.timer('gae_call_seconds', call='datastore_query') :
+        generation = RollupGeneration.load_async().get_result().current
+        shards = IncidentRollup.in_range(period, since, until, camera).fetch()
+    for shard in shards :
+        if shard.start in counts and (shard.generation or 0) == generation :
+            counts[shard.start][shard.camera] += shard.count
+    return sorted(counts.items())
+
+
+class RollupJob(ndb.Model) :
+    """A rollup rebuild, running or finished, and where it has got to"""
+    phase = ndb.StringProperty(indexed=False, default='counting')  # counting, retiring, done
+    generation = ndb.IntegerProperty(indexed=False)         # the generation it fills
+    cursor = ndb.StringProperty(indexed=False)
+    batch = ndb.IntegerProperty(indexed=False, default=0)   # next batch to run
+    until = ndb.DateTimeProperty(indexed=False)             # incidents before this are counted by the rebuild
+    cleared = ndb.IntegerProperty(indexed=False, default=0) # older generations' rollups deleted
+    counted = ndb.IntegerProperty(indexed=False, default=0)
+    error = ndb.StringProperty(indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def recent(cls, limit=5) :
+        return cls.query().order(-cls.started).fetch(limit)
+
+
+def start_rebuild() :
+    """ open the next rollup generation, record a RollupJob to fill it and queue its first batch; the job's key """
+    @ndb.transactional(xg=True)
+    def begin() :
+        state = RollupGeneration.load_async().get_result()
+        state.building = max(state.current, state.building or 0) + 1    # a newer rebuild supersedes a running one
+        state.put()
+        return RollupJob(generation=state.building, until=datetime.datetime.now()).put()
+    job_key = begin()
+    queue_batch(job_key.id(), 0)
+    return job_key
+
+
+def queue_batch(job_id, batch) :
+    background.tasks.defer(run_rebuild_batch, job_id, batch, _queue=background.MAINTENANCE_QUEUE)
+
+
+def resume_rebuild(job_id) :
+    job = RollupJob.get_by_id(job_id)
+    if job is None or job.phase == 'done' :
+        return False
+    queue_batch(job_id, job.batch)
+    return True
+
+
+def run_rebuild_batch(job_id, batch) :
+    """ task: one batch of the rebuild, counting or retiring, checkpoint, queue the next """
+    import main     # the Incident model; a task may run in a fresh instance
+    job = RollupJob.get_by_id(job_id)
+    if job is None or job.phase == 'done' or job.batch != batch :
+        logging.info("run_rebuild_batch() job {} batch {} already run".format(job_id, batch))
+        return
+    try :
+        if job.phase == 'counting' :
+            counted, job.cursor, more = count_batch(main.Incident, main.camera_name, job.until, job.cursor,
+                                                    batch, job.generation)
+            job.counted += counted
+            if not more :
+                job.cursor = None
+                job.phase = 'retiring' if make_current(job.generation) else 'done'
+        else :
+            deleted, job.cursor, more = retire_batch(job.generation, job.cursor)
+            job.cleared += deleted
+            if not more :
+                job.phase = 'done'
+    except Exception as error :
+        job.error = '{}: {}'.format(type(error).__name__, error)
+        job.put()
+        raise       # and the queue retries this batch from the saved cursor
+    job.batch += 1
+    job.error = None
+    job.put()
+    if job.phase != 'done' :
+        queue_batch(job_id, job.batch)
+    else :
+        logging.info("run_rebuild_batch() job {} done, {} incidents counted".format(job_id, job.counted))
+
+
+@ndb.transactional
+def make_current(generation) :
+    """ switch timelines to a filled generation, unless a newer rebuild has superseded it; whether it did """
+    state = RollupGeneration.load_async().get_result()
+    if state.building != generation :
+        logging.info("make_current() generation {} superseded by {}".format(generation, state.building))
+        return False
+    state.current, state.building = generation, None
+    state.put()
+    INCIDENT_LISTINGS.bump()
+    return True
+
+
+def retire_batch(generation, cursor_text) :
+    """ delete a page's rollups of generations older than generation: (deleted, next cursor, more) """
+    cursor = Cursor(urlsafe=cursor_text) if cursor_text else None
+    with REGISTRY.timer('gae_call_seconds', call='datastore_query') :
+        shards, next_cursor, more = IncidentRollup.query().fetch_page(bulk_delete.DELETE_BATCH_SIZE, start_cursor=cursor)
+    old = [shard.key for shard in shards if (shard.generation or 0) < generation]
+    with REGISTRY.timer('gae_call_seconds', call='datastore_delete') :
+        ndb.delete_multi(old)
+    REGISTRY.inc('bulk_deleted_total', len(old), kind=IncidentRollup._get_kind())
+    return len(old), next_cursor.urlsafe() if more and next_cursor else None, more
+
+
+def count_batch(incident_model, camera_name, until, cursor_text, batch, generation) :
+    """ add a page of incidents uploaded before until to generation's backfill shards: (counted, next cursor, more)
+        camera_name is main.camera_name(), which names the camera of an incident that did not say """
+    query = incident_model.query(incident_model.upload_time < until).order(incident_model.upload_time)
+    cursor = Cursor(urlsafe=cursor_text) if cursor_text else None
+    with REGISTRY.timer('gae_call_seconds', call='datastore_query') :
+        incidents, next_cursor, more = query.fetch_page(BACKFILL_BATCH_SIZE, start_cursor=cursor)
+    totals = defaultdict(int)
+    for incident in incidents :
+        camera = camera_name(incident.camera)
+        for period in PERIODS :
+            totals[(period, camera, bucket_start(period, incident.event_time()))] += 1
+    keys = [IncidentRollup.key_for(bucket_period, bucket_camera, bucket, BACKFILL_SHARD, generation)
+            for (bucket_period, bucket_camera, bucket) in totals]
+    shards = ndb.get_multi(keys)
+    changed = []
+    for key, shard, ((period, camera, start), amount) in zip(keys, shards, totals.items()) :
+        if shard is None :
+            shard = IncidentRollup(key=key, camera=camera, period=period, start=start, generation=generation)
+        if shard.last_batch < batch :
+            shard.count += amount
+            shard.last_batch = batch
+            changed.append(shard)
+    ndb.put_multi(changed)
+    return len(incidents), next_cursor.urlsafe() if more and next_cursor else None, more
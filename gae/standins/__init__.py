@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""`standins` are in-memory versions of the App Engine services, so the app runs on any WSGI server"""
+
+# install() puts them in sys.modules under the names main.py and friends import (google.appengine...,
+# cloudstorage), so it must run before those are imported. Everything lives in this one process and
+# is gone when it exits: ndb (datastore), cloudstorage (GCS), images and blobstore (serving urls),
+# users (one signed in account), memcache and deferred (a worker thread). They cover the calls this
+# app makes, no more; local_server.py serves the app on them and load_test.py drives it.
+
+import sys
+import types
+
+import ndb
+import cloudstorage
+import blobstore
+import images
+import users
+import memcache
+import deferred
+
+APPLICATION_ID = 'yard-cam-local'
+
+
+def module(name, **attributes) :
+    made = types.ModuleType(name)
+    made.__dict__.update(attributes)
+    return made
+
+
+def install(user_email=None) :
+    """ register the stand-ins as the App Engine modules; user_email is who every request is signed in as """
+    errors = dict((name, getattr(ndb, name)) for name in ('Error', 'BadValueError', 'BadRequestError',
+                  'BadArgumentError', 'BadQueryError', 'Timeout', 'TransactionFailedError', 'Rollback'))
+    modules = {
+        'google' : module('google'),
+        'google.appengine' : module('google.appengine'),
+        'google.appengine.api' : module('google.appengine.api'),
+        'google.appengine.ext' : module('google.appengine.ext'),
+        'google.appengine.datastore' : module('google.appengine.datastore'),
+        'google.appengine.ext.ndb' : ndb,
+        'google.appengine.ext.blobstore' : blobstore,
+        'google.appengine.ext.deferred' : deferred,
+        'google.appengine.ext.vendor' : module('google.appengine.ext.vendor', add=lambda path : None),
+        'google.appengine.api.images' : images,
+        'google.appengine.api.users' : users,
+        'google.appengine.api.memcache' : memcache,
+        'google.appengine.api.app_identity' : module('google.appengine.api.app_identity',
+                                                     get_application_id=lambda : APPLICATION_ID),
+        'google.appengine.api.datastore_errors' : module('google.appengine.api.datastore_errors', **errors),
+        'google.appengine.datastore.datastore_query' : module('google.appengine.datastore.datastore_query',
+                                                              Cursor=ndb.Cursor),
+        'cloudstorage' : cloudstorage,
+    }
+    sys.modules.update(modules)
+    for name, value in modules.items() :
+        if '.' in name :
+            parent, child = name.rsplit('.', 1)
+            setattr(modules[parent], child, value)
+    users.sign_in(user_email)
+
+
+def reset() :
+    """ forget every entity, object and cached value """
+    ndb.STORE.clear()
+    with cloudstorage.LOCK :
+        cloudstorage.OBJECTS.clear()
+    memcache.flush_all()
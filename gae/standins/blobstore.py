@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""`standins.blobstore` makes blob keys for GCS objects the way the SDK does: an encoded object name"""
+
+import base64
+
+from ndb import Future
+
+GS_PREFIX = 'encoded_gs_file:'
+
+
+class BlobKey(str) :
+    pass
+
+
+def create_gs_key(filename, rpc=None) :
+    """ the blob key for /gs/bucket/name """
+    if not filename.startswith('/gs/') :
+        raise ValueError("not a /gs/ filename: {!r}".format(filename))
+    return GS_PREFIX + base64.urlsafe_b64encode(filename[len('/gs'):])
+
+
+def create_gs_key_async(filename, rpc=None) :
+    return Future.run(create_gs_key, filename)
+
+
+def gcs_filename(blob_key) :
+    """ the /bucket/name behind a key from create_gs_key() """
+    return base64.urlsafe_b64decode(str(blob_key)[len(GS_PREFIX):])
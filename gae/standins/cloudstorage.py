@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""`standins.cloudstorage` keeps GCS objects in a dict, behind the cloudstorage client calls this app uses"""
+
+# Objects are /bucket/name strings mapped to their bytes and stat. As with GCS, a writer's object only
+# exists once it is closed, and then replaces any object of that name whole.
+
+import hashlib
+import threading
+import time
+from StringIO import StringIO
+
+
+class Error(Exception) :
+    pass
+
+class NotFoundError(Error) :
+    pass
+
+class ForbiddenError(Error) :
+    pass
+
+class AuthorizationError(Error) :
+    pass
+
+
+class GCSFileStat(object) :
+    """What stat() and listbucket() report about an object"""
+
+    def __init__(self, filename, st_size, etag, st_ctime, content_type=None, metadata=None, is_dir=False) :
+        self.filename = filename
+        self.st_size = st_size
+        self.etag = etag
+        self.st_ctime = st_ctime
+        self.content_type = content_type
+        self.metadata = metadata or {}
+        self.is_dir = is_dir
+
+
+OBJECTS = {}        # /bucket/name : (bytes, GCSFileStat)
+LOCK = threading.Lock()
+
+
+def store(filename, data, content_type=None, metadata=None) :
+    stat = GCSFileStat(filename, len(data), hashlib.md5(data).hexdigest(), time.time(),
+                       content_type or 'binary/octet-stream', metadata)
+    with LOCK :
+        OBJECTS[filename] = (data, stat)
+
+
+def lookup(filename) :
+    with LOCK :
+        found = OBJECTS.get(filename)
+    if found is None :
+        raise NotFoundError("no object {}".format(filename))
+    return found
+
+
+class Writer(object) :
+    """Buffers writes, creates the object on close()"""
+
+    def __init__(self, filename, content_type=None, options=None) :
+        self.filename = filename
+        self.content_type = content_type
+        self.metadata = dict((k, v) for k, v in (options or {}).items() if k.startswith('x-goog-meta-'))
+        self.buffer = StringIO()
+        self.closed = False
+
+    def write(self, data) :
+        self.buffer.write(data)
+
+    def tell(self) :
+        return self.buffer.tell()
+
+    def close(self) :
+        if not self.closed :
+            self.closed = True
+            store(self.filename, self.buffer.getvalue(), self.content_type, self.metadata)
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, kind, error, traceback) :
+        if kind is None :
+            self.close()    # an exception leaves nothing behind, as an unclosed GCS upload
+
+
+class Reader(StringIO) :
+    """The object's bytes, read(), seek() and the context manager of a ReadBuffer"""
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, kind, error, traceback) :
+        self.close()
+
+
+def open(filename, mode='r', content_type=None, options=None, read_buffer_size=None, retry_params=None) :
+    if mode == 'w' :
+        return Writer(filename, content_type, options)
+    if mode == 'r' :
+        return Reader(lookup(filename)[0])
+    raise ValueError("mode must be 'r' or 'w', not {!r}".format(mode))
+
+
+def stat(filename, retry_params=None) :
+    return lookup(filename)[1]
+
+
+def delete(filename, retry_params=None) :
+    with LOCK :
+        if OBJECTS.pop(filename, None) is None :
+            raise NotFoundError("no object {}".format(filename))
+
+
+def compose(list_of_files, destination_file, files_metadata=None, content_type=None, retry_params=None) :
+    """ concatenate objects named within the destination's bucket into destination_file """
+    bucket = destination_file[:destination_file.index('/', 1) + 1]
+    data = ''.join(lookup(bucket + name)[0] for name in list_of_files)
+    store(destination_file, data, content_type)
+
+
+def copy2(src, dst, metadata=None, retry_params=None) :
+    data, stat = lookup(src)
+    store(dst, data, stat.content_type, metadata if metadata is not None else stat.metadata)
+
+
+def listbucket(path_prefix, marker=None, prefix=None, max_keys=None, delimiter=None, retry_params=None) :
+    with LOCK :
+        names = sorted(name for name in OBJECTS if name.startswith(path_prefix + (prefix or '')))
+    if marker is not None :
+        names = [name for name in names if name > marker]
+    for name in names[:max_keys] :
+        yield lookup(name)[1]
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""`standins.deferred` runs deferred tasks on a worker thread in this process, in countdown order"""
+
+# A task that raises is retried up to RETRIES times, RETRY_SECONDS apart, then logged and dropped.
+# wait_idle() returns once nothing is queued or running, for harnesses that need the work done.
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+RETRIES = 3
+RETRY_SECONDS = 1.0
+
+
+class PermanentTaskFailure(Exception) :
+    pass
+
+
+class TaskRunner(object) :
+    """A heap of (run at, order, task) and the thread that works through it"""
+
+    def __init__(self) :
+        self.condition = threading.Condition()
+        self.heap = []
+        self.order = itertools.count()
+        self.running = 0
+        self.thread = None
+
+    def add(self, run_at, task) :
+        with self.condition :
+            heapq.heappush(self.heap, (run_at, next(self.order), task))
+            if self.thread is None :
+                self.thread = threading.Thread(target=self.work, name="deferred")
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify_all()
+
+    def work(self) :
+        while True :
+            with self.condition :
+                while not self.heap or self.heap[0][0] > time.time() :
+                    self.condition.wait(max(0.01, self.heap[0][0] - time.time()) if self.heap else None)
+                run_at, _, task = heapq.heappop(self.heap)
+                self.running += 1
+            try :
+                task()
+            finally :
+                with self.condition :
+                    self.running -= 1
+                    self.condition.notify_all()
+
+    def wait_idle(self, timeout=None) :
+        """ True once no task is queued or running, False if timeout seconds pass first """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.condition :
+            while self.heap or self.running :
+                left = deadline - time.time() if deadline is not None else None
+                if left is not None and left <= 0 :
+                    return False
+                self.condition.wait(min(left, 0.1) if left is not None else 0.1)
+        return True
+
+
+RUNNER = TaskRunner()
+
+
+def defer(function, *args, **kwargs) :
+    countdown = kwargs.pop('_countdown', 0) or 0
+    for option in [name for name in kwargs if name.startswith('_')] :    # _queue, _name, _transactional ...
+        kwargs.pop(option)
+
+    def task(tries=[0]) :
+        try :
+            function(*args, **kwargs)
+        except PermanentTaskFailure as error :
+            logging.error("deferred {} failed permanently: {}".format(function.__name__, error))
+        except Exception :
+            tries[0] += 1
+            logging.exception("deferred {} failed, try {}".format(function.__name__, tries[0]))
+            if tries[0] < RETRIES :
+                RUNNER.add(time.time() + RETRY_SECONDS, task)
+    RUNNER.add(time.time() + countdown, task)
+
+
+def wait_idle(timeout=None) :
+    return RUNNER.wait_idle(timeout)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""`standins.images` serves GCS objects from the local server and passes transforms through unchanged"""
+
+# There is no image library to count on here, so execute_transform() returns the original bytes
+# whatever was asked for: the derivative objects get written and served, just not smaller.
+# Serving urls point at the local server's /_local/gcs/ route (see local_server.py).
+
+import cloudstorage
+from blobstore import gcs_filename
+from ndb import Future
+
+JPEG = 0
+PNG = 1
+WEBP = 2
+BMP = 3
+GIF = 4
+ICO = 5
+TIFF = 6
+
+SERVING_PREFIX = '/_local/gcs'
+
+
+class Error(Exception) :
+    pass
+
+class TransformationError(Error) :
+    pass
+
+class ObjectNotFoundError(Error) :
+    pass
+
+
+class Image(object) :
+    """The original bytes, by blob key or given, and the transforms asked for"""
+
+    def __init__(self, image_data=None, blob_key=None, filename=None) :
+        self.image_data = image_data
+        self.blob_key = blob_key
+        self.transforms = []
+
+    def resize(self, width=0, height=0, crop_to_fit=False, **options) :
+        self.transforms.append(('resize', width, height))
+
+    def rotate(self, degrees) :
+        self.transforms.append(('rotate', degrees))
+
+    def execute_transform(self, output_encoding=PNG, quality=None, **options) :
+        if self.image_data is not None :
+            return self.image_data
+        try :
+            with cloudstorage.open(gcs_filename(self.blob_key)) as f :
+                return f.read()
+        except cloudstorage.NotFoundError :
+            raise ObjectNotFoundError("no object behind {}".format(self.blob_key))
+
+
+def get_serving_url(blob_key, size=None, crop=False, secure_url=None, filename=None, rpc=None) :
+    return SERVING_PREFIX + gcs_filename(blob_key)
+
+
+def get_serving_url_async(blob_key, size=None, crop=False, secure_url=None, filename=None, rpc=None) :
+    return Future.run(get_serving_url, blob_key, size, crop, secure_url)
+
+
+def delete_serving_url(blob_key, rpc=None) :
+    pass
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""`standins.memcache` is memcache's module level calls over one in-process dict, with expiry"""
+
+# Values are pickled in and out, as memcache copies them, so a caller changing what it got back
+# does not change the cached value. time is seconds from now; 0 never expires.
+
+import cPickle as pickle
+import threading
+import time as clock
+
+VALUES = {}         # key : (pickled value, expires or 0)
+LOCK = threading.Lock()
+
+
+def live(key) :
+    """ the entry for key unless it has expired; call holding LOCK """
+    entry = VALUES.get(key)
+    if entry is not None and entry[1] and entry[1] <= clock.time() :
+        del VALUES[key]
+        entry = None
+    return entry
+
+
+def expiry(time) :
+    return clock.time() + time if time else 0
+
+
+def get(key, namespace=None, for_cas=False) :
+    with LOCK :
+        entry = live(key)
+    return pickle.loads(entry[0]) if entry is not None else None
+
+
+def get_multi(keys, key_prefix='', namespace=None, for_cas=False) :
+    found = {}
+    for key in keys :
+        value = get(key_prefix + key)
+        if value is not None :
+            found[key] = value
+    return found
+
+
+def set(key, value, time=0, min_compress_len=0, namespace=None) :
+    with LOCK :
+        VALUES[key] = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expiry(time))
+    return True
+
+
+def set_multi(mapping, time=0, key_prefix='', min_compress_len=0, namespace=None) :
+    for key, value in mapping.items() :
+        set(key_prefix + key, value, time)
+    return []
+
+
+def add(key, value, time=0, min_compress_len=0, namespace=None) :
+    with LOCK :
+        if live(key) is not None :
+            return False
+        VALUES[key] = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expiry(time))
+    return True
+
+
+def add_multi(mapping, time=0, key_prefix='', min_compress_len=0, namespace=None) :
+    """ the keys that were not added, they were there already """
+    return [key for key, value in mapping.items() if not add(key_prefix + key, value, time)]
+
+
+def incr(key, delta=1, namespace=None, initial_value=None) :
+    with LOCK :
+        entry = live(key)
+        if entry is None :
+            if initial_value is None :
+                return None
+            entry = (pickle.dumps(initial_value, pickle.HIGHEST_PROTOCOL), 0)
+        value = pickle.loads(entry[0]) + delta
+        VALUES[key] = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), entry[1])
+    return value
+
+
+def decr(key, delta=1, namespace=None, initial_value=None) :
+    return incr(key, -delta, namespace, initial_value)
+
+
+def delete(key, seconds=0, namespace=None) :
+    with LOCK :
+        return 2 if VALUES.pop(key, None) is not None else 1
+
+
+def delete_multi(keys, seconds=0, key_prefix='', namespace=None) :
+    for key in keys :
+        delete(key_prefix + key)
+    return True
+
+
+def flush_all() :
+    with LOCK :
+        VALUES.clear()
+    return True
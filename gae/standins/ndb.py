@@ -0,0 +1,776 @@
+# -*- coding: utf-8 -*-
+"""`standins.ndb` is an in-memory datastore behind the parts of the ndb API this app uses"""
+
+# One process wide store, strongly consistent, guarded by one re-entrant lock; a transaction simply
+# holds the lock. Queries scan their kind, filter and sort in Python: fine for thousands of entities,
+# not for millions. Async calls run at once and return finished futures, and a tasklet runs its
+# generator to the end on the spot, so nothing overlaps (bench_handlers.py threads them).
+# Cursors are positions in a sort order, so a reversed() cursor pages back through a reversed query.
+
+import base64
+import datetime
+import functools
+import itertools
+import json
+import threading
+
+
+# datastore_errors
+
+class Error(Exception) :
+    pass
+
+class BadValueError(Error) :
+    pass
+
+class BadRequestError(Error) :
+    pass
+
+class BadArgumentError(Error) :
+    pass
+
+class BadQueryError(Error) :
+    pass
+
+class Timeout(Error) :
+    pass
+
+class TransactionFailedError(Error) :
+    pass
+
+class Rollback(Error) :
+    pass
+
+
+class Datastore(object) :
+    """kind : {key pairs : property values}, and the id allocator"""
+
+    def __init__(self) :
+        self.lock = threading.RLock()
+        self.kinds = {}
+        self.ids = itertools.count(1)
+
+    def clear(self) :
+        with self.lock :
+            self.kinds.clear()
+
+
+STORE = Datastore()
+
+
+# futures and tasklets
+
+class Future(object) :
+    """A finished call: its result, or the exception it raised"""
+
+    def __init__(self, result=None, exception=None) :
+        self.result = result
+        self.exception = exception
+
+    def get_result(self) :
+        if self.exception is not None :
+            raise self.exception
+        return self.result
+
+    def wait(self) :
+        pass
+
+    def done(self) :
+        return True
+
+    def check_success(self) :
+        self.get_result()
+
+    @classmethod
+    def run(cls, function, *args, **kwargs) :
+        try :
+            return cls(function(*args, **kwargs))
+        except Exception as error :
+            return cls(exception=error)
+
+
+class Return(StopIteration) :
+    pass
+
+
+def resolve(yielded) :
+    if isinstance(yielded, Future) :
+        return yielded.get_result()
+    if isinstance(yielded, (list, tuple)) :
+        return [resolve(item) for item in yielded]
+    raise BadArgumentError("a tasklet yielded {!r}, not a future".format(yielded))
+
+
+def tasklet(function) :
+    @functools.wraps(function)
+    def run(*args, **kwargs) :
+        try :
+            generator = function(*args, **kwargs)
+        except Return as result :
+            return Future(result.args[0] if result.args else None)
+        except Exception as error :
+            return Future(exception=error)
+        if not hasattr(generator, 'send') :
+            return Future(generator)
+        value, error = None, None
+        while True :
+            try :
+                yielded = generator.throw(error) if error is not None else generator.send(value)
+            except Return as result :
+                return Future(result.args[0] if result.args else None)
+            except StopIteration :
+                return Future(None)
+            except Exception as failure :
+                return Future(exception=failure)
+            value, error = None, None
+            try :
+                value = resolve(yielded)
+            except Exception as failure :
+                error = failure
+    return run
+
+
+def toplevel(function) :
+    return function
+
+
+def synctasklet(function) :
+    wrapped = tasklet(function)
+    @functools.wraps(function)
+    def run(*args, **kwargs) :
+        return wrapped(*args, **kwargs).get_result()
+    return run
+
+
+def transaction(function, retries=3, xg=False, **options) :
+    with STORE.lock :
+        return function()
+
+
+def transactional(function=None, **options) :
+    """ @transactional or @transactional(xg=True, ...): runs holding the store lock """
+    def decorate(function) :
+        @functools.wraps(function)
+        def run(*args, **kwargs) :
+            with STORE.lock :
+                return function(*args, **kwargs)
+        return run
+    return decorate(function) if function is not None else decorate
+
+
+def transactional_tasklet(function=None, **options) :
+    """ @transactional_tasklet: a tasklet run, to its end, holding the store lock """
+    def decorate(function) :
+        wrapped = tasklet(function)
+        @functools.wraps(function)
+        def run(*args, **kwargs) :
+            with STORE.lock :
+                return wrapped(*args, **kwargs)
+        return run
+    return decorate(function) if function is not None else decorate
+
+
+def in_transaction() :
+    return False
+
+
+# keys
+
+def encode_value(value) :
+    if isinstance(value, datetime.datetime) :
+        return {'datetime' : value.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+    if isinstance(value, Key) :
+        return {'key' : value.urlsafe()}
+    return value
+
+
+def decode_value(value) :
+    if isinstance(value, dict) and 'datetime' in value :
+        return datetime.datetime.strptime(value['datetime'], '%Y-%m-%dT%H:%M:%S.%f')
+    if isinstance(value, dict) and 'key' in value :
+        return Key(urlsafe=value['key'])
+    if isinstance(value, unicode) :
+        return value.encode('utf-8')
+    return value
+
+
+def urlsafe_encode(data) :
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':'))).rstrip('=')
+
+
+def urlsafe_decode(text) :
+    try :
+        text = str(text)
+        return json.loads(base64.urlsafe_b64decode(text + '=' * (-len(text) % 4)))
+    except (TypeError, ValueError, UnicodeError) :
+        raise BadValueError("not a urlsafe string: {!r}".format(text))
+
+
+class Key(object) :
+    """Key(kind, id, kind, id ..., parent=None) or Key(urlsafe=...); immutable"""
+
+    def __init__(self, *flat, **kwargs) :
+        if 'urlsafe' in kwargs :
+            pairs = urlsafe_decode(kwargs['urlsafe'])
+            if not isinstance(pairs, list) or not pairs :
+                raise BadValueError("not a key: {!r}".format(kwargs['urlsafe']))
+            flat = [decode_value(part) for pair in pairs for part in pair]
+        parent = kwargs.get('parent')
+        flat = [part._get_kind() if isinstance(part, type) else part for part in flat]
+        if len(flat) % 2 :
+            raise BadArgumentError("a key needs kind, id pairs: {!r}".format(flat))
+        pairs = tuple(zip(flat[0::2], flat[1::2]))
+        for kind, id in pairs :
+            if id is not None and not isinstance(id, (basestring, int, long)) :
+                raise BadArgumentError("key id must be a string or an integer: {!r}".format(id))
+        self._pairs = (parent.pairs() if parent is not None else ()) + pairs
+
+    def pairs(self) :
+        return self._pairs
+
+    def flat(self) :
+        return tuple(part for pair in self._pairs for part in pair)
+
+    def kind(self) :
+        return self._pairs[-1][0]
+
+    def id(self) :
+        return self._pairs[-1][1]
+
+    def string_id(self) :
+        return self.id() if isinstance(self.id(), basestring) else None
+
+    def integer_id(self) :
+        return self.id() if isinstance(self.id(), (int, long)) else None
+
+    def parent(self) :
+        return Key(*[part for pair in self._pairs[:-1] for part in pair]) if len(self._pairs) > 1 else None
+
+    def root(self) :
+        return Key(*self._pairs[0])
+
+    def urlsafe(self) :
+        return urlsafe_encode([list(pair) for pair in self._pairs])
+
+    def get(self) :
+        return get_multi([self])[0]
+
+    def get_async(self) :
+        return Future.run(self.get)
+
+    def delete(self) :
+        delete_multi([self])
+
+    def delete_async(self) :
+        return Future.run(self.delete)
+
+    def __eq__(self, other) :
+        return isinstance(other, Key) and self._pairs == other._pairs
+
+    def __ne__(self, other) :
+        return not self == other
+
+    def __lt__(self, other) :
+        return self._pairs < other._pairs
+
+    def __le__(self, other) :
+        return self._pairs <= other._pairs
+
+    def __gt__(self, other) :
+        return self._pairs > other._pairs
+
+    def __ge__(self, other) :
+        return self._pairs >= other._pairs
+
+    def __hash__(self) :
+        return hash(self._pairs)
+
+    def __repr__(self) :
+        return 'Key({})'.format(', '.join(repr(part) for part in self.flat()))
+
+
+# properties
+
+class Property(object) :
+    """A typed attribute of a Model; compared against a value it makes a query filter"""
+
+    types = None            # accepted value types, None for anything
+
+    def __init__(self, name=None, indexed=True, repeated=False, required=False, default=None, choices=None,
+                 validator=None, verbose_name=None) :
+        self._name = name
+        self._indexed = indexed
+        self._repeated = repeated
+        self._required = required
+        self._default = default
+        self._choices = choices
+        self._validator = validator
+
+    def _validate(self, value) :
+        if value is None :
+            return None
+        if self.types is not None and not isinstance(value, self.types) :
+            raise BadValueError("{} expects {}, got {!r}".format(self._name, self.types, value))
+        if self._choices is not None and value not in self._choices :
+            raise BadValueError("{} is not one of {}: {!r}".format(self._name, self._choices, value))
+        if self._validator is not None :
+            value = self._validator(self, value)
+        return value
+
+    def __get__(self, entity, cls=None) :
+        if entity is None :
+            return self
+        if self._name not in entity._values :
+            return [] if self._repeated else self._default
+        return entity._values[self._name]
+
+    def __set__(self, entity, value) :
+        if self._repeated :
+            value = [self._validate(item) for item in (value or [])]
+        else :
+            value = self._validate(value)
+        entity._values[self._name] = value
+
+    def _prepare_for_put(self, entity) :
+        pass
+
+    def _filter(self, op, value) :
+        return FilterNode(self._name, op, value)
+
+    def __eq__(self, value) :
+        return self._filter('=', value)
+
+    def __ne__(self, value) :
+        return self._filter('!=', value)
+
+    def __lt__(self, value) :
+        return self._filter('<', value)
+
+    def __le__(self, value) :
+        return self._filter('<=', value)
+
+    def __gt__(self, value) :
+        return self._filter('>', value)
+
+    def __ge__(self, value) :
+        return self._filter('>=', value)
+
+    def IN(self, values) :
+        return self._filter('in', list(values))
+
+    def __neg__(self) :
+        return Order(self._name, descending=True)
+
+    def __pos__(self) :
+        return Order(self._name)
+
+    __hash__ = object.__hash__
+
+
+class StringProperty(Property) :
+    types = basestring
+
+    def _validate(self, value) :
+        if isinstance(value, unicode) :
+            value = value.encode('utf-8')
+        return Property._validate(self, value)
+
+
+class TextProperty(StringProperty) :
+    pass
+
+
+class BlobProperty(Property) :
+    types = str
+
+
+class IntegerProperty(Property) :
+    types = (int, long)
+
+    def _validate(self, value) :
+        if isinstance(value, bool) :
+            raise BadValueError("{} expects an integer, got {!r}".format(self._name, value))
+        return Property._validate(self, value)
+
+
+class FloatProperty(Property) :
+    types = (int, long, float)
+
+    def _validate(self, value) :
+        return None if value is None else float(Property._validate(self, value))
+
+
+class BooleanProperty(Property) :
+    types = bool
+
+
+class JsonProperty(Property) :
+    pass
+
+
+class DateTimeProperty(Property) :
+    types = datetime.datetime
+
+    def __init__(self, auto_now=False, auto_now_add=False, **kwargs) :
+        Property.__init__(self, **kwargs)
+        self._auto_now = auto_now
+        self._auto_now_add = auto_now_add
+
+    def _prepare_for_put(self, entity) :
+        if self._auto_now or (self._auto_now_add and self.__get__(entity) is None) :
+            entity._values[self._name] = datetime.datetime.now()
+
+
+class KeyProperty(Property) :
+    types = Key
+
+    def __init__(self, kind=None, **kwargs) :
+        Property.__init__(self, **kwargs)
+        self._kind = kind._get_kind() if isinstance(kind, type) else kind
+
+
+# queries
+
+class FilterNode(object) :
+    """name op value"""
+
+    def __init__(self, name, op, value) :
+        self.name = name
+        self.op = op
+        self.value = value
+
+    def matches(self, values) :
+        if self.name not in values :
+            return False
+        value = values[self.name]
+        candidates = value if isinstance(value, list) else [value]
+        return any(self.compare(candidate) for candidate in candidates)
+
+    def compare(self, value) :
+        if self.op == '=' :
+            return value == self.value
+        if self.op == '!=' :
+            return value != self.value
+        if self.op == 'in' :
+            return value in self.value
+        if value is None or self.value is None :
+            return False        # inequalities only match values of the same type, never null
+        return {'<' : value < self.value, '<=' : value <= self.value,
+                '>' : value > self.value, '>=' : value >= self.value}[self.op]
+
+
+def AND(*nodes) :
+    return list(nodes)
+
+
+class Order(object) :
+    def __init__(self, name, descending=False) :
+        self.name = name
+        self.descending = descending
+
+    def reversed(self) :
+        return Order(self.name, not self.descending)
+
+
+class Descending(object) :
+    """Wraps a sort value so that it sorts the other way"""
+
+    def __init__(self, value) :
+        self.value = value
+
+    def __lt__(self, other) :
+        return other.value < self.value
+
+    def __gt__(self, other) :
+        return other.value > self.value
+
+    def __eq__(self, other) :
+        return self.value == other.value
+
+    def __le__(self, other) :
+        return not self > other
+
+    def __ge__(self, other) :
+        return not self < other
+
+    def __cmp__(self, other) :
+        return cmp(other.value, self.value)
+
+
+class Cursor(object) :
+    """A position in a query's sort order: after (or, reversed, up to and including) one entity"""
+
+    def __init__(self, urlsafe=None, values=None, key=None, inclusive=False) :
+        if urlsafe is not None :
+            data = urlsafe_decode(urlsafe)
+            try :
+                values = dict((str(name), decode_value(value)) for name, value in data['v'].items())
+                key = Key(urlsafe=data['k'])
+                inclusive = bool(data['i'])
+            except (KeyError, TypeError, AttributeError) :
+                raise BadValueError("not a cursor: {!r}".format(urlsafe))
+        self.values = values or {}
+        self.key = key
+        self.inclusive = inclusive
+
+    def urlsafe(self) :
+        return urlsafe_encode(dict(v=dict((name, encode_value(value)) for name, value in self.values.items()),
+                                   k=self.key.urlsafe(), i=self.inclusive))
+
+    def reversed(self) :
+        return Cursor(values=self.values, key=self.key, inclusive=not self.inclusive)
+
+    def __eq__(self, other) :
+        return isinstance(other, Cursor) and self.urlsafe() == other.urlsafe()
+
+    def __ne__(self, other) :
+        return not self == other
+
+
+class Query(object) :
+    """kind, ancestor, filters and orders; fetched by scanning the kind"""
+
+    def __init__(self, kind=None, ancestor=None, filters=(), orders=()) :
+        self.kind = kind
+        self.ancestor = ancestor
+        self.filters = tuple(filters)
+        self.orders = tuple(orders)
+
+    def filter(self, *nodes) :
+        flat = []
+        for node in nodes :
+            flat.extend(node if isinstance(node, list) else [node])
+        return Query(self.kind, self.ancestor, self.filters + tuple(flat), self.orders)
+
+    def order(self, *orders) :
+        orders = tuple(order if isinstance(order, Order) else Order(order._name) for order in orders)
+        return Query(self.kind, self.ancestor, self.filters, self.orders + orders)
+
+    def sort_key(self, key, values) :
+        parts = []
+        for order in self.orders :
+            value = values.get(order.name)
+            parts.append(Descending(value) if order.descending else value)
+        last_descending = self.orders[-1].descending if self.orders else False
+        parts.append(Descending(key) if last_descending else key)
+        return tuple(parts)
+
+    def matching(self) :
+        """ [(key, values)] in query order """
+        with STORE.lock :
+            stored = list(STORE.kinds.get(self.kind, {}).items())
+        ancestor = self.ancestor.pairs() if self.ancestor is not None else None
+        found = []
+        for pairs, values in stored :
+            if ancestor is not None and pairs[:len(ancestor)] != ancestor :
+                continue
+            if all(node.matches(values) for node in self.filters) :
+                found.append((Key(*[part for pair in pairs for part in pair]), values))
+        found.sort(key=lambda (key, values) : self.sort_key(key, values))
+        return found
+
+    def run(self, limit=None, offset=0, start_cursor=None, keys_only=False) :
+        """ (results, cursor after the last, more) """
+        found = self.matching()
+        if start_cursor is not None :
+            start = self.sort_key(start_cursor.key, start_cursor.values)
+            if start_cursor.inclusive :
+                found = [item for item in found if self.sort_key(*item) >= start]
+            else :
+                found = [item for item in found if self.sort_key(*item) > start]
+        found = found[offset:]
+        page = found if limit is None else found[:limit]
+        more = limit is not None and len(found) > limit
+        cursor = None
+        if page :
+            last_key, last_values = page[-1]
+            cursor = Cursor(values=dict((order.name, last_values.get(order.name)) for order in self.orders),
+                            key=last_key)
+        results = [key if keys_only else entity_from(key, values) for key, values in page]
+        return results, cursor, more
+
+    def fetch(self, limit=None, keys_only=False, offset=0, **options) :
+        return self.run(limit, offset, options.get('start_cursor'), keys_only)[0]
+
+    def fetch_async(self, limit=None, **options) :
+        return Future.run(self.fetch, limit, **options)
+
+    def fetch_page(self, page_size, start_cursor=None, keys_only=False, **options) :
+        return self.run(page_size, 0, start_cursor, keys_only)
+
+    def fetch_page_async(self, page_size, **options) :
+        return Future.run(self.fetch_page, page_size, **options)
+
+    def get(self, **options) :
+        results = self.fetch(1, **options)
+        return results[0] if results else None
+
+    def get_async(self, **options) :
+        return Future.run(self.get, **options)
+
+    def count(self, limit=None, **options) :
+        return len(self.fetch(limit, keys_only=True))
+
+    def iter(self, keys_only=False, **options) :
+        return iter(self.fetch(keys_only=keys_only))
+
+    __iter__ = iter
+
+
+# models
+
+KINDS = {}          # kind : Model subclass
+
+
+class MetaModel(type) :
+    """Names each Property after its attribute and registers the kind"""
+
+    def __init__(cls, name, bases, classdict) :
+        super(MetaModel, cls).__init__(name, bases, classdict)
+        cls._properties = {}
+        for base in reversed(cls.__mro__[1:]) :
+            cls._properties.update(getattr(base, '_properties', {}))
+        for attribute, value in classdict.items() :
+            if isinstance(value, Property) :
+                value._name = value._name or attribute
+                cls._properties[attribute] = value
+        KINDS[cls._get_kind()] = cls
+
+
+class Model(object) :
+    """An entity: a key and the values of its declared properties"""
+
+    __metaclass__ = MetaModel
+
+    def __init__(self, key=None, id=None, parent=None, **values) :
+        self._values = {}
+        if key is None and (id is not None or parent is not None) :
+            key = Key(self._get_kind(), id, parent=parent)
+        self.key = key
+        for name, prop in self._properties.items() :
+            if prop._default is not None and name not in values :
+                prop.__set__(self, prop._default)
+        self.populate(**values)
+
+    @classmethod
+    def _get_kind(cls) :
+        return cls.__name__
+
+    def populate(self, **values) :
+        for name, value in values.items() :
+            if name not in self._properties :
+                raise AttributeError("{} has no property {}".format(self._get_kind(), name))
+            setattr(self, name, value)
+
+    def to_dict(self, include=None, exclude=None) :
+        return dict((name, getattr(self, name)) for name in self._properties
+                    if (include is None or name in include) and (exclude is None or name not in exclude))
+
+    @classmethod
+    def query(cls, *filters, **options) :
+        return Query(cls._get_kind(), options.get('ancestor')).filter(*filters)
+
+    @classmethod
+    def get_by_id(cls, id, parent=None, **options) :
+        return Key(cls._get_kind(), id, parent=parent).get()
+
+    @classmethod
+    def get_by_id_async(cls, id, parent=None, **options) :
+        return Future.run(cls.get_by_id, id, parent)
+
+    @classmethod
+    def get_or_insert(cls, id, parent=None, **values) :
+        with STORE.lock :
+            entity = cls.get_by_id(id, parent)
+            if entity is None :
+                entity = cls(id=id, parent=parent, **values)
+                entity.put()
+            return entity
+
+    def put(self) :
+        return put_multi([self])[0]
+
+    def put_async(self) :
+        return Future.run(self.put)
+
+    def _pre_put_hook(self) :
+        pass
+
+    def _post_put_hook(self, future) :
+        pass
+
+    def __eq__(self, other) :
+        return type(self) is type(other) and self.key == other.key and self._values == other._values
+
+    def __ne__(self, other) :
+        return not self == other
+
+    __hash__ = object.__hash__
+
+    def __repr__(self) :
+        return '{}(key={!r}, {})'.format(self._get_kind(), self.key,
+                                         ', '.join('{}={!r}'.format(k, v) for k, v in sorted(self._values.items())))
+
+
+class Expando(Model) :
+    pass
+
+
+def entity_from(key, values) :
+    cls = KINDS.get(key.kind())
+    if cls is None :
+        raise BadRequestError("no model class for kind {}".format(key.kind()))
+    entity = cls.__new__(cls)
+    entity._values = dict((name, list(value) if isinstance(value, list) else value) for name, value in values.items())
+    entity.key = key
+    return entity
+
+
+def get_multi(keys, **options) :
+    with STORE.lock :
+        stored = [STORE.kinds.get(key.kind(), {}).get(key.pairs()) for key in keys]
+    return [entity_from(key, values) if values is not None else None for key, values in zip(keys, stored)]
+
+
+def put_multi(entities, **options) :
+    keys = []
+    with STORE.lock :
+        for entity in entities :
+            entity._pre_put_hook()
+            for prop in entity._properties.values() :
+                prop._prepare_for_put(entity)
+                if prop._required and prop.__get__(entity) is None :
+                    raise BadValueError("{} is required".format(prop._name))
+            if entity.key is None :
+                entity.key = Key(entity._get_kind(), None)
+            if entity.key.id() is None :
+                flat = entity.key.flat()[:-1] + (next(STORE.ids),)
+                entity.key = Key(*flat)
+            values = {}
+            for prop in entity._properties.values() :     # unset properties are stored as their default
+                value = prop.__get__(entity)
+                values[prop._name] = list(value) if isinstance(value, list) else value
+            STORE.kinds.setdefault(entity.key.kind(), {})[entity.key.pairs()] = values
+            keys.append(entity.key)
+    for entity, key in zip(entities, keys) :
+        entity._post_put_hook(Future(key))
+    return keys
+
+
+def delete_multi(keys, **options) :
+    with STORE.lock :
+        for key in keys :
+            STORE.kinds.get(key.kind(), {}).pop(key.pairs(), None)
+    return [None] * len(keys)
+
+
+def get_multi_async(keys, **options) :
+    return [Future.run(lambda key=key : get_multi([key])[0]) for key in keys]
+
+
+def put_multi_async(entities, **options) :
+    return [Future.run(entity.put) for entity in entities]
+
+
+def delete_multi_async(keys, **options) :
+    return [Future.run(key.delete) for key in keys]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""`standins.users` signs every request in as one Google account, set by sign_in()"""
+
+import urllib
+
+CURRENT = {'email' : None}
+
+
+class User(object) :
+    def __init__(self, email=None, _auth_domain=None, _user_id=None) :
+        self._email = email
+
+    def email(self) :
+        return self._email
+
+    def nickname(self) :
+        return self._email.split('@')[0]
+
+    def user_id(self) :
+        return str(abs(hash(self._email)))
+
+    def __eq__(self, other) :
+        return isinstance(other, User) and self._email == other._email
+
+
+def sign_in(email) :
+    """ the account get_current_user() returns from now on, None for signed out """
+    CURRENT['email'] = email
+
+
+def get_current_user() :
+    return User(CURRENT['email']) if CURRENT['email'] else None
+
+
+def is_current_user_admin() :
+    return CURRENT['email'] is not None
+
+
+def create_login_url(dest_url=None, _auth_domain=None, federated_identity=None) :
+    return '/_local/login?' + urllib.urlencode(dict(continue_url=dest_url or '/'))
+
+
+def create_logout_url(dest_url) :
+    return '/_local/logout?' + urllib.urlencode(dict(continue_url=dest_url or '/'))
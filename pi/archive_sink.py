@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""`archive_sink` optionally keeps a copy of uploaded images on the Pi's SD card, written by its own thread"""
+
+import os
+import threading
+import Queue
+
+
+class ArchiveSink(object) :
+    """Writes already encoded images to a directory; best effort, drops work rather than block anyone"""
+
+    def __init__(self, path, queue_size=16) :
+        self.path = path
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.work, name="archive-sink")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, filename, content) :
+        """ queue bytes (or a uint8 array) to be written as path/filename """
+        try :
+            self.queue.put_nowait((filename, content))
+            return True
+        except Queue.Full :
+            self.dropped += 1
+            return False
+
+    def work(self) :
+        while True :
+            job = self.queue.get()
+            try :
+                if job is None :
+                    return
+                filename, content = job
+                full_name = os.path.join(self.path, filename)
+                try :
+                    with open(full_name, 'wb') as f :
+                        f.write(content)
+                    self.written += 1
+                except IOError as error :
+                    print "archive write failed {}: {}".format(full_name, error)
+            finally :
+                self.queue.task_done()
+
+    def close(self, wait=True) :
+        if wait :
+            self.queue.join()
+        try :
+            self.queue.put_nowait(None)
+        except Queue.Full :
+            pass    # not waiting, the daemon thread dies with the process
+        if wait :
+            self.thread.join()
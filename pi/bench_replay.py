@@ -0,0 +1,120 @@
+# USAGE
+# python bench_replay.py <video file | frame directory> [--conf conf.json] [--max-frames N] [--upload] [--pipelined]
+#                        [--detector contour|block_grid] [--json out.json]
+#
+# Replays recorded yard footage through the camcorder loop as fast as possible and
+# reports end-to-end fps plus the time spent in each stage. Runs anywhere opencv does,
+# so detector changes can be compared on an x86 box against the same recording.
+
+import argparse
+import warnings
+import json
+import time
+
+from camcorder import Camcorder, load_conf, make_dedup
+from frame_source import open_frame_source
+from stage_timer import StageTimer
+from uploader import BackgroundUploader
+from pipeline import Pipeline
+from clip_recorder import ClipRecorder
+from frame_rate import AdaptiveRateController
+
+
+def replay(conf, source, max_frames=None, upload=None, pipelined=False, recorder=None) :
+    """ run the source through a Camcorder, returns (camcorder, pipeline or None, elapsed seconds) """
+    timer = StageTimer()
+    rate = AdaptiveRateController(conf) if conf.get("adaptive_rate") else None
+    camcorder = Camcorder(conf, timer=timer, upload=upload, recorder=recorder, rate=rate, dedup=make_dedup(conf))
+    pipeline = Pipeline(camcorder, conf.get("pipeline_queue_size", 2), drop_frames=False) if pipelined else None
+    start = time.time()
+    if pipeline :
+        pipeline.run(source, max_frames)
+        return camcorder, pipeline, time.time() - start
+    try :
+        for frame, timestamp in source :
+            camcorder.handle_frame(frame, timestamp)
+            if max_frames and camcorder.frame_count >= max_frames :
+                break
+    finally :
+        source.release()
+    return camcorder, None, time.time() - start
+
+
+def report(camcorder, elapsed, uploader=None, pipeline=None) :
+    """ dict of the numbers worth comparing between runs """
+    frames = camcorder.frame_count
+    return {
+        'queues' : [dict(queue=name, mean_depth=mean, capacity=size)
+                    for name, (_, mean, size) in pipeline.occupancy().items()] if pipeline else None,
+        'uploader' : uploader.summary() if uploader else None,
+        'rate_tiers' : [dict(fps=fps, seconds=seconds) for fps, seconds in camcorder.rate.summary(camcorder.last_timestamp)]
+                       if camcorder.rate else None,
+        'skipped' : camcorder.rate.skipped if camcorder.rate else 0,
+        'duplicates' : camcorder.dedup.duplicates if camcorder.dedup else 0,
+        'frames' : frames,
+        'uploads' : camcorder.upload_count,
+        'elapsed_seconds' : elapsed,
+        'fps' : frames / elapsed if elapsed else 0.0,
+        'stages' : [dict(stage=name, calls=calls, total_seconds=total, mean_ms=mean_ms)
+                    for (name, calls, total, mean_ms) in camcorder.timer.summary()],
+    }
+
+
+def print_report(result) :
+    print "frames: {frames}  skipped: {skipped}  uploads: {uploads}  duplicates: {duplicates}  elapsed: {elapsed_seconds:.2f}s  fps: {fps:.1f}".format(**result)
+    if result['rate_tiers'] :
+        print "seconds per frame rate: " + ", ".join("{fps} fps {seconds:.1f}s".format(**t) for t in result['rate_tiers'])
+    if result['uploader'] :
+        print "uploader: {submitted} submitted, {uploaded} uploaded, {dropped} dropped, {failed} failed, " \
+              "mean latency {mean_latency:.3f}s, max {max_latency:.3f}s".format(**result['uploader'])
+    if result['queues'] :
+        print "queues: " + ", ".join("{queue} {mean_depth:.1f}/{capacity}".format(**q) for q in result['queues'])
+    total = sum(s['total_seconds'] for s in result['stages']) or 1.0
+    print "{:<20} {:>8} {:>10} {:>7}".format("stage", "calls", "mean ms", "share")
+    for s in result['stages'] :
+        print "{:<20} {:>8} {:>10.3f} {:>6.1f}%".format(s['stage'], s['calls'], s['mean_ms'],
+                                                       100.0 * s['total_seconds'] / total)
+
+
+def main() :
+    ap = argparse.ArgumentParser()
+    ap.add_argument("source", help="video file or directory of recorded frames")
+    ap.add_argument("-c", "--conf", required=False,
+        help="path to the JSON configuration file")
+    ap.add_argument("-n", "--max-frames", type=int, default=None,
+        help="stop after this many frames")
+    ap.add_argument("--upload", action="store_true",
+        help="really upload motion frames, or clips with clip_upload (point upload_url in the conf at a test server)")
+    ap.add_argument("--pipelined", action="store_true",
+        help="run the stages on their own threads, as with pipelined in the conf")
+    ap.add_argument("-d", "--detector", required=False,
+        help="override the conf's detector, e.g. contour or block_grid")
+    ap.add_argument("--json", required=False,
+        help="also write the report to this file, for comparing runs")
+    args = vars(ap.parse_args())
+
+    warnings.filterwarnings("ignore")
+    conf = load_conf(args["conf"])
+    conf["show_video"] = False
+    if args["detector"] :
+        conf["detector"] = args["detector"]
+
+    source = open_frame_source(conf, args["source"])
+    uploader = BackgroundUploader(conf) if args["upload"] else None
+    recorder = ClipRecorder(conf, uploader.submit_clip) if uploader and conf.get("clip_upload") else None
+    camcorder, pipeline, elapsed = replay(conf, source, args["max_frames"],
+                                          upload=uploader.submit if uploader else None,
+                                          pipelined=args["pipelined"], recorder=recorder)
+    if recorder :
+        recorder.close()
+    if uploader :
+        uploader.close()
+    result = report(camcorder, elapsed, uploader, pipeline)
+    print_report(result)
+    if args["json"] :
+        with open(args["json"], 'w') as f :
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__" :
+    main()
@@ -1,153 +1,194 @@
 # USAGE
-# python camera.py [--conf conf.json]
-
-from picamera.array import PiRGBArray
-from picamera import PiCamera
+# python camcorder.py [--conf conf.json] [--source <video file | frame directory>]
 
 import argparse
 import warnings
-import datetime
-import imutils
 import json
-import time
+import datetime
 import cv2
-import requests
-
-# construct the argument parser and parse the arguments
-ap = argparse.ArgumentParser()
-ap.add_argument("-c", "--conf", required=False,
-    help="path to the JSON configuration file")
-args = vars(ap.parse_args())
-
-# filter warnings, load the configuration
-# client
-warnings.filterwarnings("ignore")
-print args["conf"]
-conf_file = "conf.json" if args["conf"] is None else args["conf"]
-conf = json.load(open(conf_file))
-client = None
-
-# initialize the camera and grab a reference to the raw camera capture
-camera = PiCamera()
-camera.resolution = tuple(conf["resolution"])
-camera.framerate = conf["fps"]
-rawCapture = PiRGBArray(camera, size=tuple(conf["resolution"]))
-
-# initialize reference times and counters used to throttle frame display and upload rates
-lastUploaded = datetime.datetime.now() 
-lastDisplayed = None
-motionCounter = 0
-print "[INFO] warming up...", conf["camera_warmup_time"]
-time.sleep(conf["camera_warmup_time"])
-print "[INFO] awake now"
-
-avg = None
-
-# capture frames from the camera
-for f in camera.capture_continuous(rawCapture, format="bgr", use_video_port=True):
-    # grab the raw NumPy array representing the image and initialize
-    # the timestamp and occupied/unoccupied text
-    frame = f.array
-    timestamp = datetime.datetime.now()
-    text = "Unoccupied"
-
-    # resize the frame, convert it to grayscale, and blur it
-    frame = imutils.resize(frame, width=500)
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    gray = cv2.GaussianBlur(gray, (21, 21), 0)
-
-    # if the average frame is None, initialize it
-    if avg is None:
-        print "[INFO] starting background model, initialize average."
-        avg = gray.copy().astype("float")
-        rawCapture.truncate(0)
-        continue
-
-    # accumulate the weighted average between the current frame and
-    # previous frames, then compute the difference between the current
-    # frame and running average
-    cv2.accumulateWeighted(gray, avg, 0.5)
-    frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(avg))
-
-    # threshold the delta image, dilate the thresholded image to fill
-    # in holes, then find contours on thresholded image
-    thresh = cv2.threshold(frameDelta, conf["delta_thresh"], 255,
-        cv2.THRESH_BINARY)[1]
-    thresh = cv2.dilate(thresh, None, iterations=2)
-    (cnts, _) = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL,
-        cv2.CHAIN_APPROX_SIMPLE)
-
-    # loop over the contours
-    for c in cnts:
-        # if the contour is too small, ignore it
-        if cv2.contourArea(c) < conf["min_area"]:
-            # print "ignoring contour area", cv2.contourArea(c)
-            continue
-
-        # compute the bounding box for the contour, draw it on the frame,
-        # and update the text
-        (x, y, w, h) = cv2.boundingRect(c)
-        cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
-        text = "Occupied"
-
-    # draw the text and timestamp on the frame
-    ts = timestamp.strftime("%A %d %B %Y %I:%M:%S %p")
-    cv2.putText(frame, "Yard Status: {}".format(text), (10, 20),
-        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
-    cv2.putText(frame, ts, (10, frame.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX,
-        0.35, (0, 0, 255), 1)
-
-    # check to see if the room is occupied
-    if text == "Occupied":
-        # check to see if enough time has passed between uploads
-        if (timestamp - lastUploaded).seconds >= conf["min_upload_seconds"]:
-            # increment the motion counter
-            motionCounter += 1
-
-            # check to see if the number of frames with consistent motion is
-            # high enough
-            if motionCounter >= conf["min_motion_frames"]:
-                if conf["use_web_upload"] :
-                    # filename in ISO 8601 timestamp
-                    # TBD fix ambiguous local time, or add (non-standard?) TZ
-                    base = timestamp.strftime("%Y-%m-%dT%H:%M:%S")+'.jpg'
-                    filename = "{path}/{base}".format( \
-                            path=conf["surveillance_images_path"], \
-                            base=base)
-                    # TBD opener.open() to POST....
-                    print "copy to pi file {}".format(filename)
-                    rc = cv2.imwrite(filename, frame)
-                    print "imwrite return code {}".format(rc)
-                    data = {'api' : True,  'reason' : 'upload from pi camera' }
-                    files = { 'img' : (filename, open(filename, 'rb')) }
-                    url = 'http://hello-ryan-family.appspot.com/upload_image'
-                    #url = 'http://requestb.in/1bxnies1'
-                    r = requests.post(url, data=data, files=files)
-                    print 'status:', r.status_code
-                    print 'content', r.content
-                # update the last uploaded timestamp and reset the motion
-                # counter
-                lastUploaded = timestamp
-                motionCounter = 0
-            else :
-                print "motion count {}".format(motionCounter)
-
-    # otherwise, the room is not occupied
-    else:
-        motionCounter = 0
-
-    # check to see if the frames should be displayed to screen
-    if conf["show_video"] :
-##        if lastDisplayed is None or \
-##        (timestamp - lastDisplayed).seconds >= 1.0/conf["show_video_fps"]:
+
+from frame_source import open_frame_source
+from motion_detector import make_detector, annotate
+from stage_timer import StageTimer
+from uploader import BackgroundUploader
+from pipeline import Pipeline
+from clip_recorder import ClipRecorder
+from frame_rate import AdaptiveRateController
+from phash import RecentHashes, dhash, hex_hash
+from metrics import REGISTRY
+from pinger import Pinger
+from commands import CommandPoller
+
+
+def load_conf(conf_file=None) :
+    conf_file = "conf.json" if conf_file is None else conf_file
+    return json.load(open(conf_file))
+
+
+def make_dedup(conf) :
+    """ RecentHashes per the conf, None when near duplicate suppression is off """
+    if not conf.get("dedup_hamming") :
+        return None
+    return RecentHashes(conf["dedup_hamming"], conf.get("dedup_window_seconds", 300), conf.get("dedup_history", 16))
+
+
+class Camcorder(object) :
+    """Runs frames from any frame source through motion detection and uploads the interesting ones"""
+
+    def __init__(self, conf, detector=None, timer=None, upload=None, recorder=None, rate=None, dedup=None) :
+        self.conf = conf
+        self.timer = timer or StageTimer()
+        self.detector = detector or make_detector(conf, self.timer)
+        self.upload = upload    # upload(frame, timestamp, image_hash), must return promptly, e.g. BackgroundUploader.submit
+        self.frames_reused = False  # set when frame buffers are recycled (pipelined mode), uploads then get a copy
+        self.recorder = recorder    # ClipRecorder, when set motion events are uploaded as clips instead of frames
+        self.rate = rate            # AdaptiveRateController, when set quiet periods are sampled at a lower rate
+        self.dedup = dedup          # RecentHashes, when set near duplicates of recent uploads are skipped
+
+        # reference times and counters used to throttle frame display and upload rates
+        self.lastUploaded = None
+        self.lastDisplayed = None
+        self.motionCounter = 0
+        self.frame_count = 0
+        self.last_timestamp = None
+        self.upload_count = 0
+
+    def handle_frame(self, frame, timestamp) :
+        """ detect, annotate and (maybe) upload one frame; returns the annotated frame, None while warming up or skipped """
+        if self.rate and not self.rate.should_process(timestamp) :
+            return None
+        frame, gray = self.detector.preprocess(frame)
+        boxes = self.detector.compare(gray)
+        return self.handle_detection(frame, timestamp, boxes, gray=gray)
+
+    def handle_detection(self, frame, timestamp, boxes, energy=None, gray=None) :
+        """ annotate and (maybe) upload an already resized frame, given the detector's boxes, motion energy and gray frame """
+        conf = self.conf
+        self.frame_count += 1
+        REGISTRY.inc('camcorder_frames_total')
+        self.last_timestamp = timestamp
+        if self.lastUploaded is None :
+            self.lastUploaded = timestamp
+        if boxes is None :
+            return None
+        occupied = len(boxes) > 0
+        if self.rate :
+            self.rate.update(timestamp, self.detector.motion_energy if energy is None else energy, occupied)
+
+        with self.timer.stage("annotate") :
+            annotate(frame, timestamp, boxes, occupied)
+        if self.recorder :
+            with self.timer.stage("ring buffer") :
+                self.recorder.push(frame, timestamp, occupied)
+
+        # check to see if the room is occupied
+        if occupied :
+            # check to see if enough time has passed between uploads
+            if (timestamp - self.lastUploaded).seconds >= conf["min_upload_seconds"]:
+                # increment the motion counter
+                self.motionCounter += 1
+
+                # check to see if the number of frames with consistent motion is
+                # high enough
+                if self.motionCounter >= conf["min_motion_frames"]:
+                    image_hash = None
+                    if self.dedup is not None :
+                        with self.timer.stage("dhash") :
+                            image_hash = dhash(gray if gray is not None else frame)
+                    if conf["use_web_upload"] and image_hash is not None and \
+                       self.dedup.is_duplicate(image_hash, timestamp) :
+                        print "skipping near duplicate {}".format(hex_hash(image_hash))
+                        REGISTRY.inc('camcorder_duplicates_total')
+                    elif conf["use_web_upload"] :
+                        self.upload_count += 1
+                        REGISTRY.inc('camcorder_triggers_total')
+                        if image_hash is not None :
+                            self.dedup.add(image_hash, timestamp)
+                        if self.recorder :
+                            self.recorder.trigger(timestamp)
+                        elif self.upload is not None :
+                            with self.timer.stage("upload") :
+                                self.upload(frame.copy() if self.frames_reused else frame, timestamp,
+                                            hex_hash(image_hash) if image_hash is not None else None)
+                    # update the last uploaded timestamp and reset the motion
+                    # counter
+                    self.lastUploaded = timestamp
+                    self.motionCounter = 0
+                else :
+                    print "motion count {}".format(self.motionCounter)
+
+        # otherwise, the room is not occupied
+        else:
+            self.motionCounter = 0
+        return frame
+
+    def run(self, source) :
+        """ process every frame from the source until it runs dry (the camera never does) """
+        try :
+            for frame, timestamp in source :
+                frame = self.handle_frame(frame, timestamp)
+                if frame is not None :
+                    self.show(frame, timestamp)
+        finally :
+            source.release()
+
+    def show(self, frame, timestamp) :
+        # check to see if the frames should be displayed to screen
+        if self.conf["show_video"] :
+##          if self.lastDisplayed is None or \
+##          (timestamp - self.lastDisplayed).seconds >= 1.0/conf["show_video_fps"]:
             # display the security feed
             cv2.imshow("Security Feed", frame)
-            lastDisplayed = timestamp
+            self.lastDisplayed = timestamp
             key = cv2.waitKey(1) & 0xFF
 
-        # if the `q` key is pressed, break from the lop
-        # if key == ord("q"):
-        #    break
-
-    # clear the stream in preparation for the next frame
-    rawCapture.truncate(0)
+            # if the `q` key is pressed, break from the lop
+            # if key == ord("q"):
+            #    break
+
+
+def main() :
+    # construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-c", "--conf", required=False,
+        help="path to the JSON configuration file")
+    ap.add_argument("-s", "--source", required=False,
+        help="replay a video file or a directory of frames instead of using the camera")
+    args = vars(ap.parse_args())
+
+    # filter warnings, load the configuration
+    warnings.filterwarnings("ignore")
+    print args["conf"]
+    conf = load_conf(args["conf"])
+
+    source = open_frame_source(conf, args["source"], realtime=True)
+    uploader = BackgroundUploader(conf) if conf["use_web_upload"] else None
+    recorder = ClipRecorder(conf, uploader.submit_clip) if uploader and conf.get("clip_upload") else None
+    rate = AdaptiveRateController(conf) if conf.get("adaptive_rate") else None
+    dedup = make_dedup(conf)
+    commands = CommandPoller(conf) if conf.get("command_wait_seconds") else None
+    pinger = Pinger(conf, on_commands=commands.handle if commands else None) if conf.get("ping_seconds") else None
+    try :
+        camcorder = Camcorder(conf, upload=uploader.submit if uploader else None, recorder=recorder, rate=rate,
+                              dedup=dedup)
+        if conf.get("pipelined") :
+            Pipeline(camcorder, conf.get("pipeline_queue_size", 2),
+                     report_seconds=conf.get("pipeline_report_seconds")).run(source)
+        else :
+            camcorder.run(source)
+    finally :
+        if pinger :
+            pinger.close()
+        if commands :
+            commands.close()
+        if rate :
+            print "[INFO] seconds per frame rate:", rate.summary(datetime.datetime.now())
+        if recorder :
+            recorder.close()
+        if uploader :
+            uploader.close()
+            print "[INFO] uploads:", uploader.summary()
+
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""`clip_recorder` keeps the last few seconds of frames and turns each motion event into one uploaded clip"""
+
+# The ring is a single preallocated array of frames; pushing a frame is one copy into the next slot,
+# no allocation. A motion event covers pre-roll frames already in the ring, the event itself and a
+# post-roll after the last motion. An encoder thread follows the event through the ring, copying each
+# frame out into its own scratch buffer (MJPEG in memory, or MP4 via a temporary file) and hands the
+# finished clip to the uploader as one object. If the encoder falls a whole ring behind, the
+# overwritten frames are left out of the clip.
+
+import os
+import threading
+import Queue
+import tempfile
+import numpy as np
+import cv2
+
+CLIP_FORMATS = {
+    # format : (file extension, content type)
+    'mjpeg' : ('.mjpeg', 'video/x-motion-jpeg'),
+    'mp4' : ('.mp4', 'video/mp4'),
+}
+
+
+class FrameRing(object) :
+    """Fixed capacity ring of same sized frames, addressed by an ever increasing sequence number"""
+
+    def __init__(self, capacity) :
+        self.capacity = capacity
+        self.frames = None          # (capacity, h, w, 3) uint8, allocated on the first push
+        self.times = [None] * capacity
+        self.seqs = np.full(capacity, -1, np.int64)     # sequence number held by each slot, -1 while written
+        self.head = -1              # sequence number of the newest frame
+
+    def push(self, frame, timestamp) :
+        if self.frames is None :
+            self.frames = np.empty((self.capacity,) + frame.shape, frame.dtype)
+        seq = self.head + 1
+        i = seq % self.capacity
+        self.seqs[i] = -1
+        np.copyto(self.frames[i], frame)
+        self.times[i] = timestamp
+        self.seqs[i] = seq
+        self.head = seq
+        return seq
+
+    def oldest(self) :
+        return max(0, self.head - self.capacity + 1)
+
+    def copy_out(self, seq, out) :
+        """ copy frame seq into out, returns its timestamp; None if it is (or got) overwritten meanwhile """
+        i = seq % self.capacity
+        if self.seqs[i] != seq :
+            return None
+        timestamp = self.times[i]
+        np.copyto(out, self.frames[i])
+        return timestamp if self.seqs[i] == seq else None
+
+
+class Clip(object) :
+    """One motion event, as a range of ring sequence numbers"""
+
+    def __init__(self, start, timestamp) :
+        self.start = start
+        self.end = None         # set once the post-roll has passed
+        self.timestamp = timestamp
+        self.last_motion = timestamp
+
+
+class ClipRecorder(object) :
+    """Pre-roll / post-roll ring buffer with an off-thread clip encoder"""
+
+    def __init__(self, conf, upload_clip) :
+        self.fps = conf["fps"]
+        self.pre_roll = conf.get("clip_pre_roll_seconds", 3.0)
+        self.post_roll = conf.get("clip_post_roll_seconds", 3.0)
+        self.max_seconds = conf.get("clip_max_seconds", 30.0)
+        self.format = conf.get("clip_format", "mjpeg")
+        if self.format not in CLIP_FORMATS :
+            raise ValueError("unknown clip_format: {}".format(self.format))
+        self.jpeg_quality = conf.get("jpeg_quality", 85)
+        self.upload_clip = upload_clip      # upload_clip(filename, content, content_type, timestamp)
+
+        # pre-roll plus slack for the encoder to keep up
+        buffer_seconds = conf.get("clip_buffer_seconds", self.pre_roll + 2.0)
+        self.ring = FrameRing(max(2, int(buffer_seconds * self.fps)))
+        self.pre_frames = int(self.pre_roll * self.fps)
+        self.current = None
+        self.clips = Queue.Queue()
+        self.pushed = threading.Condition()
+        self.scratch = None         # encoder's own copy of the frame being encoded
+        self.lost_frames = 0
+        self.encoded_clips = 0
+
+        self.thread = threading.Thread(target=self.work, name="clip-encoder")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # capture side, called for every frame
+
+    def push(self, frame, timestamp, occupied) :
+        """ add the frame to the ring, extend or close the current event """
+        with self.pushed :
+            seq = self.ring.push(frame, timestamp)
+            clip = self.current
+            if clip is not None :
+                if occupied :
+                    clip.last_motion = timestamp
+                if (timestamp - clip.last_motion).total_seconds() >= self.post_roll or \
+                   (timestamp - clip.timestamp).total_seconds() >= self.max_seconds :
+                    clip.end = seq
+                    self.current = None
+            self.pushed.notify()
+
+    def trigger(self, timestamp) :
+        """ motion event confirmed (the camcorder would have uploaded a frame), start a clip if none is open """
+        if self.current is not None :
+            return False
+        with self.pushed :
+            start = max(self.ring.oldest(), self.ring.head - self.pre_frames)
+            self.current = Clip(start, timestamp)
+        self.clips.put(self.current)
+        return True
+
+    # encoder side
+
+    def next_frame(self, clip, seq) :
+        """ wait until frame seq is in the ring or the clip has ended before it; False when the clip is done """
+        with self.pushed :
+            while self.ring.head < seq and (clip.end is None or clip.end >= seq) :
+                self.pushed.wait(1.0)
+        return clip.end is None or seq <= clip.end
+
+    def work(self) :
+        while True :
+            clip = self.clips.get()
+            if clip is None :
+                return
+            try :
+                self.encode(clip)
+            except Exception as error :
+                print "clip encoder error:", error
+
+    def encode(self, clip) :
+        writer = MjpegWriter(self.jpeg_quality) if self.format == 'mjpeg' else Mp4Writer(self.fps)
+        if self.scratch is None :
+            self.scratch = np.empty_like(self.ring.frames[0])
+        seq = clip.start
+        frames = 0
+        while self.next_frame(clip, seq) :
+            if seq < self.ring.oldest() :
+                self.lost_frames += self.ring.oldest() - seq
+                seq = self.ring.oldest()
+                continue
+            if self.ring.copy_out(seq, self.scratch) is not None :
+                writer.write(self.scratch)
+                frames += 1
+            else :
+                self.lost_frames += 1
+            seq += 1
+        if not frames :
+            return
+        extension, content_type = CLIP_FORMATS[self.format]
+        content = writer.finish()
+        filename = clip.timestamp.strftime("%Y-%m-%dT%H:%M:%S") + extension
+        print "[INFO] clip {} frames {} bytes {}".format(filename, frames, len(content))
+        self.encoded_clips += 1
+        self.upload_clip(filename, content, content_type, clip.timestamp)
+
+    def close(self, wait=True) :
+        with self.pushed :
+            if self.current is not None :
+                self.current.end = self.ring.head
+                self.current = None
+            self.pushed.notify_all()
+        self.clips.put(None)
+        if wait :
+            self.thread.join()
+
+
+class MjpegWriter(object) :
+    """Concatenated JPEG frames, built in memory"""
+
+    def __init__(self, quality) :
+        self.params = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)]
+        self.parts = []
+
+    def write(self, frame) :
+        ok, jpeg = cv2.imencode('.jpg', frame, self.params)
+        if ok :
+            self.parts.append(jpeg.tostring())
+
+    def finish(self) :
+        return ''.join(self.parts)
+
+
+class Mp4Writer(object) :
+    """cv2.VideoWriter only writes to files, so the clip goes through a temporary file"""
+
+    def __init__(self, fps) :
+        self.fps = fps
+        self.writer = None
+        handle, self.path = tempfile.mkstemp(suffix='.mp4')
+        os.close(handle)
+
+    def write(self, frame) :
+        if self.writer is None :
+            size = (frame.shape[1], frame.shape[0])
+            self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*'mp4v'), self.fps, size)
+        self.writer.write(frame)
+
+    def finish(self) :
+        try :
+            if self.writer is not None :
+                self.writer.release()
+            with open(self.path, 'rb') as f :
+                return f.read()
+        finally :
+            os.remove(self.path)
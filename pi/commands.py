@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""`commands` long-polls the web app for this pi's remote commands, runs them and acknowledges them"""
+
+# /rcp_get leases up to a batch of the device's commands, holding the request open up to
+# command_wait_seconds until one is queued, so a command arrives within a second or so without
+# tight polling. Each command goes to the handler; the ids that ran are acknowledged in one
+# /rcp_ack post (those that raised, in another, as failed). A command whose acknowledgement is lost
+# is leased again once its lease runs out, so handlers should not mind running one twice.
+# Commands that ride back on a /ping reply are passed to handle() the same way.
+
+import threading
+import requests
+
+from metrics import REGISTRY
+from uploader import DEFAULT_UPLOAD_URL, device_id
+
+
+def print_command(command) :
+    print "remote command:", command.get("command"), command.get("parameters")
+
+
+class CommandPoller(object) :
+    """Background long poll of the web app's /rcp_get, acknowledging through /rcp_ack"""
+
+    def __init__(self, conf, handler=print_command) :
+        self.handler = handler
+        self.wait = conf.get("command_wait_seconds", 20)
+        self.retry_seconds = conf.get("command_retry_seconds", 10)
+        base = conf.get("upload_url", DEFAULT_UPLOAD_URL).rsplit('/', 1)[0]
+        self.url = conf.get("command_url", base + '/rcp_get')
+        self.ack_url = conf.get("command_ack_url", base + '/rcp_ack')
+        self.device_id = device_id(conf)
+        connect, read = conf.get("upload_timeout", (3.05, 15))
+        self.timeout = (connect, read + self.wait)     # the server holds the poll open up to wait seconds
+        self.session = requests.Session()
+        self.lock = threading.Lock()        # handle() is also called from the pinger's thread
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.work, name="commands")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def poll(self) :
+        r = self.session.get(self.url, params=dict(device=self.device_id, wait=self.wait), timeout=self.timeout)
+        r.raise_for_status()
+        return self.handle(r.json().get("commands", []))
+
+    def handle(self, commands) :
+        """ run each command through the handler, then acknowledge them; how many ran """
+        done, failed = [], []
+        with self.lock :
+            for command in commands :
+                try :
+                    self.handler(command)
+                    done.append(command["id"])
+                except Exception as error :
+                    print "remote command {} failed: {}".format(command.get("command"), error)
+                    failed.append(command["id"])
+        REGISTRY.inc('commands_total', len(done), result='done')
+        REGISTRY.inc('commands_total', len(failed), result='failed')
+        for status, ids in (('done', done), ('failed', failed)) :
+            if ids :
+                self.session.post(self.ack_url, data=dict(device=self.device_id, status=status, id=ids),
+                                  timeout=self.timeout).raise_for_status()
+        return len(done)
+
+    def work(self) :
+        while not self.stopping.is_set() :
+            try :
+                self.poll()
+            except (requests.RequestException, ValueError) as error :
+                print "command poll error:", error
+                self.stopping.wait(self.retry_seconds)
+
+    def close(self) :
+        self.stopping.set()
+        self.thread.join(self.timeout[0])   # a poll in flight may take up to the read timeout, daemon anyway
+        self.session.close()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""`frame_rate` decides which camera frames are worth processing: few while the yard is quiet, all of them during motion"""
+
+# The camera keeps capturing at its configured fps; frames between samples are dropped before
+# any resize or blur, which is where the CPU (and heat) goes. Motion energy above rise_energy,
+# or any detected motion, jumps straight to the fastest tier so min_motion_frames is reached at
+# full rate. Energy has to stay below fall_energy for hold_seconds before dropping one tier, and
+# again for each tier after that, so a gust of wind does not make the rate flap.
+#
+# Samples are scheduled, each due one tier interval after the last was due, and a frame within half
+# a camera frame of its due time counts, so timestamp jitter does not push frames out. A tier at or
+# above the camera's fps takes every frame. In pipelined mode should_process() runs on the capture
+# thread and update() on the output thread, so the state is behind a lock.
+
+import datetime
+import threading
+
+
+class AdaptiveRateController(object) :
+    """Tiered sampling rate with hysteresis, plus time spent in each tier"""
+
+    def __init__(self, conf) :
+        settings = conf.get("adaptive_rate", {})
+        self.tiers = sorted(settings.get("tiers_fps", [1, 4, conf["fps"]]))     # slowest first
+        self.rise_energy = settings.get("rise_energy", 0.01)
+        self.fall_energy = settings.get("fall_energy", 0.002)
+        self.hold_seconds = settings.get("hold_seconds", 10.0)
+        self.camera_fps = conf["fps"]
+        self.tolerance = 0.5 / self.camera_fps     # seconds early a frame may be and still be the sample
+        self.lock = threading.Lock()
+
+        self.tier = len(self.tiers) - 1     # start at full rate while the background model settles
+        self.next_due = None        # when the next sample is due, None to take the next frame
+        self.quiet_since = None
+        self.tier_started = None
+        self.tier_seconds = [0.0] * len(self.tiers)
+        self.skipped = 0
+
+    def should_process(self, timestamp) :
+        """ called for every captured frame, False means drop it unprocessed """
+        with self.lock :
+            if self.tier_started is None :
+                self.tier_started = timestamp
+            fps = self.tiers[self.tier]
+            if fps >= self.camera_fps :
+                return True
+            interval = datetime.timedelta(seconds=1.0 / fps)
+            if self.next_due is not None and \
+               (self.next_due - timestamp).total_seconds() > self.tolerance :
+                self.skipped += 1
+                return False
+            # keep to the schedule, unless the frames fell a whole interval behind it
+            if self.next_due is None or timestamp - self.next_due >= interval :
+                self.next_due = timestamp + interval
+            else :
+                self.next_due += interval
+            return True
+
+    def update(self, timestamp, energy, occupied) :
+        """ called with the detector's result for every processed frame """
+        with self.lock :
+            self.update_locked(timestamp, energy, occupied)
+
+    def update_locked(self, timestamp, energy, occupied) :
+        if occupied or energy >= self.rise_energy :
+            self.quiet_since = None
+            self.set_tier(len(self.tiers) - 1, timestamp)
+        elif energy < self.fall_energy :
+            if self.quiet_since is None :
+                self.quiet_since = timestamp
+            elif self.tier > 0 and (timestamp - self.quiet_since).total_seconds() >= self.hold_seconds :
+                self.set_tier(self.tier - 1, timestamp)
+                self.quiet_since = timestamp    # hold again before the next step down
+        else :
+            self.quiet_since = None     # between thresholds, stay put
+
+    def set_tier(self, tier, timestamp) :
+        if tier == self.tier :
+            return
+        self.account(timestamp)
+        print "[INFO] frame rate {} -> {} fps".format(self.tiers[self.tier], self.tiers[tier])
+        self.tier = tier
+        self.next_due = None
+
+    def account(self, timestamp) :
+        if self.tier_started is not None :
+            self.tier_seconds[self.tier] += max(0.0, (timestamp - self.tier_started).total_seconds())
+        self.tier_started = timestamp
+
+    def fps(self) :
+        with self.lock :
+            return self.tiers[self.tier]
+
+    def summary(self, timestamp=None) :
+        """ list of (tier fps, seconds spent at that rate) """
+        with self.lock :
+            if timestamp is not None :
+                self.account(timestamp)
+            return zip(self.tiers, self.tier_seconds)
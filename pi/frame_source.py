@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""`frame_source` abstracts where camcorder frames come from: a live PiCamera, a recorded video or a directory of frames"""
+
+# Every source is iterable and yields (frame, timestamp) pairs, frame being a BGR NumPy array.
+# Recorded sources synthesize timestamps from the recording so that min_upload_seconds etc. behave
+# as they did in the yard, not as fast as an x86 box can replay them.
+
+import os
+import glob
+import time
+import datetime
+import cv2
+
+FRAME_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+FRAME_NAME_FORMAT = "%Y-%m-%dT%H:%M:%S"     # camcorder names captured images by ISO 8601 timestamp
+
+
+class FrameSource(object) :
+    """Base class, iterate to get (frame, timestamp) pairs"""
+
+    def frames(self) :
+        raise NotImplementedError
+
+    def release(self) :
+        """ give back the camera, file handle, etc. """
+        pass
+
+    def __iter__(self) :
+        return self.frames()
+
+
+class PiCameraSource(FrameSource) :
+    """Live frames from the Pi camera module"""
+
+    def __init__(self, resolution, fps, warmup_time=0) :
+        # imported here so that replay works on machines without a camera module
+        from picamera.array import PiRGBArray
+        from picamera import PiCamera
+
+        self.camera = PiCamera()
+        self.camera.resolution = tuple(resolution)
+        self.camera.framerate = fps
+        self.raw_capture = PiRGBArray(self.camera, size=tuple(resolution))
+        print "[INFO] warming up...", warmup_time
+        time.sleep(warmup_time)
+        print "[INFO] awake now"
+
+    def frames(self) :
+        for f in self.camera.capture_continuous(self.raw_capture, format="bgr", use_video_port=True):
+            yield f.array, datetime.datetime.now()
+            # clear the stream in preparation for the next frame
+            self.raw_capture.truncate(0)
+
+    def release(self) :
+        self.camera.close()
+
+
+class VideoFileSource(FrameSource) :
+    """Frames from a recorded video file, timestamps derived from the recording's frame rate"""
+
+    def __init__(self, path, fps=None, start_time=None, realtime=False) :
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened() :
+            raise IOError("cannot open video file: {}".format(path))
+        recorded_fps = self.capture.get(cv2.CAP_PROP_FPS)
+        self.fps = fps or recorded_fps or 16.0
+        self.start_time = start_time or datetime.datetime.fromtimestamp(os.path.getmtime(path))
+        self.realtime = realtime
+
+    def frames(self) :
+        index = 0
+        while True :
+            ok, frame = self.capture.read()
+            if not ok :
+                break
+            yield frame, self.start_time + datetime.timedelta(seconds=index / self.fps)
+            index += 1
+            if self.realtime :
+                time.sleep(1.0 / self.fps)
+
+    def release(self) :
+        self.capture.release()
+
+
+class FrameDirectorySource(FrameSource) :
+    """Frames from a directory of still images, in file name order"""
+
+    def __init__(self, path, fps=16.0, start_time=None, realtime=False) :
+        self.paths = sorted(p for p in glob.glob(os.path.join(path, '*'))
+                            if os.path.splitext(p)[1].lower() in FRAME_EXTENSIONS)
+        if not self.paths :
+            raise IOError("no frames found in directory: {}".format(path))
+        self.fps = fps
+        self.start_time = start_time or datetime.datetime.now()
+        self.realtime = realtime
+
+    def frame_time(self, path, index) :
+        """ captured images are named by timestamp, anything else is spaced out at fps """
+        base = os.path.splitext(os.path.basename(path))[0]
+        try :
+            return datetime.datetime.strptime(base, FRAME_NAME_FORMAT)
+        except ValueError :
+            return self.start_time + datetime.timedelta(seconds=index / float(self.fps))
+
+    def frames(self) :
+        for index, path in enumerate(self.paths) :
+            frame = cv2.imread(path)
+            if frame is None :
+                print "[WARN] skipping unreadable frame", path
+                continue
+            yield frame, self.frame_time(path, index)
+            if self.realtime :
+                time.sleep(1.0 / self.fps)
+
+
+def open_frame_source(conf, source=None, realtime=False) :
+    """ a directory or video file path replays recorded frames, no path means the live camera """
+    if source is None :
+        return PiCameraSource(conf["resolution"], conf["fps"], conf["camera_warmup_time"])
+    if os.path.isdir(source) :
+        return FrameDirectorySource(source, fps=conf["fps"], realtime=realtime)
+    return VideoFileSource(source, realtime=realtime)
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""`motion_detector` finds motion against a running average of previous frames"""
+
+# Two interchangeable detectors, picked by "detector" in conf.json so they can be A/B'd with bench_replay.py:
+#   contour     - blur, threshold and contour search on every 500px frame (the original)
+#   block_grid  - mean difference per block on a tiny frame, contours only once enough blocks move
+
+import numpy as np
+import cv2
+
+from stage_timer import StageTimer
+
+DETECT_WIDTH = 500      # frames are resized to this width (keeping aspect) before detection
+
+
+class ContourMotionDetector(object) :
+    """Blur, background difference, threshold and contour search (the original camcorder detector)"""
+
+    def __init__(self, conf, timer=None) :
+        self.delta_thresh = conf["delta_thresh"]
+        self.min_area = conf["min_area"]
+        self.timer = timer or StageTimer()
+        self.avg = None
+        self.motion_energy = 0.0    # fraction of pixels over delta_thresh in the latest frame
+
+    def detect(self, frame) :
+        """ returns (resized frame, bounding boxes of motion); None for boxes while the background warms up """
+        frame, gray = self.preprocess(frame)
+        return frame, self.compare(gray)
+
+    def preprocess(self, frame, buffers=None) :
+        """ returns (resized frame, blurred gray frame); written into buffers=(frame, gray) when given """
+        timer = self.timer
+        small, gray = buffers if buffers is not None else (None, None)
+
+        # resize the frame, convert it to grayscale, and blur it
+        with timer.stage("resize") :
+            (h, w) = frame.shape[:2]
+            size = (DETECT_WIDTH, int(h * DETECT_WIDTH / float(w)))
+            small = cv2.resize(frame, size, dst=small, interpolation=cv2.INTER_AREA)
+        with timer.stage("cvtColor") :
+            gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=gray)
+        with timer.stage("GaussianBlur") :
+            gray = cv2.GaussianBlur(gray, (21, 21), 0, dst=gray)
+        return small, gray
+
+    def compare(self, gray) :
+        """ bounding boxes of motion against the running average, None while it warms up """
+        timer = self.timer
+
+        # if the average frame is None, initialize it
+        if self.avg is None :
+            print "[INFO] starting background model, initialize average."
+            self.avg = gray.copy().astype("float")
+            return None
+
+        # accumulate the weighted average between the current frame and
+        # previous frames, then compute the difference between the current
+        # frame and running average
+        with timer.stage("accumulateWeighted") :
+            cv2.accumulateWeighted(gray, self.avg, 0.5)
+            frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(self.avg))
+
+        # threshold the delta image, dilate the thresholded image to fill
+        # in holes, then find contours on thresholded image
+        with timer.stage("threshold/dilate") :
+            thresh = cv2.threshold(frameDelta, self.delta_thresh, 255, cv2.THRESH_BINARY)[1]
+            self.motion_energy = cv2.countNonZero(thresh) / float(thresh.size)
+            thresh = cv2.dilate(thresh, None, iterations=2)
+        with timer.stage("findContours") :
+            cnts = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+            # ignore contours that are too small, keep the bounding box of the rest
+            boxes = [cv2.boundingRect(c) for c in cnts if cv2.contourArea(c) >= self.min_area]
+        return boxes
+
+
+def annotate(frame, timestamp, boxes, occupied) :
+    """ draw the motion boxes, yard status and timestamp on the frame """
+    for (x, y, w, h) in boxes or [] :
+        cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+    text = "Occupied" if occupied else "Unoccupied"
+    ts = timestamp.strftime("%A %d %B %Y %I:%M:%S %p")
+    cv2.putText(frame, "Yard Status: {}".format(text), (10, 20),
+        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
+    cv2.putText(frame, ts, (10, frame.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX,
+        0.35, (0, 0, 255), 1)
+    return frame
+
+
+class BlockGridMotionDetector(object) :
+    """Motion energy per block of a heavily downscaled frame, with region of interest masks"""
+
+    def __init__(self, conf, timer=None) :
+        self.grid_width = conf.get("grid_width", 128)       # detection frame width, pixels
+        self.block = conf.get("grid_block", 8)              # block side, pixels of the detection frame
+        self.block_thresh = conf.get("block_delta_thresh", conf["delta_thresh"])  # mean abs difference per block
+        self.delta_thresh = conf["delta_thresh"]
+        self.min_area = conf["min_area"]                    # in pixels of the 500px frame, as for contours
+        self.mask_image = conf.get("motion_mask")           # white counts, black is ignored
+        self.ignore_regions = conf.get("ignore_regions", [])  # [x, y, w, h] as fractions of the frame
+        self.timer = timer or StageTimer()
+        self.avg = None
+        self.grid_size = None       # (width, height) of the detection frame
+        self.pixel_mask = None      # uint8 0/255 at detection resolution
+        self.block_mask = None      # bool per block
+        self.motion_energy = 0.0    # fraction of unmasked blocks moving in the latest frame
+
+    def setup(self, frame_shape) :
+        """ size the grid and build the masks from the first frame """
+        (h, w) = frame_shape[:2]
+        rows = max(1, int(round(h * self.grid_width / float(w) / self.block)))
+        self.grid_size = (self.grid_width - self.grid_width % self.block, rows * self.block)
+        (gw, gh) = self.grid_size
+
+        if self.mask_image :
+            mask = cv2.imread(self.mask_image, cv2.IMREAD_GRAYSCALE)
+            if mask is None :
+                raise IOError("cannot read motion_mask: {}".format(self.mask_image))
+            mask = cv2.resize(mask, self.grid_size, interpolation=cv2.INTER_AREA)
+            mask = np.where(mask > 127, 255, 0).astype(np.uint8)
+        else :
+            mask = np.full((gh, gw), 255, np.uint8)
+        for (x, y, rw, rh) in self.ignore_regions :
+            mask[int(y * gh):int(round((y + rh) * gh)), int(x * gw):int(round((x + rw) * gw))] = 0
+        self.pixel_mask = mask
+        self.block_mask = self.blocks(mask) > 127
+
+        # min_area and boxes are in 500px frame pixels
+        self.scale = DETECT_WIDTH / float(gw)
+        self.min_blocks = self.min_area / (self.scale * self.block) ** 2
+
+    def blocks(self, image) :
+        """ mean of each block, as a (rows, cols) float array """
+        (gw, gh) = self.grid_size
+        b = self.block
+        return image.reshape(gh // b, b, gw // b, b).mean(axis=(1, 3))
+
+    def detect(self, frame) :
+        """ returns (resized frame, bounding boxes of motion); None for boxes while the background warms up """
+        frame, gray = self.preprocess(frame)
+        return frame, self.compare(gray)
+
+    def preprocess(self, frame, buffers=None) :
+        """ returns (resized frame, tiny gray frame); written into buffers=(frame, gray) when given """
+        timer = self.timer
+        small, gray = buffers if buffers is not None else (None, None)
+        if self.grid_size is None :
+            self.setup(frame.shape)
+
+        # the 500px frame is still what gets annotated and uploaded, detection only sees the tiny one
+        with timer.stage("resize") :
+            (h, w) = frame.shape[:2]
+            size = (DETECT_WIDTH, int(h * DETECT_WIDTH / float(w)))
+            small = cv2.resize(frame, size, dst=small, interpolation=cv2.INTER_AREA)
+            tiny = cv2.resize(small, self.grid_size, interpolation=cv2.INTER_AREA)
+        with timer.stage("cvtColor") :
+            gray = cv2.cvtColor(tiny, cv2.COLOR_BGR2GRAY, dst=gray)
+        return small, gray
+
+    def compare(self, gray) :
+        """ bounding boxes of motion against the running average, None while it warms up """
+        timer = self.timer
+
+        if self.avg is None :
+            print "[INFO] starting background model, initialize average."
+            self.avg = gray.astype("float")
+            return None
+
+        with timer.stage("accumulateWeighted") :
+            cv2.accumulateWeighted(gray, self.avg, 0.5)
+            frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(self.avg))
+
+        with timer.stage("blockEnergy") :
+            active = (self.blocks(frameDelta) > self.block_thresh) & self.block_mask
+            moving = np.count_nonzero(active)
+            self.motion_energy = moving / float(np.count_nonzero(self.block_mask) or 1)
+        if moving < self.min_blocks :
+            return []
+
+        # enough of the grid moved, now find where, only within the moving blocks
+        with timer.stage("findContours") :
+            b = self.block
+            region = np.repeat(np.repeat(active, b, axis=0), b, axis=1)
+            thresh = cv2.threshold(frameDelta, self.delta_thresh, 255, cv2.THRESH_BINARY)[1]
+            thresh &= self.pixel_mask
+            thresh[~region] = 0
+            thresh = cv2.dilate(thresh, None, iterations=1)
+            cnts = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+            s = self.scale
+            boxes = [tuple(int(v * s) for v in cv2.boundingRect(c)) for c in cnts
+                     if cv2.contourArea(c) * s * s >= self.min_area]
+        return boxes
+
+
+DETECTORS = {
+    'contour' : ContourMotionDetector,
+    'block_grid' : BlockGridMotionDetector,
+}
+
+
+def make_detector(conf, timer=None) :
+    """ the detector named by "detector" in the conf, contour by default """
+    name = conf.get("detector", "contour")
+    if name not in DETECTORS :
+        raise ValueError("unknown detector: {}".format(name))
+    return DETECTORS[name](conf, timer)
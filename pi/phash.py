@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""`phash` perceptual (difference) hashes, to skip uploading the same sleeping cat every few seconds"""
+
+# dHash: shrink to 9x8, compare each pixel with its right hand neighbour, 64 bits.
+# Nearly identical frames differ in a few bits; the Hamming distance measures how few.
+# The web app gets the hash as a 16 hex digit string and does the same check across cameras.
+
+from collections import deque
+import numpy as np
+import cv2
+
+
+def dhash(gray, size=8) :
+    """ 64 bit (for size 8) difference hash of a gray (or BGR) frame, as an int """
+    if gray.ndim == 3 :
+        gray = cv2.cvtColor(cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    else :
+        gray = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = gray[:, 1:] > gray[:, :-1]
+    return int(np.packbits(bits).tostring().encode('hex'), 16)
+
+
+def hex_hash(value) :
+    return '{:016x}'.format(value)
+
+
+def hamming(a, b) :
+    return bin(a ^ b).count('1')
+
+
+class RecentHashes(object) :
+    """Hashes of recent uploads, to spot near duplicates"""
+
+    def __init__(self, max_distance=6, window_seconds=300, history=16) :
+        self.max_distance = max_distance
+        self.window_seconds = window_seconds
+        self.recent = deque(maxlen=history)     # (timestamp, hash), newest last
+        self.duplicates = 0
+
+    def is_duplicate(self, value, timestamp) :
+        """ True if within max_distance bits of an upload in the last window_seconds """
+        for (seen, other) in self.recent :
+            if (timestamp - seen).total_seconds() <= self.window_seconds and \
+               hamming(value, other) <= self.max_distance :
+                self.duplicates += 1
+                return True
+        return False
+
+    def add(self, value, timestamp) :
+        self.recent.append((timestamp, value))
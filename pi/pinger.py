@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""`pinger` checks in with the web app every ping_seconds, carrying a compact metrics summary"""
+
+# The web app's /ping is the device heartbeat. The POST carries the device id and the metrics
+# registry's summary() as one JSON form field, a few hundred bytes. It runs on its own thread over
+# its own session so a slow server never holds up capture or uploads; a failed ping is printed
+# and otherwise forgotten, the next one carries the (cumulative) numbers anyway. Commands leased
+# to the pi in the reply go to on_commands (CommandPoller.handle), when given.
+
+import json
+import threading
+import requests
+
+from metrics import REGISTRY
+from uploader import DEFAULT_UPLOAD_URL, device_id
+
+
+class Pinger(object) :
+    """Background heartbeat to the web app's /ping"""
+
+    def __init__(self, conf, metrics=REGISTRY, on_commands=None) :
+        self.metrics = metrics
+        self.on_commands = on_commands
+        self.interval = conf.get("ping_seconds", 60)
+        self.url = conf.get("ping_url", conf.get("upload_url", DEFAULT_UPLOAD_URL).rsplit('/', 1)[0] + '/ping')
+        self.device_id = device_id(conf)
+        self.timeout = tuple(conf.get("upload_timeout", (3.05, 15)))
+        self.session = requests.Session()
+        self.last_response = None
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.work, name="pinger")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def ping(self) :
+        data = dict(device=self.device_id,
+                    metrics=json.dumps(self.metrics.summary(), separators=(',', ':'), sort_keys=True))
+        r = self.session.post(self.url, data=data, timeout=self.timeout)
+        self.last_response = r.content
+        if self.on_commands and r.ok :
+            try :
+                commands = r.json().get("commands")
+            except ValueError :
+                commands = None     # an older web app answers with plain text
+            if commands :
+                self.on_commands(commands)
+        return r
+
+    def work(self) :
+        while not self.stopping.wait(self.interval) :
+            try :
+                self.ping()
+            except requests.RequestException as error :
+                print "ping error:", error
+
+    def close(self) :
+        self.stopping.set()
+        self.thread.join()
+        self.session.close()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""`pipeline` runs the camcorder stages on their own threads, joined by small bounded queues"""
+
+# capture -> preprocess (resize, gray, blur) -> detect (background model, contours) -> output (annotate, upload, display)
+#
+# Most cv2 calls release the GIL, so on a four core Pi the stages overlap and sustained fps
+# approaches the camera's. Frames travel in preallocated slots that are recycled once the output
+# stage is done with them. When the preprocess queue is full (the stages behind it are busy) the
+# capture stage drops the new frame, handing its slot straight back, rather than fall behind the
+# camera. The output stage runs on the calling (main) thread so cv2.imshow works.
+
+import threading
+import Queue
+import time
+from collections import OrderedDict
+
+END = None      # passed down the queues when the source runs dry
+
+
+class FrameSlot(object) :
+    """One preallocated set of buffers travelling down the pipeline"""
+    __slots__ = ('raw', 'frame', 'gray', 'timestamp', 'boxes', 'energy')
+
+    def __init__(self) :
+        self.raw = None         # camera frame, as delivered
+        self.frame = None       # resized frame, preallocated on first use
+        self.gray = None        # blurred gray frame, preallocated on first use
+        self.timestamp = None
+        self.boxes = None
+        self.energy = None
+
+
+class Pipeline(object) :
+    """Pipelined alternative to Camcorder.run()"""
+
+    def __init__(self, camcorder, queue_size=2, report_seconds=None, drop_frames=True) :
+        self.camcorder = camcorder
+        self.detector = camcorder.detector
+        self.camcorder.frames_reused = True
+        self.report_seconds = report_seconds
+        self.drop_frames = drop_frames      # False when replaying, wait for a slot instead
+
+        self.queues = OrderedDict((name, Queue.Queue(maxsize=queue_size)) for name in ('preprocess', 'detect', 'output'))
+        self.occupancy_totals = dict((name, 0) for name in self.queues)
+        self.occupancy_samples = 0
+
+        # enough slots for every queue to be full with one frame in hand at each stage
+        self.free = Queue.Queue()
+        for _ in range(len(self.queues) * (queue_size + 1) + 1) :
+            self.free.put(FrameSlot())
+
+        self.captured = 0
+        self.dropped = 0
+        self.stopping = threading.Event()
+
+    def start(self, name, target, *args) :
+        thread = threading.Thread(target=target, args=args, name="pipeline-" + name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def capture(self, source) :
+        try :
+            for frame, timestamp in source :
+                if self.stopping.is_set() :
+                    break
+                self.captured += 1
+                rate = self.camcorder.rate
+                if rate and not rate.should_process(timestamp) :
+                    continue
+                try :
+                    slot = self.free.get(block=not self.drop_frames)
+                except Queue.Empty :
+                    self.dropped += 1     # pipeline is behind the camera
+                    continue
+                slot.raw, slot.timestamp = frame, timestamp
+                try :
+                    self.queues['preprocess'].put(slot, block=not self.drop_frames)
+                except Queue.Full :
+                    slot.raw = None
+                    self.free.put(slot)
+                    self.dropped += 1     # pipeline is behind the camera
+        finally :
+            self.queues['preprocess'].put(END)
+
+    def preprocess(self) :
+        while True :
+            slot = self.queues['preprocess'].get()
+            if slot is not END :
+                buffers = (slot.frame, slot.gray) if slot.frame is not None else None
+                slot.frame, slot.gray = self.detector.preprocess(slot.raw, buffers)
+                slot.raw = None
+            self.queues['detect'].put(slot)
+            if slot is END :
+                return
+
+    def detect(self) :
+        while True :
+            slot = self.queues['detect'].get()
+            if slot is not END :
+                slot.boxes = self.detector.compare(slot.gray)
+                slot.energy = self.detector.motion_energy
+            self.queues['output'].put(slot)
+            if slot is END :
+                return
+
+    def sample_occupancy(self) :
+        for name, queue in self.queues.items() :
+            self.occupancy_totals[name] += queue.qsize()
+        self.occupancy_samples += 1
+
+    def occupancy(self) :
+        """ per hand-off queue (current depth, mean depth, capacity); a queue that stays full feeds the bottleneck """
+        samples = self.occupancy_samples or 1
+        return OrderedDict((name, (queue.qsize(), self.occupancy_totals[name] / float(samples), queue.maxsize))
+                           for name, queue in self.queues.items())
+
+    def report(self) :
+        print "[INFO] pipeline captured {} dropped {} queues {}".format(self.captured, self.dropped,
+            ", ".join("{} {:.1f}/{}".format(name, mean, size) for name, (_, mean, size) in self.occupancy().items()))
+
+    def run(self, source, max_frames=None) :
+        """ process frames until the source runs dry (or max_frames); output stage on this thread """
+        self.start('capture', self.capture, source)
+        self.start('preprocess', self.preprocess)
+        self.start('detect', self.detect)
+        last_report = time.time()
+        try :
+            while True :
+                slot = self.queues['output'].get()
+                if slot is END :
+                    break
+                self.sample_occupancy()
+                frame = self.camcorder.handle_detection(slot.frame, slot.timestamp, slot.boxes, slot.energy, slot.gray)
+                if frame is not None :
+                    self.camcorder.show(frame, slot.timestamp)
+                slot.boxes = None
+                self.free.put(slot)
+                if max_frames and self.camcorder.frame_count >= max_frames :
+                    break
+                if self.report_seconds and time.time() - last_report >= self.report_seconds :
+                    self.report()
+                    last_report = time.time()
+        finally :
+            self.stopping.set()
+            self.drain()
+            source.release()
+
+    def drain(self) :
+        """ after stopping, keep recycling slots until the END marker comes through so no stage is left blocked """
+        while True :
+            try :
+                slot = self.queues['output'].get(timeout=1.0)
+            except Queue.Empty :
+                return
+            if slot is END :
+                return
+            self.free.put(slot)
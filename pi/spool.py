@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""`spool` keeps uploads the web app could not take in a local SQLite file, and backfills them later"""
+
+# When an upload runs out of retries (Wi-Fi down, the web app unreachable) the uploader puts it here
+# rather than drop it: the encoded bytes with their capture time, dhash and reason, one row each.
+# The file is SQLite in WAL mode with synchronous=FULL, so a put has reached the SD card before it
+# returns and a crash or power cut loses nothing already spooled. The rows' content is kept within
+# max_bytes by evicting the oldest first. A BackfillWorker drains the spool oldest first, images in
+# batches of up to backfill_batch_max per POST and clips one at a time, with at least
+# backfill_interval seconds between POSTs so a long backlog never hogs the uplink, backing off while
+# the web app stays out of reach. A row is only deleted once the web app has answered for it. Each
+# carries its capture time, so its incident is logged as when it happened, not when it arrived.
+
+import collections
+import os
+import sqlite3
+import threading
+
+from metrics import REGISTRY
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+EVICT_ROWS = 64             # oldest rows looked at per eviction query
+
+# what deliver() made of a batch
+SENT = "sent"               # the web app has them
+REFUSED = "refused"         # the web app will never take them (4xx), dropped
+UNREACHABLE = "unreachable" # try again later
+
+Spooled = collections.namedtuple('Spooled', 'id filename content content_type captured dhash reason')
+
+
+def is_clip(content_type) :
+    return (content_type or '').startswith('video/')
+
+
+class Spool(object) :
+    """Uploads waiting for the web app, oldest first, in a SQLite file of bounded content size"""
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES) :
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()        # one connection, shared by the upload workers and the backfill
+        self.added = threading.Event()      # set by put(), wakes the backfill worker
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory) :
+            os.makedirs(directory)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        with self.db :
+            self.db.execute("CREATE TABLE IF NOT EXISTS pending (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                            " filename TEXT, content BLOB, content_type TEXT, captured REAL, dhash TEXT,"
+                            " reason TEXT, size INTEGER)")
+        self.rows, self.bytes = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pending").fetchone()
+        self.report()
+
+    def report(self) :
+        REGISTRY.set('spool_depth', self.rows)
+        REGISTRY.set('spool_bytes', self.bytes)
+
+    def put(self, items) :
+        """ spool (filename, content, content_type, captured, dhash, reason) tuples in one transaction,
+            evicting the oldest rows to make room; returns how many rows (new ones too big included) were dropped """
+        rows = []
+        dropped = 0
+        for filename, content, content_type, captured, image_hash, reason in items :
+            content = content.tobytes() if hasattr(content, 'tobytes') else bytes(content)
+            if len(content) > self.max_bytes :
+                dropped += 1
+                continue
+            rows.append((filename, sqlite3.Binary(content), content_type, captured, image_hash, reason, len(content)))
+        with self.lock :
+            with self.db :
+                need = self.bytes + sum(row[-1] for row in rows) - self.max_bytes
+                while need > 0 :
+                    oldest = self.db.execute("SELECT id, size FROM pending ORDER BY id LIMIT ?", (EVICT_ROWS,)).fetchall()
+                    if not oldest :
+                        break
+                    evicted = []
+                    for row_id, size in oldest :
+                        if need <= 0 :
+                            break
+                        evicted.append(row_id)
+                        need -= size
+                        self.bytes -= size
+                    self.db.executemany("DELETE FROM pending WHERE id = ?", [(row_id,) for row_id in evicted])
+                    self.rows -= len(evicted)
+                    dropped += len(evicted)
+                self.db.executemany("INSERT INTO pending (filename, content, content_type, captured, dhash, reason, size)"
+                                    " VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                self.rows += len(rows)
+                self.bytes += sum(row[-1] for row in rows)
+            self.report()
+        if dropped :
+            REGISTRY.inc('spool_evicted_total', dropped)
+        if rows :
+            self.added.set()
+        return dropped
+
+    def oldest(self, limit) :
+        """ up to limit of the oldest rows, as Spooled """
+        with self.lock :
+            rows = self.db.execute("SELECT id, filename, content, content_type, captured, dhash, reason"
+                                   " FROM pending ORDER BY id LIMIT ?", (limit,)).fetchall()
+        return [Spooled(row_id, filename, bytes(content), content_type, captured, image_hash, reason)
+                for row_id, filename, content, content_type, captured, image_hash, reason in rows]
+
+    def remove(self, ids) :
+        with self.lock :
+            with self.db :
+                sizes = [self.db.execute("SELECT size FROM pending WHERE id = ?", (row_id,)).fetchone() for row_id in ids]
+                self.db.executemany("DELETE FROM pending WHERE id = ?", [(row_id,) for row_id in ids])
+            found = [size[0] for size in sizes if size is not None]
+            self.rows -= len(found)
+            self.bytes -= sum(found)
+            self.report()
+
+    def depth(self) :
+        return self.rows
+
+    def close(self) :
+        with self.lock :
+            self.db.close()
+
+
+class BackfillWorker(object) :
+    """Background drain of a Spool through deliver(rows), which returns SENT, REFUSED or UNREACHABLE"""
+
+    def __init__(self, conf, spool, deliver) :
+        self.spool = spool
+        self.deliver = deliver
+        self.batch_max = max(1, conf.get("backfill_batch_max", 6))
+        self.interval = conf.get("backfill_interval", 2.0)
+        self.max_backoff = conf.get("backfill_max_backoff", 300)
+        self.idle_seconds = conf.get("backfill_idle_seconds", 30)  # looks at an empty spool this often anyway
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.work, name="backfill")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def next_batch(self) :
+        """ the oldest clip alone, or the oldest run of images sharing a reason """
+        rows = self.spool.oldest(self.batch_max)
+        if not rows or is_clip(rows[0].content_type) :
+            return rows[:1]
+        batch = []
+        for row in rows :
+            if is_clip(row.content_type) or row.reason != rows[0].reason :
+                break
+            batch.append(row)
+        return batch
+
+    def work(self) :
+        backoff = 0
+        while not self.stopping.is_set() :
+            rows = self.next_batch()
+            if not rows :
+                self.spool.added.wait(self.idle_seconds)
+                self.spool.added.clear()
+                continue
+            outcome = self.deliver(rows)
+            if outcome == UNREACHABLE :
+                backoff = min(max(2 * backoff, self.interval), self.max_backoff)
+                self.stopping.wait(backoff)
+                continue
+            backoff = 0
+            self.spool.remove([row.id for row in rows])
+            REGISTRY.inc('spool_{}_total'.format(outcome), len(rows))
+            self.stopping.wait(self.interval)
+
+    def close(self) :
+        self.stopping.set()
+        self.spool.added.set()
+        self.thread.join()
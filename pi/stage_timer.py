@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""`stage_timer` accumulates wall clock time spent in each named stage of the camcorder loop"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+from metrics import REGISTRY
+
+
+class StageTimer(object) :
+    """Per stage totals and counts, cheap enough to leave on in the capture loop, safe across pipeline threads"""
+
+    def __init__(self) :
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.counts = {}
+        self.order = []     # stages in first seen order, for reporting
+
+    @contextmanager
+    def stage(self, name) :
+        start = time.time()
+        try :
+            yield
+        finally :
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds) :
+        with self.lock :
+            if name not in self.totals :
+                self.totals[name] = 0.0
+                self.counts[name] = 0
+                self.order.append(name)
+            self.totals[name] += seconds
+            self.counts[name] += 1
+        REGISTRY.observe('camcorder_stage_seconds', seconds, stage=name)
+
+    def reset(self) :
+        with self.lock :
+            self.totals.clear()
+            self.counts.clear()
+            del self.order[:]
+
+    def summary(self) :
+        """ list of (stage, calls, total seconds, mean milliseconds) """
+        with self.lock :
+            return [(name, self.counts[name], self.totals[name], 1000.0 * self.totals[name] / self.counts[name])
+                    for name in self.order]
@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+"""`uploader` moves image uploads off the capture thread onto a small pool of worker threads"""
+
+# Frames are handed to a bounded queue; workers drain it over one shared keep-alive
+# requests.Session so the TLS handshake is paid once, not once per motion hit.
+# Timeouts, retries and backoff all happen on the workers, never on the capture thread.
+# With spool_path set, uploads that run out of retries are kept on disk and backfilled later
+# (see spool.py) instead of being lost; while that backlog lasts, new uploads get one try only.
+
+import hashlib
+import threading
+import Queue
+import time
+import uuid
+import socket
+import sqlite3
+import cv2
+import requests
+
+from archive_sink import ArchiveSink
+from metrics import REGISTRY
+from spool import Spool, BackfillWorker, DEFAULT_MAX_BYTES, SENT, REFUSED, UNREACHABLE
+
+DEFAULT_UPLOAD_URL = 'http://hello-ryan-family.appspot.com/upload_image'
+
+# what submit() does when the queue is full
+DROP_OLDEST = "drop_oldest"     # make room by discarding the stalest frame (default, keeps the newest action)
+DROP_NEWEST = "drop_newest"     # discard the frame being submitted
+BLOCK = "block"                 # wait for room, stalls the capture loop
+BACKPRESSURE_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class UploadStats(object) :
+    """Counters shared by the capture thread and the workers"""
+
+    def __init__(self) :
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.dropped = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.retries = 0
+        self.spooled = 0            # kept in the spool after running out of retries
+        self.backfilled = 0         # later sent from the spool
+        self.total_latency = 0.0     # submit to completed upload, seconds
+        self.max_latency = 0.0
+
+    def count(self, name, n=1) :
+        with self.lock :
+            setattr(self, name, getattr(self, name) + n)
+        REGISTRY.inc('upload_{}_total'.format(name), n)
+
+    def record_upload(self, latency) :
+        with self.lock :
+            self.uploaded += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        REGISTRY.inc('upload_uploaded_total')
+        REGISTRY.observe('upload_latency_seconds', latency)
+
+    def as_dict(self) :
+        with self.lock :
+            return dict(submitted=self.submitted, dropped=self.dropped, uploaded=self.uploaded,
+                        failed=self.failed, retries=self.retries, spooled=self.spooled, backfilled=self.backfilled,
+                        mean_latency=self.total_latency / self.uploaded if self.uploaded else 0.0,
+                        max_latency=self.max_latency)
+
+
+def encode_jpeg(frame, quality) :
+    """ JPEG encode in memory, returns a 1-D uint8 array """
+    ok, jpeg = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)])
+    if not ok :
+        raise IOError("JPEG encode failed")
+    return jpeg.reshape(-1)
+
+
+class MultipartBody(object) :
+    """A multipart/form-data body read straight out of the encoded images, never joined into one string"""
+
+    # requests sees read() and len(), so it sends a Content-Length and streams the parts in blocks
+
+    def __init__(self, fields, file_field, files) :
+        """ fields is a list of (name, value), files a list of (filename, content, content_type) sent as file_field """
+        self.boundary = uuid.uuid4().hex
+        head = []
+        for name, value in fields :
+            head.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+                self.boundary, name, value))
+        self.parts = [memoryview(''.join(head))]
+        for (filename, content, content_type) in files :
+            self.parts.append(memoryview('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                'Content-Type: {}\r\n\r\n'.format(self.boundary, file_field, filename, content_type)))
+            self.parts.append(memoryview(content))
+            self.parts.append(memoryview('\r\n'))
+        self.parts.append(memoryview('--{}--\r\n'.format(self.boundary)))
+        self.length = sum(len(p) for p in self.parts)
+        self.part = 0
+        self.offset = 0
+
+    @property
+    def content_type(self) :
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def __len__(self) :
+        return self.length
+
+    def read(self, size=-1) :
+        chunks = []
+        while self.part < len(self.parts) and size != 0 :
+            part = self.parts[self.part]
+            end = len(part) if size < 0 else min(len(part), self.offset + size)
+            chunks.append(part[self.offset:end].tobytes())
+            if size > 0 :
+                size -= end - self.offset
+            self.offset = end
+            if self.offset == len(part) :
+                self.part += 1
+                self.offset = 0
+        return ''.join(chunks)
+
+
+def device_id(conf) :
+    """ this pi's name to the web app, its incidents are grouped by it """
+    return conf.get("device_id") or socket.gethostname()
+
+
+def capture_epoch(timestamp) :
+    """ a frame's (local time) timestamp as seconds since the epoch, how the web app takes capture times """
+    return time.mktime(timestamp.timetuple()) + timestamp.microsecond / 1e6
+
+
+def post_files(session, url, files, timeout, reason='upload from pi camera', hashes=None, camera=None, captured=None) :
+    """ POST encoded images (or a clip) to the web app, returns the response """
+    data = [('api', True), ('reason', reason)]
+    if camera :
+        data.append(('camera', camera))
+    if hashes and any(hashes) :
+        # one dhash per file, in file order, so the server can spot near duplicates from any camera
+        data.extend(('dhash', h or '') for h in hashes)
+    if captured and any(t is not None for t in captured) :
+        # likewise one capture time per file, which matters for a backlog sent long after
+        data.extend(('captured', '' if t is None else '{:.3f}'.format(t)) for t in captured)
+    body = MultipartBody(data, 'img', files)
+    return session.post(url, data=body, headers={'Content-Type' : body.content_type}, timeout=timeout)
+
+
+class BackgroundUploader(object) :
+    """Bounded upload queue drained by worker threads sharing one HTTP session"""
+
+    def __init__(self, conf, workers=None, queue_size=None, policy=None) :
+        self.conf = conf
+        self.policy = policy or conf.get("upload_backpressure", DROP_OLDEST)
+        if self.policy not in BACKPRESSURE_POLICIES :
+            raise ValueError("unknown upload_backpressure policy: {}".format(self.policy))
+        self.timeout = tuple(conf.get("upload_timeout", (3.05, 15)))   # (connect, read) seconds
+        self.retries = conf.get("upload_retries", 2)
+        self.url = conf.get("upload_url", DEFAULT_UPLOAD_URL)
+        self.camera = device_id(conf)
+        # with batching on, a worker collects frames for up to upload_batch_seconds and sends them in one POST
+        self.batch_max = conf.get("upload_batch_max", 0)
+        self.batch_seconds = conf.get("upload_batch_seconds", 2.0)
+        self.batch_url = conf.get("upload_batch_url", self.url.rsplit('/', 1)[0] + '/upload_batch')
+        # with resumable uploads on, clips go up in upload_part_size PUTs; a dropped connection resends one part, not the clip
+        self.resumable = conf.get("upload_resumable", False)
+        self.part_size = conf.get("upload_part_size", 1024 * 1024)
+        self.session_url = conf.get("upload_session_url", self.url.rsplit('/', 1)[0] + '/upload_session')
+        self.jpeg_quality = conf.get("jpeg_quality", 85)
+        # keeping a copy on the SD card is optional, and never on the upload path
+        self.archive = ArchiveSink(conf["surveillance_images_path"]) if conf.get("archive_images") else None
+        workers = workers or conf.get("upload_workers", 2)
+        # what the workers cannot get through waits on disk, within spool_max_bytes, for the backfill worker
+        self.spool = Spool(conf["spool_path"], conf.get("spool_max_bytes", DEFAULT_MAX_BYTES)) \
+                     if conf.get("spool_path") else None
+
+        self.queue = Queue.Queue(maxsize=queue_size or conf.get("upload_queue_size", 8))
+        self.stats = UploadStats()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers + 1)     # and the backfill
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.backfill = BackfillWorker(conf, self.spool, self.deliver_spooled) if self.spool else None
+
+        self.threads = [threading.Thread(target=self.work, name="uploader-{}".format(i)) for i in range(workers)]
+        for t in self.threads :
+            t.daemon = True     # never hold up shutdown for a stuck upload
+            t.start()
+
+    def submit(self, frame, timestamp, image_hash=None) :
+        """ called on the capture thread, queue the frame and return at once; False if something was dropped """
+        return self.enqueue((frame, timestamp, None, time.time(), image_hash))
+
+    def submit_clip(self, filename, content, content_type, timestamp) :
+        """ queue already encoded content, e.g. an event clip """
+        return self.enqueue((None, timestamp, (filename, content, content_type), time.time(), None))
+
+    def enqueue(self, job) :
+        self.stats.count('submitted')
+        REGISTRY.set('upload_queue_depth', self.queue.qsize())
+        if self.policy == BLOCK :
+            self.queue.put(job)
+            return True
+        try :
+            self.queue.put_nowait(job)
+            return True
+        except Queue.Full :
+            self.stats.count('dropped')
+            if self.policy == DROP_NEWEST :
+                return False
+        # drop oldest, the workers may have made room in the meantime
+        try :
+            self.queue.get_nowait()
+            self.queue.task_done()
+        except Queue.Empty :
+            pass
+        try :
+            self.queue.put_nowait(job)
+        except Queue.Full :
+            self.stats.count('dropped')
+        return False
+
+    def next_jobs(self) :
+        """ block for one job; with batching on, keep collecting frames for a while (a clip or stop ends the batch) """
+        jobs = [self.queue.get()]
+        if not self.batch_max or jobs[0] is None or jobs[0][2] is not None :
+            return jobs
+        deadline = time.time() + self.batch_seconds
+        while len(jobs) < self.batch_max :
+            remaining = deadline - time.time()
+            if remaining <= 0 :
+                break
+            try :
+                job = self.queue.get(timeout=remaining)
+            except Queue.Empty :
+                break
+            jobs.append(job)
+            if job is None or job[2] is not None :
+                break
+        return jobs
+
+    def work(self) :
+        while True :
+            jobs = self.next_jobs()
+            try :
+                frames = [job for job in jobs if job is not None and job[2] is None]
+                clips = [job for job in jobs if job is not None and job[2] is not None]
+                if len(frames) > 1 :
+                    self.upload_batch(frames)
+                elif frames :
+                    self.upload(*frames[0])
+                for job in clips :
+                    self.upload(*job)
+            except Exception as error :
+                # a dead worker would quietly stall the queue, count it and carry on
+                print "upload worker error:", error
+                self.stats.count('failed', len(jobs))
+            finally :
+                for _ in jobs :
+                    self.queue.task_done()
+            if None in jobs :
+                return
+
+    def prepare(self, frame, timestamp, encoded) :
+        """ (filename, content, content_type) for a job, encoding (once) and archiving frames """
+        if encoded is None :
+            # filename in ISO 8601 timestamp
+            # TBD fix ambiguous local time, or add (non-standard?) TZ
+            filename = timestamp.strftime("%Y-%m-%dT%H:%M:%S")+'.jpg'
+            encoded = (filename, encode_jpeg(frame, self.jpeg_quality), 'image/jpeg')
+        if self.archive :
+            self.archive.submit(encoded[0], encoded[1])
+        return encoded
+
+    def upload(self, frame, timestamp, encoded, submitted, image_hash) :
+        """ worker side, one frame or clip in one POST """
+        encoded = self.prepare(frame, timestamp, encoded)
+        captured = capture_epoch(timestamp)
+        if encoded[2].startswith('video/') :
+            if self.resumable :
+                return self.send_resumable(encoded, submitted, 'motion clip from pi camera', captured)
+            return self.send(self.url, [encoded], [submitted], 'motion clip from pi camera', captured=[captured])
+        return self.send(self.url, [encoded], [submitted], 'upload from pi camera', [image_hash], [captured])
+
+    def upload_batch(self, jobs) :
+        """ worker side, several frames in one POST to the batch endpoint """
+        files = [self.prepare(frame, timestamp, encoded) for (frame, timestamp, encoded, _, _) in jobs]
+        return self.send(self.batch_url, files, [job[3] for job in jobs], 'upload from pi camera',
+                         [job[4] for job in jobs], [capture_epoch(job[1]) for job in jobs])
+
+    def attempts(self) :
+        """ tries per upload: one while a spooled backlog says the web app was out of reach lately """
+        return 1 if self.spool and self.spool.depth() else self.retries + 1
+
+    def send(self, url, files, submitted, reason, hashes=None, captured=None) :
+        """ try a few times with backoff, then spool these files (or give up on them) """
+        for attempt in range(self.attempts()) :
+            if attempt :
+                self.stats.count('retries')
+                time.sleep(min(2 ** attempt, 30))
+            try :
+                with REGISTRY.timer('upload_post_seconds', files=len(files)) :
+                    r = post_files(self.session, url, files, self.timeout, reason, hashes, self.camera, captured)
+            except (requests.RequestException, IOError) as error :
+                print "upload error:", error
+                continue
+            print 'status:', r.status_code
+            print 'content', r.content
+            if r.status_code < 400 :
+                now = time.time()
+                for t in submitted :
+                    self.stats.record_upload(now - t)
+                return True
+            if r.status_code < 500 :
+                self.stats.count('failed', len(files))
+                return False    # the server will not change its mind
+        return self.spool_files(files, reason, hashes, captured)
+
+    def spool_files(self, files, reason, hashes=None, captured=None) :
+        """ keep files that could not be sent for the backfill worker, or count them failed without a spool """
+        if self.spool is None :
+            self.stats.count('failed', len(files))
+            return False
+        hashes = hashes or [None] * len(files)
+        captured = captured or [None] * len(files)
+        try :
+            dropped = self.spool.put([(filename, content, content_type, t, h, reason)
+                                      for (filename, content, content_type), h, t in zip(files, hashes, captured)])
+        except sqlite3.Error as error :
+            print "spool error:", error
+            self.stats.count('failed', len(files))
+            return False
+        self.stats.count('spooled', len(files))
+        if dropped :
+            print "spool full, {} oldest uploads dropped".format(dropped)
+        return False
+
+    def deliver_spooled(self, rows) :
+        """ backfill worker side, one try at sending spooled rows (several in one batch POST): SENT, REFUSED or UNREACHABLE """
+        url = self.batch_url if len(rows) > 1 else self.url
+        files = [(row.filename, row.content, row.content_type) for row in rows]
+        try :
+            with REGISTRY.timer('upload_post_seconds', files=len(files)) :
+                r = post_files(self.session, url, files, self.timeout, rows[0].reason, [row.dhash for row in rows],
+                               self.camera, [row.captured for row in rows])
+        except (requests.RequestException, IOError) as error :
+            print "backfill error:", error
+            return UNREACHABLE
+        if r.status_code >= 500 :
+            return UNREACHABLE
+        if r.status_code >= 400 :
+            print "backfill refused:", r.status_code
+            self.stats.count('failed', len(rows))
+            return REFUSED
+        self.stats.count('backfilled', len(rows))
+        return SENT
+
+    def send_resumable(self, encoded, submitted, reason, captured=None) :
+        """ start an upload session, then PUT the content in parts; after an error carry on from the server's offset """
+        filename, content, content_type = encoded
+        digest = hashlib.sha256(content).hexdigest()     # lets the server skip content it already has
+        content = memoryview(content)
+        part_url = None
+        for attempt in range(self.attempts()) :
+            if attempt :
+                self.stats.count('retries')
+                time.sleep(min(2 ** attempt, 30))
+            try :
+                if part_url is None :
+                    r = self.session.post(self.session_url, timeout=self.timeout,
+                                          data=dict(filename=filename, content_type=content_type, sha256=digest,
+                                                    size=len(content), reason=reason, camera=self.camera,
+                                                    captured='' if captured is None else '{:.3f}'.format(captured)))
+                    r.raise_for_status()
+                    started = r.json()
+                    if 'url' in started :
+                        break       # nothing to send, the server already has it
+                    part_url = '{}/{}'.format(self.session_url, started['session'])
+                    offset = started['offset']
+                else :
+                    r = self.session.get(part_url, timeout=self.timeout)
+                    r.raise_for_status()
+                    offset = r.json()['offset']
+                while offset < len(content) :
+                    end = min(len(content), offset + self.part_size)
+                    with REGISTRY.timer('upload_part_seconds') :
+                        r = self.session.put(part_url, data=content[offset:end].tobytes(), timeout=self.timeout,
+                                             params=dict(offset=offset, final=int(end == len(content))),
+                                             headers={'Content-Type' : content_type})
+                    if r.status_code != 409 :
+                        r.raise_for_status()
+                    offset = r.json()['offset']
+                break
+            except requests.HTTPError as error :
+                print "upload error:", error
+                if error.response.status_code < 500 :
+                    self.stats.count('failed')
+                    return False
+            except (requests.RequestException, IOError, ValueError) as error :
+                print "upload error:", error
+        else :
+            return self.spool_files([encoded], reason, captured=[captured])
+        self.stats.record_upload(time.time() - submitted)
+        return True
+
+    def depth(self) :
+        return self.queue.qsize()
+
+    def summary(self) :
+        stats = self.stats.as_dict()
+        stats['queue_depth'] = self.depth()
+        if self.spool :
+            stats['spool_depth'] = self.spool.depth()
+        return stats
+
+    def close(self, wait=True) :
+        """ let the workers finish what is queued (if wait) and stop """
+        if wait :
+            self.queue.join()
+        else :
+            while True :
+                try :
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                except Queue.Empty :
+                    break
+        for _ in self.threads :
+            self.queue.put(None)
+        if wait :
+            for t in self.threads :
+                t.join()
+        if self.backfill :
+            self.backfill.close()   # what is still spooled goes up after the next start
+        self.session.close()
+        if self.spool :
+            self.spool.close()
+        if self.archive :
+            self.archive.close(wait)